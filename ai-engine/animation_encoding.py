@@ -0,0 +1,55 @@
+from io import BytesIO
+
+import imageio.v3 as iio
+import numpy as np
+from PIL import Image
+
+# Animation formats and their mimetypes
+ANIMATION_FORMATS = {
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+    'mp4': 'video/mp4'
+}
+
+
+def animation_format(name):
+    name = (name or 'gif').lower()
+    if name not in ANIMATION_FORMATS:
+        raise ValueError(f"Unknown animation format: {name} (expected one of {', '.join(ANIMATION_FORMATS)})")
+    return name
+
+
+def animation_mimetype(fmt):
+    return ANIMATION_FORMATS[fmt]
+
+
+def decode_frames(encoded):
+    # PIL images of encoded frames (PNG, WebP, ...)
+    frames = []
+    for data in encoded:
+        frame = Image.open(BytesIO(data))
+        frame.load()
+        frames.append(frame.convert('RGB'))
+    return frames
+
+
+def encode_animation(frames, fmt='gif', fps=8, quality=None):
+    # Encodes the frames (PIL images) into memory, looping forever. MP4 is
+    # H.264 / yuv420p through imageio's ffmpeg plugin, which plays everywhere
+    # but needs even sizes (the frames are padded when they are not).
+    duration = int(round(1000 / fps))
+    if fmt == 'gif':
+        buffer = BytesIO()
+        frames[0].save(buffer, 'GIF', save_all=True, append_images=frames[1:], duration=duration, loop=0, disposal=2)
+        return buffer.getvalue()
+    if fmt == 'webp':
+        buffer = BytesIO()
+        frames[0].save(buffer, 'WEBP', save_all=True, append_images=frames[1:], duration=duration, loop=0,
+                       quality=quality or 85, method=4)
+        return buffer.getvalue()
+
+    video = np.stack([np.asarray(frame.convert('RGB')) for frame in frames])
+    _, height, width, _ = video.shape
+    video = np.pad(video, ((0, 0), (0, height % 2), (0, width % 2), (0, 0)), mode='edge')
+    return iio.imwrite('<bytes>', video, extension='.mp4', plugin='FFMPEG', fps=fps, codec='libx264',
+                       quality=quality / 10 if quality else 7, macro_block_size=2)
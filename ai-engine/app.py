@@ -1,109 +1,300 @@
 import os
 import logging
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context, g
 from flask_cors import CORS
 from openai import OpenAI
+import httpx
 import tempfile
-import torch
-import torchaudio
-from transformers import WhisperProcessor, WhisperForConditionalGeneration
+import numpy as np
 from gtts import gTTS
-from TTS.api import TTS 
 from google.generativeai import GenerativeModel, configure
 import google.generativeai as genai
-from diffusers import DPMSolverMultistepScheduler, AutoPipelineForText2Image
 from io import BytesIO
 import base64
-from huggingface_hub import login
 import json
-
-# Set environment variable to accept TTS license agreement
-os.environ["COQUI_TOS_AGREED"] = "1"
-
-# Add safe globals for TTS model loading
-import torch.serialization
-from TTS.tts.configs.xtts_config import XttsConfig
-from TTS.tts.models.xtts import XttsAudioConfig, XttsArgs
-from TTS.config.shared_configs import BaseDatasetConfig
-
-# Fallback if some classes are not available
-torch.serialization.add_safe_globals([
-    XttsConfig, 
-    XttsAudioConfig, 
-    BaseDatasetConfig, 
-    XttsArgs
-])
+import time
+import threading
+import hashlib
+import uuid
+from functools import lru_cache
+from urllib.parse import quote
+from cache import cache_key, LRUCache, DiskCache, TieredCache
+from tts_stream import split_sentences, wav_header, pcm16, encode_wav, pipelined
+from audio_io import read_upload, decode_audio, to_whisper_input, UploadTooLarge, WHISPER_SAMPLE_RATE
+from vad import speech_segments, speech_windows, stitch_transcripts, MAX_WINDOW_SECONDS
+from jobs import JobQueue, QueueFull, JobCancelled, DONE, FAILED, CANCELLED
+from image_store import ImageStore, derive_seed
+from image_encoding import image_format, mimetype, encode_variants
+from animation_encoding import animation_format, animation_mimetype, decode_frames, encode_animation
+from concurrent.futures import CancelledError
+import image_prompts
+from moderation import ModerationPipeline
+from upstream import Upstream
+from story_context import StoryContext
+from singleflight import SingleFlight
+from inference_ipc import InferenceClient
+import metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Only login to Hugging Face if token is provided
-hf_token = os.getenv("HUGGING_FACE_TOKEN")
-if hf_token:
-    logger.info("Logging in to Hugging Face with provided token")
-    try:
-        login(token=hf_token)
-        logger.info("Successfully logged in to Hugging Face")
-    except Exception as e:
-        logger.warning(f"Failed to log in to Hugging Face: {str(e)}")
-        logger.warning("Some features may not work without Hugging Face authentication")
-else:
-    logger.warning("No Hugging Face token provided. Some features may not work.")
-
 app = Flask(__name__)
 CORS(app)
 
 # Global variable to control local vs. API processing
 USE_LOCAL_MODELS = True
 
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# One pooled, keep-alive HTTP client shared by every OpenAI call. Retries are
+# handled by the upstream layer below, so the SDK's own retries are disabled.
+# OPENAI_BASE_URL points the client at another server (e.g. a local fake).
+openai_client = OpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=0,
+    http_client=httpx.Client(
+        limits=httpx.Limits(
+            max_connections=int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "32")),
+            max_keepalive_connections=int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "16"))
+        ),
+        timeout=httpx.Timeout(float(os.getenv("UPSTREAM_TIMEOUT", "60")), connect=5.0)
+    )
+)
 
-# Check CUDA availability
-if torch.cuda.is_available():
-    device = torch.device("cuda")
-    logger.info("CUDA available: True")
-    logger.info(f"CUDA version: {torch.version.cuda}")
-else:
-    device = torch.device("cpu")
-    logger.info("CUDA available: False")
-
-torch.set_num_threads(4)  # Adjust this based on your CPU cores
-
-logger.info("Starting Whisper model")
-
-# Load Whisper model for local processing
-stt_device = torch.device("cuda")
-whisper_processor = WhisperProcessor.from_pretrained("openai/whisper-small")
-whisper_model = WhisperForConditionalGeneration.from_pretrained("openai/whisper-small",
-                                                                device_map="auto",
-                                                                low_cpu_mem_usage=True,
-                                                                max_memory={0: "2GB", "cpu": "8GB"}
-                                                                ).to(stt_device)
-    
 # Configure Google AI
-configure(api_key=os.getenv("GOOGLE_API_KEY"))
-
-logger.info("Starting image generation model")
-# Load image generation models
-torch.cuda.empty_cache()
-pipe = AutoPipelineForText2Image.from_pretrained("stabilityai/stable-diffusion-xl-base-1.0", torch_dtype=torch.float16, variant="fp16", max_memory={0: "8GB", "cpu": "8GB"}).to(device)
-pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
-pipe.enable_model_cpu_offload()
-pipe.to("cpu")
+# GEMINI_API_ENDPOINT switches to the REST transport against another server
+gemini_endpoint = os.getenv("GEMINI_API_ENDPOINT")
+if gemini_endpoint:
+    configure(api_key=os.getenv("GOOGLE_API_KEY"), transport="rest", client_options={"api_endpoint": gemini_endpoint})
+else:
+    configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
-logger.info("Starting Coqui TTS model")
-# Load Coqui TTS model
-coqui_tts = TTS(model_name="tts_models/multilingual/multi-dataset/xtts_v2", progress_bar=False).to(device)
+# The models live in the inference module. By default (python app.py) it is
+# imported and runs in this process. In production mode (gunicorn -c
+# gunicorn.conf.py app:app) every HTTP worker only does parsing, validation,
+# caching and the LLM calls, and reaches the one inference process that owns
+# the models through INFERENCE_ADDRESS (a Unix socket path or host:port).
+INFERENCE_ADDRESS = os.getenv("INFERENCE_ADDRESS")
+if INFERENCE_ADDRESS:
+    inference = InferenceClient(
+        INFERENCE_ADDRESS,
+        authkey=os.getenv("INFERENCE_AUTHKEY", "").encode('utf-8') or None,
+        timeout=float(os.getenv("INFERENCE_TIMEOUT", "0")) or None
+    )
+else:
+    import inference
 
 MODEL_MAPPING = {
     'gpt4o-mini': 'gpt-4o-mini',
     'gemini-pro': 'gemini-pro'
 }
 
+upstream = Upstream(
+    openai_client,
+    GenerativeModel,
+    MODEL_MAPPING,
+    max_concurrency=int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "8")),
+    max_retries=int(os.getenv("UPSTREAM_MAX_RETRIES", "2")),
+    request_timeout=float(os.getenv("UPSTREAM_TIMEOUT", "60")),
+    failure_threshold=int(os.getenv("UPSTREAM_BREAKER_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("UPSTREAM_BREAKER_RESET", "30"))
+)
+
 AVAILABLE_VOICES = ["alloy", "echo", "fable", "google", "onyx", "nova", "shimmer"]
 if USE_LOCAL_MODELS:
     AVAILABLE_VOICES.append("isabela")
 
+TTS_MIMETYPES = {'.wav': 'audio/wav', '.mp3': 'audio/mp3'}
+
+# Longest that model work may wait for the GPU before it is dropped (504), per
+# model; 0 waits indefinitely. A caller can shorten it with X-Deadline-Ms, its
+# remaining time budget. X-Game-Id (or gameId in a JSON body) names the game
+# the GPU time is accounted to, so that busy games cannot starve the others.
+GPU_DEADLINE_SECONDS = {
+    'whisper': float(os.getenv("STT_DEADLINE_SECONDS", "30")),
+    'xtts': float(os.getenv("TTS_DEADLINE_SECONDS", "60")),
+    'sdxl': float(os.getenv("IMAGE_DEADLINE_SECONDS", "300")),
+    'animation': float(os.getenv("ANIMATION_DEADLINE_SECONDS", "600"))
+}
+
+# Identical /tts, /generate-image and /generate requests that arrive while one
+# is being computed wait for it and share its result instead of computing it
+# again. A waiting request gives up after COALESCE_TIMEOUT seconds (504; 0
+# waits as long as the request it joined) without affecting the others.
+COALESCE_TIMEOUT = float(os.getenv("COALESCE_TIMEOUT", "0")) or None
+tts_flight = SingleFlight('tts')
+image_flight = SingleFlight('generate_image')
+generate_flight = SingleFlight('generate')
+
+# Uploads to /speech-to-text are read into memory up to this size (413 above)
+MAX_AUDIO_UPLOAD_BYTES = int(os.getenv("MAX_AUDIO_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+
+# XTTS v2 always produces 24 kHz audio
+XTTS_SAMPLE_RATE = 24000
+
+# OpenAI returns raw 16-bit mono PCM at 24 kHz for response_format="pcm"
+OPENAI_PCM_SAMPLE_RATE = 24000
+
+# Synthesized audio cache: a small LRU in memory in front of a byte-budgeted
+# directory on disk. Set TTS_CACHE_MAX_BYTES=0 to disable the disk tier.
+tts_cache = TieredCache(
+    LRUCache(
+        max_items=int(os.getenv("TTS_CACHE_MEMORY_ITEMS", "128")),
+        max_bytes=int(os.getenv("TTS_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+    ),
+    DiskCache(
+        os.getenv("TTS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ai-engine-tts-cache")),
+        max_bytes=int(os.getenv("TTS_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+    )
+)
+
+# Image quality profiles, from a quick low-res preview to the full render.
+# DPM++ 2M with Karras sigmas converges well before 50 steps. refine_strength
+# is how much of a preview is re-denoised when it is refined into the
+# profile (two-phase mode); dalle_size is used when rendering through the API.
+IMAGE_PROFILES = {
+    'preview': {'width': 512, 'height': 512, 'steps': 12, 'guidance_scale': 5.0, 'scheduler': 'dpmpp_2m_karras', 'dalle_size': '256x256'},
+    'standard': {'width': 1024, 'height': 1024, 'steps': 25, 'guidance_scale': 7.0, 'scheduler': 'dpmpp_2m_karras', 'refine_strength': 0.6, 'dalle_size': '256x256'},
+    'high': {'width': 1024, 'height': 1024, 'steps': 40, 'guidance_scale': 7.5, 'scheduler': 'dpmpp_2m_karras', 'refine_strength': 0.7, 'dalle_size': '512x512'}
+}
+IMAGE_DEFAULT_PROFILE = os.getenv("IMAGE_DEFAULT_PROFILE", "standard")
+
+IMAGE_MAX_BATCH_SIZE = int(os.getenv("IMAGE_MAX_BATCH_SIZE", "2"))
+
+# Animated scenes (AnimateDiff on the local SDXL). vae_slicing decodes one
+# frame at a time: less memory and the first frame streams sooner; decoding
+# all frames at once is faster when they are small.
+ANIMATION_PROFILES = {
+    'preview': {'width': 512, 'height': 512, 'frames': 8, 'steps': 12, 'guidance_scale': 6.0, 'fps': 8, 'vae_slicing': False},
+    'standard': {'width': 768, 'height': 768, 'frames': 16, 'steps': 20, 'guidance_scale': 7.5, 'fps': 8, 'vae_slicing': True},
+    'high': {'width': 1024, 'height': 1024, 'frames': 16, 'steps': 30, 'guidance_scale': 8.0, 'fps': 8, 'vae_slicing': True}
+}
+ANIMATION_DEFAULT_PROFILE = os.getenv("ANIMATION_DEFAULT_PROFILE", "standard")
+
+# Encoded animations of finished jobs, per job and format
+animation_cache = LRUCache(
+    max_items=int(os.getenv("ANIMATION_CACHE_ITEMS", "32")),
+    max_bytes=int(os.getenv("ANIMATION_CACHE_BYTES", str(256 * 1024 * 1024)))
+)
+
+# Seconds between two looks at a job streamed by GET /jobs/<id>/frames
+JOB_STREAM_POLL_INTERVAL = float(os.getenv("JOB_STREAM_POLL_INTERVAL", "0.25"))
+
+# Rendered images, addressed by prompt, settings, seed and model, with aliases
+# from the raw request inputs. Set IMAGE_CACHE_MAX_BYTES=0 to disable the disk tier.
+image_store = ImageStore(
+    TieredCache(
+        LRUCache(
+            max_items=int(os.getenv("IMAGE_CACHE_MEMORY_ITEMS", "64")),
+            max_bytes=int(os.getenv("IMAGE_CACHE_MEMORY_BYTES", str(128 * 1024 * 1024)))
+        ),
+        DiskCache(
+            os.getenv("IMAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ai-engine-image-cache")),
+            max_bytes=int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+        )
+    ),
+    os.getenv("SDXL_MODEL_ID", "stabilityai/stable-diffusion-xl-base-1.0") if USE_LOCAL_MODELS else 'dall-e-2'
+)
+
+# Image jobs run on dedicated worker threads, as many as fit in one image
+# batch. Submissions beyond IMAGE_JOB_MAX_QUEUE are rejected with 429;
+# finished jobs are kept for polling for IMAGE_JOB_RESULT_TTL seconds. In
+# production mode the jobs are also published to the inference process, so a
+# job can be polled through any HTTP worker (the limits are per worker).
+image_jobs = JobQueue(
+    max_queued=int(os.getenv("IMAGE_JOB_MAX_QUEUE", "8")),
+    result_ttl=int(os.getenv("IMAGE_JOB_RESULT_TTL", "600")),
+    name='image-worker',
+    workers=int(os.getenv("IMAGE_JOB_WORKERS", str(IMAGE_MAX_BATCH_SIZE))),
+    board=inference.job_board if INFERENCE_ADDRESS else None
+)
+
+request_seconds = metrics.REGISTRY.histogram('request_seconds', 'HTTP request latency (streams: until the response starts)', ('route', 'method'))
+requests_total = metrics.REGISTRY.counter('requests_total', 'HTTP requests by status', ('route', 'method', 'status'))
+request_errors = metrics.REGISTRY.counter('request_errors_total', 'HTTP requests that failed with a 5xx', ('route',))
+metrics.REGISTRY.gauge('image_job_queue_depth', 'Image jobs waiting for a worker thread', lambda: image_jobs.depth())
+
+# Requests slower than this (or carrying an X-Trace-Id) are logged with the
+# time spent in each stage
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "5000"))
+
+# Production mode: each worker pushes its metrics to the inference process
+# every METRICS_PUSH_INTERVAL seconds, so a scrape of any worker sees them all
+METRICS_PUSH_INTERVAL = float(os.getenv("METRICS_PUSH_INTERVAL", "10"))
+METRICS_SOURCE = f"worker-{os.getpid()}"
+
+def push_metrics():
+    while True:
+        time.sleep(METRICS_PUSH_INTERVAL)
+        try:
+            inference.metrics.push(METRICS_SOURCE, metrics.REGISTRY.snapshot())
+        except Exception as e:
+            logger.warning(f"Could not push metrics: {str(e)}")
+
+if INFERENCE_ADDRESS:
+    threading.Thread(target=push_metrics, name='metrics-push', daemon=True).start()
+
+@app.before_request
+def start_trace():
+    # The game-server's X-Trace-Id (or a new id) follows the request through
+    # its stages, the inference process and the jobs it submits.
+    # "X-Torch-Profile: <model>" records that model's next run with the
+    # torch profiler, when TORCH_PROFILER=1.
+    g.trace, g.trace_token = metrics.begin_trace(request.headers.get('X-Trace-Id'))
+    g.request_start = time.perf_counter()
+    profile_model = request.headers.get('X-Torch-Profile')
+    if profile_model:
+        try:
+            inference.profiler.arm(profile_model, g.trace.trace_id)
+        except PermissionError as e:
+            logger.warning(str(e))
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    elapsed = time.perf_counter() - g.request_start
+    request_seconds.labels(route, request.method).observe(elapsed)
+    requests_total.labels(route, request.method, str(response.status_code)).inc()
+    if response.status_code >= 500:
+        request_errors.labels(route).inc()
+
+    stages = g.trace.stage_ms()
+    response.headers['X-Trace-Id'] = g.trace.trace_id
+    if stages:
+        response.headers['Server-Timing'] = ', '.join(f"{stage};dur={ms}" for stage, ms in stages.items())
+    if 'X-Trace-Id' in request.headers or elapsed * 1000 >= SLOW_REQUEST_MS:
+        logger.info(f"trace={g.trace.trace_id} {request.method} {route} {response.status_code} "
+                    f"{round(elapsed * 1000, 1)}ms stages={stages}")
+    return response
+
+@app.teardown_request
+def end_trace(error=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        try:
+            metrics.end_trace(token)
+        except ValueError:
+            # Streamed responses may finish in another context
+            pass
+
+def request_tenant():
+    tenant = request.headers.get('X-Game-Id')
+    if not tenant and request.is_json:
+        tenant = (request.get_json(silent=True) or {}).get('gameId')
+    return str(tenant) if tenant else None
+
+def request_deadline():
+    budget = request.headers.get('X-Deadline-Ms')
+    try:
+        return time.time() + float(budget) / 1000 if budget else None
+    except ValueError:
+        return None
+
+def gpu_deadline(model, deadline=None):
+    # The deadline of model work queued now: the model's limit, or the
+    # caller's deadline if that comes first
+    limit = GPU_DEADLINE_SECONDS[model]
+    deadlines = [d for d in (deadline, time.time() + limit if limit else None) if d is not None]
+    return min(deadlines) if deadlines else None
+
 logger.info("Starting Flask app")
 @app.route('/generate-local-image', methods=['POST'])
 def generate_local_image():
@@ -111,64 +302,74 @@ def generate_local_image():
     prompt = data.get('prompt', 'a beautiful landscape')
 
     try:
-        # Clear GPU cache before generating the image
-        torch.cuda.empty_cache()
-        image = pipe(prompt).images[0]
-        img_io = BytesIO()
-        image.save(img_io, 'PNG')
-        img_io.seek(0)
-        torch.cuda.empty_cache()
-
-        return send_file(img_io, mimetype='image/png')
+        # Same settings as the pipeline defaults, no negative prompt
+        png = inference.render_image(prompt, steps=50, guidance_scale=5.0)
+        return send_file(BytesIO(png), mimetype='image/png')
     except Exception as e:
         logger.error(f"Error in generate_image: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def transcribe_long_form(samples, language, tenant=None, deadline=None):
+    # Silence is cut by the VAD and the speech is packed into <=30 s windows,
+    # which go through Whisper together as one batch
+    with metrics.span('vad'):
+        windows = speech_windows(samples, WHISPER_SAMPLE_RATE, speech_segments(samples, WHISPER_SAMPLE_RATE))
+    if not windows:
+        return '', []
+
+    texts = inference.transcribe_windows([window.samples for window in windows], language, tenant, gpu_deadline('whisper', deadline))
+
+    stitched, transcript = stitch_transcripts(windows, [text.strip() for text in texts])
+    segments = [
+        {'start': round(window.start, 2), 'end': round(window.end, 2), 'text': text}
+        for window, text in zip(windows, stitched)
+        if text
+    ]
+    return transcript, segments
+
 @app.route('/speech-to-text', methods=['POST'])
 def speech_to_text():
     #get the language from the request headers
     language = request.headers.get('language', 'en')
+    # Long-form mode is used automatically for audio over 30 s, and can be
+    # forced for shorter audio with ?long_form=1 or a "long-form: 1" header
+    force_long_form = request.args.get('long_form', request.headers.get('long-form', '')).lower() in ('1', 'true', 'yes')
+    tenant, deadline = request_tenant(), request_deadline()
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_audio:
-            temp_audio.write(request.stream.read())
-            temp_audio.flush()
+        # The upload stays in memory, nothing is written to /tmp
+        audio_bytes = read_upload(request.stream, MAX_AUDIO_UPLOAD_BYTES)
 
         if USE_LOCAL_MODELS:
-            # Local processing using Whisper-tiny on CPU
-            waveform, sample_rate = torchaudio.load(temp_audio.name)
-            input_features = whisper_processor(waveform.squeeze().numpy(), sampling_rate=sample_rate, return_tensors="pt", language=language).input_features
-            
-            # Ensure input_features are on CPU
-            input_features = input_features.to(stt_device)
-            
-            with torch.no_grad():
-                predicted_ids = whisper_model.generate(input_features)
-            
-            transcript = whisper_processor.batch_decode(predicted_ids, skip_special_tokens=True)[0]
+            # Local processing using Whisper; decoding and resampling happen
+            # here, the features and generate() where the model lives
+            with metrics.span('audio_decode'):
+                waveform, sample_rate = decode_audio(audio_bytes)
+                samples = to_whisper_input(waveform, sample_rate)
+
+            if force_long_form or len(samples) > MAX_WINDOW_SECONDS * WHISPER_SAMPLE_RATE:
+                transcript, segments = transcribe_long_form(samples, language.split('-')[0], tenant, deadline)
+                return jsonify({'transcript': transcript, 'segments': segments})
+
+            transcript = inference.transcribe(samples, language.split('-')[0], tenant, gpu_deadline('whisper', deadline))
         else:
             # API processing, the language must be on ISO-639-1 format e.g. pt-br must be converted to pt
-            with open(temp_audio.name, 'rb') as audio_file:
-                transcript = openai_client.audio.transcriptions.create(
-                    model="whisper-1", 
-                    file=audio_file,
-                    response_format="text",
-                    language=language.split('-')[0]
-                )
-        
-        os.unlink(temp_audio.name)
+            transcript = upstream.call('openai', 'whisper-1', lambda: openai_client.audio.transcriptions.create(
+                model="whisper-1", 
+                file=("audio.wav", audio_bytes),
+                response_format="text",
+                language=language.split('-')[0]
+            ))
         
         return jsonify({'transcript': transcript})
+    except UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except TimeoutError as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         logger.error(f"Error in speech_to_text: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/tts', methods=['POST'])
-def text_to_speech():
-    data = request.json
-    text = data['text']
-    voice = data.get('voice', 'alloy')
-    language = data.get('language', 'en')
-
+def extract_tts_text(text):
     if text.startswith("```json"):
         text = text.split("```json")[1].split("```")[0]
 
@@ -182,205 +383,825 @@ def text_to_speech():
     except json.JSONDecodeError:
         # If text is not valid JSON, keep the original text
         logger.info("Text is not valid JSON, using original text.")
-        
+
+    return text
+
+def tts_backend(voice):
+    if voice == 'google':
+        return 'gtts'
+    elif USE_LOCAL_MODELS:
+        return 'xtts'
+    return 'openai'
+
+def tts_sentences(text, is_kids_mode=False, language=None):
+    # In kids mode every sentence is checked right away: clean sentences are
+    # approved by the local pre-filter, flagged ones go to the LLM moderator in
+    # parallel while the sentences before them are already being synthesized
+    sentences = split_sentences(text)
+    if not is_kids_mode:
+        return sentences
+    moderated = [kids_moderation.submit(sentence, language, model='gpt4o-mini') for sentence in sentences]
+    return (future.result().text for future in moderated)
+
+def synthesize_speech(text, voice, language, backend, is_kids_mode=False, tenant=None, deadline=None):
+    # Returns the synthesized audio bytes and their file suffix
+    if is_kids_mode and backend != 'xtts':
+        text = ' '.join(tts_sentences(text, is_kids_mode, language))
+    # Everything is synthesized into memory buffers, no temp files
+    if backend == 'gtts':
+        audio_io = BytesIO()
+        with metrics.span('gtts'):
+            gTTS(text=text, lang=language).write_to_fp(audio_io)
+        return audio_io.getvalue(), '.mp3'
+    elif backend == 'xtts':
+        # Use Coqui TTS to generate speech, one sentence at a time with a
+        # short pause in between
+        pause = np.zeros(XTTS_SAMPLE_RATE // 4, dtype=np.float32)
+        samples = []
+        for sentence in tts_sentences(text, is_kids_mode, language):
+            samples.extend([inference.xtts_synthesize(sentence, voice, language, tenant, gpu_deadline('xtts', deadline)), pause])
+        return encode_wav(pcm16(np.concatenate(samples or [pause])), XTTS_SAMPLE_RATE), '.wav'
+
+    # API processing
+    response = upstream.call('openai', 'tts-1', lambda: openai_client.audio.speech.create(
+        model="tts-1",
+        voice=voice,
+        input=text
+    ))
+    return response.content, '.wav'
+
+def stream_speech(text, voice, language, backend, is_kids_mode=False, tenant=None, deadline=None):
+    # Yields audio chunks as soon as each sentence is synthesized. For WAV the
+    # header is written once, up front, with an open-ended data size.
+    if is_kids_mode and backend != 'xtts':
+        text = ' '.join(tts_sentences(text, is_kids_mode, language))
+
+    if backend == 'gtts':
+        # gTTS already requests and yields the audio one text chunk at a time
+        yield from gTTS(text=text, lang=language).stream()
+    elif backend == 'xtts':
+        yield wav_header(XTTS_SAMPLE_RATE)
+
+        pause = np.zeros(XTTS_SAMPLE_RATE // 4, dtype=np.float32)
+
+        def synthesize(sentence):
+            return pcm16(np.concatenate([inference.xtts_synthesize(sentence, voice, language, tenant, gpu_deadline('xtts', deadline)), pause]))
+
+        # The next sentence is synthesized while the current one is being sent
+        yield from pipelined(tts_sentences(text, is_kids_mode, language), synthesize)
+    else:
+        yield wav_header(OPENAI_PCM_SAMPLE_RATE)
+
+        def speech_chunks():
+            with openai_client.audio.speech.with_streaming_response.create(
+                model="tts-1",
+                voice=voice,
+                input=text,
+                response_format="pcm"
+            ) as response:
+                yield from response.iter_bytes(4096)
+
+        def open_speech():
+            chunks = speech_chunks()
+            return next(chunks, None), chunks
+
+        yield from upstream.call_stream('openai', 'tts-1', open_speech)
+
+def cache_streamed_speech(key, chunks, backend):
+    # Passes the chunks through and caches the complete audio once the stream
+    # finished successfully
+    collected = []
+    try:
+        for chunk in chunks:
+            collected.append(chunk)
+            yield chunk
+    except Exception as e:
+        # Headers are already sent at this point, all we can do is end the stream
+        logger.error(f"Error in streaming text_to_speech: {str(e)}")
+        return
+
+    if backend == 'gtts':
+        tts_cache.put(key, b''.join(collected), '.mp3')
+    elif collected:
+        header, pcm = collected[0], b''.join(collected[1:])
+        sample_rate = int.from_bytes(header[24:28], 'little')
+        tts_cache.put(key, encode_wav(pcm, sample_rate), '.wav')
+
+def cached_speech(key):
+    # The cached audio of key and its suffix, or None. A disk hit is read and
+    # promoted to the memory tier rather than sent from its path: another
+    # worker's eviction can unlink the file before the response is written,
+    # and a file that is already gone counts as a miss.
+    cached = tts_cache.get(key)
+    if cached is None:
+        return None
+    tier, value, metadata = cached
+    if tier == 'disk':
+        try:
+            with open(value, 'rb') as f:
+                value = f.read()
+        except OSError:
+            return None
+        tts_cache.memory.put(key, value, suffix=metadata['suffix'])
+    return value, metadata['suffix']
+
+@app.route('/tts', methods=['POST'])
+def text_to_speech():
+    data = request.json
+    text = extract_tts_text(data['text'])
+    voice = data.get('voice', 'alloy')
+    language = data.get('language', 'en')
+    stream = str(request.args.get('stream', data.get('stream', ''))).lower() in ('1', 'true')
+    is_kids_mode = bool(data.get('isKidsMode', False))
+    tenant, deadline = request_tenant(), request_deadline()
 
     if voice not in AVAILABLE_VOICES:
         return jsonify({'error': 'Invalid voice selected'}), 400
     
     try:
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-        
-        if voice == 'google':
-            tts = gTTS(text=text, lang=language)
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-            tts.save(temp_file.name)
-            return send_file(temp_file.name, mimetype="audio/mp3")
-        elif USE_LOCAL_MODELS:
-            # Use Coqui TTS to generate speech
-            text = text.replace(".","\n")
-            coqui_tts.tts_to_file(text=text, file_path=temp_file.name, language=language[:2], speaker_wav="voice_samples/"+voice+".wav")
-            return send_file(temp_file.name, mimetype="audio/wav")
-        else:
-            # API processing
-            response = openai_client.audio.speech.create(
-                model="tts-1",
-                voice=voice,
-                input=text
-            )
-            response.stream_to_file(temp_file.name)
-        
-        return send_file(temp_file.name, mimetype="audio/wav")
+        backend = tts_backend(voice)
+        key = cache_key('tts', backend, voice, language, is_kids_mode, ' '.join(text.split()))
+
+        cached = cached_speech(key)
+        if cached:
+            audio, suffix = cached
+            return send_file(BytesIO(audio), mimetype=TTS_MIMETYPES[suffix])
+
+        if stream:
+            mimetype = TTS_MIMETYPES['.mp3' if backend == 'gtts' else '.wav']
+            chunks = cache_streamed_speech(key, stream_speech(text, voice, language, backend, is_kids_mode, tenant, deadline), backend)
+            return Response(stream_with_context(chunks), mimetype=mimetype)
+
+        def synthesize(flight):
+            audio, suffix = synthesize_speech(text, voice, language, backend, is_kids_mode, tenant, deadline)
+            tts_cache.put(key, audio, suffix)
+            return audio, suffix
+
+        audio, suffix = tts_flight.do(key, synthesize, timeout=COALESCE_TIMEOUT)
+        return send_file(BytesIO(audio), mimetype=TTS_MIMETYPES[suffix])
+    except TimeoutError as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         logger.error(f"Error in text_to_speech: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 
+def image_profile(data):
+    profile = data.get('profile') or IMAGE_DEFAULT_PROFILE
+    if profile not in IMAGE_PROFILES:
+        raise ValueError(f"Unknown image profile: {profile} (expected one of {', '.join(IMAGE_PROFILES)})")
+    return profile
+
+def is_progressive(data, profile):
+    # Two-phase delivery: a preview first, then the preview refined into the
+    # requested profile. Only the local pipeline can refine an image.
+    return bool(data.get('progressive')) and USE_LOCAL_MODELS and profile != 'preview'
+
+def image_seed(data, image_prompt, negative_prompt):
+    # An explicit seed, or one derived from the prompts so that the same
+    # scene always renders to the same image
+    seed = data.get('seed')
+    if seed is None:
+        return derive_seed(image_prompt, negative_prompt)
+    try:
+        return int(seed)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid seed: {seed}")
+
+def image_alias(data, negative_prompt, profile):
+    # Raw inputs of a request, before the LLM prompt expansion
+    return image_store.alias_key(image_prompts.prompt_inputs(data), negative_prompt, profile, data.get('seed'))
+
+def image_key(image_prompt, negative_prompt, profile, seed, init_image=None):
+    return image_store.image_key(image_prompt, negative_prompt, IMAGE_PROFILES[profile], seed, init_image)
+
+def cached_image(alias):
+    # (PNG bytes, metadata) for a request whose raw inputs were rendered before
+    hit = image_store.get_alias(alias)
+    if hit is None:
+        return None
+    entry, png = hit
+    return png, {'prompt': entry['prompt'], 'seed': entry['seed']}
+
+def render_image(image_prompt, negative_prompt, profile, seed, on_step=None, cancelled=None, init_image=None, use_cache=True,
+                 tenant=None, deadline=None):
+    # Returns the rendered PNG bytes. With init_image (PNG bytes), that image
+    # is refined into the profile instead of generated from scratch. Rendered
+    # images are stored, and served from the store on an exact repeat.
+    key = image_key(image_prompt, negative_prompt, profile, seed, init_image)
+    if use_cache:
+        png = image_store.get(key)
+        if png is not None:
+            return png
+
+    png = render_png(image_prompt, negative_prompt, profile, seed, on_step, cancelled, init_image, tenant, deadline)
+    # A render cancelled late may still have returned; it is never stored
+    if cancelled and cancelled():
+        raise CancelledError()
+    image_store.put(key, png)
+    return png
+
+def render_png(image_prompt, negative_prompt, profile, seed, on_step=None, cancelled=None, init_image=None, tenant=None, deadline=None):
+    settings = IMAGE_PROFILES[profile]
+    if USE_LOCAL_MODELS:
+        # Generate the image using the local SDXL model, batched with any
+        # other image requests that use the same settings
+        return inference.render_image(
+            image_prompt,
+            negative_prompt,
+            width=settings['width'],
+            height=settings['height'],
+            steps=settings['steps'],
+            guidance_scale=settings['guidance_scale'],
+            scheduler=settings['scheduler'],
+            init_image=init_image,
+            strength=settings.get('refine_strength'),
+            seed=seed,
+            on_step=on_step,
+            cancelled=cancelled,
+            tenant=tenant,
+            deadline=gpu_deadline('sdxl', deadline)
+        )
+
+    # Generate the image using the DALL-E API (it takes no seed)
+    response = upstream.call('openai', 'dall-e-2', lambda: openai_client.images.generate(
+        model="dall-e-2",
+        prompt=image_prompt,
+        size=settings['dalle_size'],
+        response_format="b64_json",
+        n=1
+    ))
+    return base64.b64decode(response.data[0].b64_json)
+
+def image_encoding_options(data):
+    # Output format, quality and thumbnail sizes, from the JSON body or the
+    # query string (format=webp&quality=80&thumbnails=256,512)
+    fmt = image_format(data.get('format') or request.args.get('format'))
+    quality = data.get('quality') or request.args.get('quality')
+    thumbnails = data.get('thumbnails') or request.args.get('thumbnails') or []
+    if isinstance(thumbnails, str):
+        thumbnails = [size for size in thumbnails.split(',') if size.strip()]
+    try:
+        quality = int(quality) if quality else None
+        thumbnails = sorted({int(size) for size in thumbnails})
+    except (TypeError, ValueError):
+        raise ValueError("quality and thumbnails must be integers")
+    if quality is not None and not 1 <= quality <= 100:
+        raise ValueError("quality must be between 1 and 100")
+    if any(not 16 <= size <= 1024 for size in thumbnails):
+        raise ValueError("thumbnail sizes must be between 16 and 1024")
+    return {'format': fmt, 'quality': quality, 'thumbnails': thumbnails}
+
+def encoded_images(png, options):
+    # The image and its thumbnails in the requested format. Encoded variants
+    # are stored under the hash of the PNG, so repeats are not re-encoded.
+    fmt, quality, sizes = options['format'], options['quality'], options['thumbnails']
+    digest = hashlib.sha256(png).hexdigest()
+    variant_keys = {name: cache_key('image-variant', digest, fmt, quality, name) for name in ['full'] + [str(size) for size in sizes]}
+    if fmt == 'png':
+        variant_keys.pop('full')
+
+    variants = {name: image_store.get(variant_key) for name, variant_key in variant_keys.items()}
+    missing = [name for name, data in variants.items() if data is None]
+    if missing:
+        with metrics.span('image_encode'):
+            encoded = encode_variants(png, fmt, quality, [int(name) for name in missing if name != 'full'])
+        if 'full' not in missing:
+            encoded.pop('full')
+        for name, data in encoded.items():
+            if name in variant_keys:
+                image_store.put(variant_keys[name], data, '.' + fmt)
+        variants.update(encoded)
+    variants.setdefault('full', png)
+    return variants
+
+# Response headers carrying the metadata of a raw image (values are URL-encoded)
+IMAGE_METADATA_HEADERS = {
+    'prompt': 'X-Image-Prompt',
+    'profile': 'X-Image-Profile',
+    'seed': 'X-Image-Seed',
+    'jobId': 'X-Job-Id',
+    'timings': 'X-Image-Timings'
+}
+
+def image_response(png, metadata, options):
+    # Default: JSON with the base64 image (and thumbnails), as before.
+    # "Accept: image/*" returns the raw image with the metadata in X-Image-*
+    # headers; "Accept: multipart/mixed" returns the metadata as a JSON part
+    # followed by the image and each thumbnail.
+    variants = encoded_images(png, options)
+    fmt = options['format']
+    accept = request.headers.get('Accept', '')
+
+    if 'multipart/mixed' in accept:
+        boundary = uuid.uuid4().hex
+        parts = [(
+            'Content-Type: application/json\r\nContent-Disposition: inline; name="metadata"',
+            json.dumps(dict(metadata, format=fmt)).encode('utf-8')
+        )]
+        for name, data in variants.items():
+            part_name = 'image' if name == 'full' else f"thumbnail-{name}"
+            parts.append((f'Content-Type: {mimetype(fmt)}\r\nContent-Disposition: inline; name="{part_name}"', data))
+        body = b''.join(
+            f"--{boundary}\r\n{headers}\r\n\r\n".encode('utf-8') + data + b"\r\n" for headers, data in parts
+        ) + f"--{boundary}--\r\n".encode('utf-8')
+        return Response(body, mimetype=f"multipart/mixed; boundary={boundary}")
+
+    if 'image/' in accept:
+        response = Response(variants['full'], mimetype=mimetype(fmt))
+        for name, value in metadata.items():
+            if value is not None:
+                response.headers[IMAGE_METADATA_HEADERS.get(name, 'X-Image-' + name.capitalize())] = quote(value if isinstance(value, str) else json.dumps(value))
+        return response
+
+    body = dict(metadata, image=base64.b64encode(variants['full']).decode('utf-8'), format=fmt)
+    if options['thumbnails']:
+        body['thumbnails'] = {name: base64.b64encode(data).decode('utf-8') for name, data in variants.items() if name != 'full'}
+    return jsonify(body)
+
+def bypass_cache(data):
+    # Per request opt-out of the memoized LLM steps: {"noCache": true} in the
+    # body or a "Cache-Control: no-cache" header
+    return bool(data.get('noCache')) or 'no-cache' in request.headers.get('Cache-Control', '')
+
 @app.route('/generate-image', methods=['POST'])
 def generate_image():
     try:
         data = request.json
-        context_prompt = data['contextPrompt']
-        current_message = data['currentMessage']
-        is_kids_mode = data.get('isKidsMode', False)
-        style = data.get('style', 'cartoon')  # Default to 'cartoon' if not provided
         negative_prompt = data.get('negative_prompt', 'blurry, bad art, poor quality')
-        theme = data.get('theme', '')
-    
-        # Adjust the system message based on kids mode
-        system_message = (
-            "You are an AI that generates detailed image prompts based on story context. "
-            "Create a vivid, descriptive prompt that captures the scene, including relevant details from the context. "
-            "Focus on visual elements and maintain continuity with previous events. "
-            f"The prompt should be suitable for image generation. Apply a {style} art style to the image. "
-        )
+        profile = image_profile(data)
+        progressive = is_progressive(data, profile)
+        options = image_encoding_options(data)
+        use_cache = not bypass_cache(data)
+        timings = {}
 
-        if is_kids_mode:
-            system_message += (
-                "As this is for a children's story, ensure all content is family-friendly and appropriate for young audiences. "
-                "Avoid any scary, violent, or adult themes. Focus on whimsical, colorful, and positive imagery. "
-                "Characters should be cute or friendly-looking. Scenes should be bright and cheerful. "
-            )
-        
-        if theme:
-            system_message += (f" The theme of the game is {theme}.")
-        
-        # Generate a detailed image prompt
-        detailed_prompt = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": f"Context:\n{context_prompt}\n\nCurrent action:\n{current_message}\n\nGenerate a detailed image prompt for this scene in {style} style:"}
-            ],
-            max_tokens=75
+        # A repeat of an earlier request skips prompt expansion and rendering
+        start = time.perf_counter()
+        alias = image_alias(data, negative_prompt, profile)
+        cached = cached_image(alias) if use_cache else None
+        if cached:
+            png, metadata = cached
+            timings['image_cache_ms'] = round((time.perf_counter() - start) * 1000, 3)
+            return image_response(png, dict(metadata, profile=profile, timings=timings), options)
+
+        # The encoding options are left out of the key: every request sharing
+        # the render encodes it its own way
+        png, metadata = image_flight.do(
+            cache_key('generate-image', alias, progressive, use_cache),
+            lambda flight: produce_image(data, alias, negative_prompt, profile, progressive, use_cache, timings,
+                                         request_tenant(), request_deadline()),
+            timeout=COALESCE_TIMEOUT
         )
-        
-        image_prompt = detailed_prompt.choices[0].message.content.strip()
-        
-        # Add a safety check for kids mode
-        if is_kids_mode:
-            safety_check = openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a content moderator for children's content. Evaluate the following image prompt and determine if it's suitable for children. If it's not suitable, provide a modified, child-friendly version."},
-                    {"role": "user", "content": f"Image prompt: {image_prompt}\n\nIs this prompt suitable for children? If not, provide a modified version:"}
-                ],
-                max_tokens=100
-            )
-            
-            safety_response = safety_check.choices[0].message.content.strip()
-            if "not suitable" in safety_response.lower():
-                image_prompt = safety_response.split("Modified version:")[-1].strip()
-        
-        if USE_LOCAL_MODELS:
-            # Generate the image using the local SDXL Turbo model
-            torch.cuda.empty_cache()
-
-            image = pipe(
-                prompt=image_prompt,
-                negative_prompt=negative_prompt,
-                num_inference_steps=50, 
-                max_embeddings_multiples=3,
-                guidance_scale=7.5,
-                width=1024,
-                height=1024
-            ).images[0]
-
-            torch.cuda.empty_cache()  # Clear unused GPU memory
-
-            img_io = BytesIO()
-            image.save(img_io, 'PNG')
-            img_io.seek(0)
-            image_data = base64.b64encode(img_io.getvalue()).decode('utf-8')
-        else:
-            # Generate the image using the DALL-E API
-            response = openai_client.images.generate(
-                model="dall-e-2",
-                prompt=image_prompt,
-                size="256x256",
-                response_format="b64_json",
-                n=1
-            )
-            image_data = response.data[0].b64_json
-        
-        return jsonify({'image': image_data, 'prompt': image_prompt})
+        return image_response(png, dict(metadata), options)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except TimeoutError as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         logger.error(f"Error generating image: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-def generate_response(prompt, model, is_kids_mode=False, language='', ai_role='DM'):
+def produce_image(data, alias, negative_prompt, profile, progressive, use_cache, timings, tenant=None, deadline=None):
+    # Expands and renders the image of a /generate-image request; returns the
+    # PNG and its metadata
+    image_prompt = image_prompts.build_image_prompt(upstream, data, use_cache=use_cache, timings=timings)
+    seed = image_seed(data, image_prompt, negative_prompt)
+    rendered_profile = 'preview' if progressive else profile
+    start = time.perf_counter()
+    png = render_image(image_prompt, negative_prompt, rendered_profile, seed, use_cache=use_cache, tenant=tenant, deadline=deadline)
+    timings['render_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    metadata = {'prompt': image_prompt, 'profile': rendered_profile, 'seed': seed, 'timings': timings}
+
+    if not progressive:
+        image_store.put_alias(alias, image_key(image_prompt, negative_prompt, profile, seed), prompt=image_prompt, seed=seed)
+        return png, metadata
+
+    # The preview is returned right away; the refined image is published
+    # under jobId (GET /jobs/<jobId>)
+    refine = {'prompt': image_prompt, 'negative_prompt': negative_prompt, 'profile': profile, 'seed': seed,
+              'preview': png, 'alias': alias, 'noCache': not use_cache, 'tenant': tenant}
+    try:
+        metadata['jobId'] = image_jobs.submit('image_refine', refine).id
+    except QueueFull:
+        logger.warning("Image job queue is full, returning the preview only")
+        metadata['jobId'] = None
+    return png, metadata
+
+def render_job_image(job, image_prompt, negative_prompt, profile, seed, timings, timing_key, init_image=None):
+    job.set_progress(0, IMAGE_PROFILES[profile]['steps'])
+    start = time.perf_counter()
     try:
-        system_message = (
-            "You are an adaptive RPG AI capable of playing both as a Dungeon Master and as a Player character. "
-            "Respond appropriately based on the role specified in the prompt. "
-            "Keep your responses concise and relevant to the game context."
+        png = render_image(image_prompt, negative_prompt, profile, seed, job.set_progress, lambda: job.cancel_requested,
+                           init_image, use_cache=not job.payload.get('noCache'), tenant=job.payload.get('tenant'))
+    except CancelledError:
+        raise JobCancelled()
+    timings[timing_key] = round((time.perf_counter() - start) * 1000, 3)
+    job.check_cancelled()
+    return png
+
+def run_image_job(job):
+    data = job.payload
+    negative_prompt = data.get('negative_prompt', 'blurry, bad art, poor quality')
+    profile = image_profile(data)
+    use_cache = not data.get('noCache')
+    timings = {}
+
+    start = time.perf_counter()
+    alias = image_alias(data, negative_prompt, profile)
+    cached = cached_image(alias) if use_cache else None
+    if cached:
+        png, metadata = cached
+        timings['image_cache_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        return dict(metadata, image=base64.b64encode(png).decode('utf-8'), profile=profile, timings=timings)
+
+    image_prompt = image_prompts.build_image_prompt(upstream, data, use_cache=use_cache, timings=timings)
+    seed = image_seed(data, image_prompt, negative_prompt)
+    job.check_cancelled()
+
+    preview = None
+    if is_progressive(data, profile):
+        # Clients polling the job get the preview while it is refined
+        preview = render_job_image(job, image_prompt, negative_prompt, 'preview', seed, timings, 'preview_ms')
+        job.set_partial_result({'image': base64.b64encode(preview).decode('utf-8'), 'prompt': image_prompt, 'profile': 'preview', 'seed': seed})
+
+    png = render_job_image(job, image_prompt, negative_prompt, profile, seed, timings, 'render_ms', preview)
+    image_store.put_alias(alias, image_key(image_prompt, negative_prompt, profile, seed, preview), prompt=image_prompt, seed=seed)
+    return {'image': base64.b64encode(png).decode('utf-8'), 'prompt': image_prompt, 'profile': profile, 'seed': seed, 'timings': timings}
+
+def run_image_refine_job(job):
+    # Second phase of a progressive /generate-image request
+    data = job.payload
+    timings = {}
+    job.set_partial_result({'image': base64.b64encode(data['preview']).decode('utf-8'), 'prompt': data['prompt'], 'profile': 'preview', 'seed': data['seed']})
+    png = render_job_image(job, data['prompt'], data['negative_prompt'], data['profile'], data['seed'], timings, 'render_ms', data['preview'])
+    image_store.put_alias(data['alias'], image_key(data['prompt'], data['negative_prompt'], data['profile'], data['seed'], data['preview']),
+                          prompt=data['prompt'], seed=data['seed'])
+    return {'image': base64.b64encode(png).decode('utf-8'), 'prompt': data['prompt'], 'profile': data['profile'], 'seed': data['seed'], 'timings': timings}
+
+def animation_profile(data):
+    profile = data.get('profile') or ANIMATION_DEFAULT_PROFILE
+    if profile not in ANIMATION_PROFILES:
+        raise ValueError(f"Unknown animation profile: {profile} (expected one of {', '.join(ANIMATION_PROFILES)})")
+    return profile
+
+def run_animation_job(job):
+    # Every frame is published on its own (job.add_frame) as soon as it is
+    # decoded, so clients can show the animation while it is being rendered
+    data = job.payload
+    negative_prompt = data.get('negative_prompt', 'blurry, bad art, poor quality')
+    profile = animation_profile(data)
+    settings = ANIMATION_PROFILES[profile]
+    timings = {}
+
+    image_prompt = image_prompts.build_image_prompt(upstream, data, use_cache=not data.get('noCache'), timings=timings)
+    seed = image_seed(data, image_prompt, negative_prompt)
+    job.check_cancelled()
+
+    metadata = {'prompt': image_prompt, 'profile': profile, 'seed': seed, 'fps': settings['fps'], 'mimetype': 'image/jpeg'}
+    job.set_partial_result(metadata)
+
+    def on_step(step, total=None, frame=None):
+        if frame is not None:
+            job.add_frame(frame)
+        job.set_progress(step, total)
+
+    job.set_progress(0, settings['steps'] + settings['frames'])
+    start = time.perf_counter()
+    try:
+        inference.animate(
+            image_prompt,
+            negative_prompt,
+            width=settings['width'],
+            height=settings['height'],
+            frames=settings['frames'],
+            steps=settings['steps'],
+            guidance_scale=settings['guidance_scale'],
+            seed=seed,
+            vae_slicing=settings['vae_slicing'],
+            on_step=on_step,
+            cancelled=lambda: job.cancel_requested,
+            tenant=data.get('tenant'),
+            deadline=gpu_deadline('animation')
         )
+    except CancelledError:
+        raise JobCancelled()
+    timings['render_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    return dict(metadata, frame_count=len(job.frames), timings=timings)
 
-        if ai_role == 'DM' and model != 'llama':
-            system_message += (
-                "Respond in JSON format, with the following keys: 'role', 'content', 'options' (for multiple choice questions or actions)."
-                "e.g. { 'role': 'Dungeon Master', 'content': 'Story content', 'options': ['Option 1', 'Option 2', ...] }."
-            )
-
-        if is_kids_mode:
-            system_message += (
-                " As this is a game for children, ensure all content is family-friendly and appropriate for young audiences. "
-                "Avoid any scary, violent, or adult themes. Focus on positive, educational, and fun experiences. "
-                "Use simple language and explain any complex concepts. Encourage teamwork, problem-solving, and creativity. "
-                "Make sure all characters and situations are suitable for children."
-                "Keep the game light-hearted and engaging, with a focus on exploration and discovery."
-                "Use positive reinforcement and encouragement to motivate players."
-                "Use short sentences and simple words to make the game easy to understand."
-                "Encourage players to use their imagination and creativity to solve problems."
-                "Use icons when it makes sense to help players understand the game."
-            )        
-
-        if language:
-            system_message += f"\nRespond in language ({language})."
-
-        if model == 'gemini-pro':
-            # Gemini-specific processing
-            gemini_model = GenerativeModel('gemini-pro')
-            
-            response = gemini_model.generate_content([system_message, prompt])
-            generated_text = response.text
-        else:
-            # Existing OpenAI processing
-            openai_model = MODEL_MAPPING.get(model, 'gpt-4o-mini')
-
-            # Send the prompt to the AI model
-            response = openai_client.chat.completions.create(
-                model=openai_model,
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=500,
-                temperature=0.7
-            )
-            
-            generated_text = response.choices[0].message.content.strip()
-            
-            if is_kids_mode:
-                # Additional safety check for kids mode content
-                safety_check = openai_client.chat.completions.create(
-                    model=openai_model,
-                    messages=[
-                        {"role": "system", "content": "You are a content moderator for children's content. Evaluate the following text and determine if it's suitable for children. If it's not suitable, provide a modified, child-friendly version."},
-                        {"role": "user", "content": f"Text: {generated_text}\n\nIs this text suitable for children? If not, provide a modified version:"}
-                    ],
-                    max_tokens=500,
-                    temperature=0.5
-                )
-                
-                safety_response = safety_check.choices[0].message.content.strip()
-                if "not suitable" in safety_response.lower():
-                    generated_text = safety_response.split("Modified version:")[-1].strip()
+image_jobs.register('image', run_image_job)
+image_jobs.register('image_refine', run_image_refine_job)
+image_jobs.register('animation', run_animation_job)
+
+@app.route('/jobs/image', methods=['POST'])
+def submit_image_job():
+    data = request.json or {}
+    if 'contextPrompt' not in data or 'currentMessage' not in data:
+        return jsonify({'error': 'contextPrompt and currentMessage are required'}), 400
+    try:
+        image_profile(data)
+        if data.get('seed') is not None:
+            int(data['seed'])
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        job = image_jobs.submit('image', dict(data, noCache=bypass_cache(data), tenant=request_tenant()))
+    except QueueFull:
+        return jsonify({'error': 'Too many queued image jobs, try again later'}), 429
+
+    return jsonify(job.to_dict()), 202
+
+@app.route('/jobs/animation', methods=['POST'])
+def submit_animation_job():
+    data = request.json or {}
+    if not USE_LOCAL_MODELS:
+        return jsonify({'error': 'Animations need the local models'}), 400
+    if 'contextPrompt' not in data or 'currentMessage' not in data:
+        return jsonify({'error': 'contextPrompt and currentMessage are required'}), 400
+    try:
+        animation_profile(data)
+        if data.get('seed') is not None:
+            int(data['seed'])
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        job = image_jobs.submit('animation', dict(data, noCache=bypass_cache(data), tenant=request_tenant()))
+    except QueueFull:
+        return jsonify({'error': 'Too many queued image jobs, try again later'}), 429
+
+    return jsonify(job.to_dict()), 202
+
+@app.route('/jobs/<job_id>/frames', methods=['GET'])
+def stream_job_frames(job_id):
+    # Server-sent events of an animation job: 'frame' ({index, image}) for
+    # every frame as soon as it is decoded, 'progress', then 'done' (the
+    # result) or 'error'. Each look at the job only fetches the frames not
+    # sent yet.
+    if image_jobs.snapshot(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def events():
+        sent = 0
+        progress = None
+        while True:
+            # The status first: once it is final, the frames fetched after it are all of them
+            job = image_jobs.snapshot(job_id)
+            frames = image_jobs.frames(job_id, sent) if job is not None else None
+            if frames is None:
+                yield sse_event('error', {'error': 'Job not found'})
+                return
+            for frame in frames:
+                yield sse_event('frame', {'index': sent, 'image': base64.b64encode(frame).decode('utf-8')})
+                sent += 1
+            if job.get('progress') and job['progress'] != progress:
+                progress = job['progress']
+                yield sse_event('progress', progress)
+
+            if job['status'] == DONE:
+                yield sse_event('done', dict(job.get('result') or {}, jobId=job_id))
+                return
+            if job['status'] in (FAILED, CANCELLED):
+                yield sse_event('error', {'error': job.get('error') or job['status'], 'status': job['status']})
+                return
+            time.sleep(JOB_STREAM_POLL_INTERVAL)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>/animation', methods=['GET'])
+def get_job_animation(job_id):
+    # The finished animation of a job, encoded in memory as ?format=gif
+    # (default), webp or mp4
+    job = image_jobs.snapshot(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    result = job.get('result')
+    if job['status'] != DONE or not result or not result.get('frame_count'):
+        return jsonify({'error': 'No animation yet', 'status': job.get('status')}), 404
+    try:
+        fmt = animation_format(request.args.get('format'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    key = cache_key('animation', job_id, fmt)
+    cached = animation_cache.get(key)
+    if cached is not None:
+        data = cached[0]
+    else:
+        with metrics.span('animation_encode'):
+            frames = decode_frames(image_jobs.frames(job_id) or [])
+            data = encode_animation(frames, fmt, fps=result.get('fps', 8))
+        animation_cache.put(key, data)
+    return send_file(BytesIO(data), mimetype=animation_mimetype(fmt), download_name=f"{job_id}.{fmt}")
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = image_jobs.snapshot(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/image', methods=['GET'])
+def get_job_image(job_id):
+    # The job's image (the refined result, or the preview while refining) in
+    # the format and response mode negotiated like /generate-image
+    job = image_jobs.snapshot(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    result = job.get('result') or job.get('partial_result')
+    if not result or 'image' not in result:
+        return jsonify({'error': 'No image yet', 'status': job.get('status')}), 404
+    try:
+        options = image_encoding_options({})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    metadata = {name: value for name, value in result.items() if name != 'image'}
+    return image_response(base64.b64decode(result['image']), dict(metadata, jobId=job_id), options)
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = image_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+# Built once per combination of arguments; the same bytes every time keep the
+# providers' prompt caches warm
+@lru_cache(maxsize=256)
+def build_system_message(model, is_kids_mode=False, language='', ai_role='DM'):
+    system_message = (
+        "You are an adaptive RPG AI capable of playing both as a Dungeon Master and as a Player character. "
+        "Respond appropriately based on the role specified in the prompt. "
+        "Keep your responses concise and relevant to the game context."
+    )
+
+    if ai_role == 'DM' and model != 'llama':
+        system_message += (
+            "Respond in JSON format, with the following keys: 'role', 'content', 'options' (for multiple choice questions or actions)."
+            "e.g. { 'role': 'Dungeon Master', 'content': 'Story content', 'options': ['Option 1', 'Option 2', ...] }."
+        )
+
+    if is_kids_mode:
+        system_message += (
+            " As this is a game for children, ensure all content is family-friendly and appropriate for young audiences. "
+            "Avoid any scary, violent, or adult themes. Focus on positive, educational, and fun experiences. "
+            "Use simple language and explain any complex concepts. Encourage teamwork, problem-solving, and creativity. "
+            "Make sure all characters and situations are suitable for children."
+            "Keep the game light-hearted and engaging, with a focus on exploration and discovery."
+            "Use positive reinforcement and encouragement to motivate players."
+            "Use short sentences and simple words to make the game easy to understand."
+            "Encourage players to use their imagination and creativity to solve problems."
+            "Use icons when it makes sense to help players understand the game."
+        )        
+
+    if language:
+        system_message += f"\nRespond in language ({language})."
+
+    return system_message
+
+def moderate_kids_text(generated_text, model='gpt4o-mini'):
+    # Additional safety check for kids mode content
+    safety_response = upstream.chat(
+        model,
+        [
+            {"role": "system", "content": "You are a content moderator for children's content. Evaluate the following text and determine if it's suitable for children. If it's not suitable, provide a modified, child-friendly version."},
+            {"role": "user", "content": f"Text: {generated_text}\n\nIs this text suitable for children? If not, provide a modified version:"}
+        ],
+        max_tokens=500,
+        temperature=0.5
+    ).strip()
+
+    if "not suitable" in safety_response.lower():
+        return safety_response.split("Modified version:")[-1].strip()
+    return generated_text
+
+# Kids mode text goes through the local pre-filter first and only reaches the
+# LLM moderator when something is flagged (KIDS_MODERATION_MODE=always
+# moderates everything, as before)
+kids_moderation = ModerationPipeline(
+    moderate_kids_text,
+    always_moderate=os.getenv("KIDS_MODERATION_MODE", "prefilter") == "always"
+)
+
+def summarize_story(summary, turns):
+    # Extends the running summary of a game with the turns that no longer fit
+    # in its /generate prompts
+    return upstream.chat(
+        'gpt4o-mini',
+        [
+            {"role": "system", "content": "You keep the running summary of a role-playing game session. Merge the new turns into the summary. "
+                                          "Keep characters, places, items, open quests and decisions the players made; drop flavour text. "
+                                          "Answer with the updated summary only, in the language of the story."},
+            {"role": "user", "content": f"Summary so far:\n{summary or '(none)'}\n\nNew turns:\n" + '\n'.join(turns)}
+        ],
+        max_tokens=int(os.getenv("STORY_SUMMARY_MAX_TOKENS", "400")),
+        temperature=0.3
+    ).strip()
+
+# Requests with a gameId send at most STORY_TOKEN_BUDGET (estimated) tokens of
+# story; older turns are replaced by a rolling summary of the game. In
+# production mode the summaries and windows are kept by the inference process,
+# so the turns of a game can reach any HTTP worker.
+story_context = StoryContext(
+    summarize_story,
+    token_budget=int(os.getenv("STORY_TOKEN_BUDGET", "2000")),
+    max_games=int(os.getenv("STORY_CONTEXT_MAX_GAMES", "1024")),
+    ttl=int(os.getenv("STORY_CONTEXT_TTL", str(24 * 3600))),
+    board=inference.story_board if INFERENCE_ADDRESS else None
+)
+
+def chat_messages(prompt, model, is_kids_mode=False, language='', ai_role='DM', game_id=None, context=None):
+    # context, when given, is filled with the tokens sent and saved
+    system_message = build_system_message(model, bool(is_kids_mode), language, ai_role)
+    if not game_id:
+        return [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": prompt}
+        ]
+    messages, stats = story_context.compact(game_id, system_message, prompt)
+    if context is not None:
+        context.update(stats)
+    return messages
+
+def generate_response(prompt, model, is_kids_mode=False, language='', ai_role='DM', timings=None, game_id=None, context=None):
+    # timings, when given, is filled with the duration of each stage in ms
+    timings = {} if timings is None else timings
+    try:
+        messages = chat_messages(prompt, model, is_kids_mode, language, ai_role, game_id, context)
+        start = time.perf_counter()
+
+        # Send the prompt to the AI model (failing over to the other
+        # providers in MODEL_MAPPING if this one is unavailable)
+        generated_text = upstream.chat(
+            model,
+            messages,
+            max_tokens=500,
+            temperature=0.7
+        ).strip()
+        timings['generation_ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+        # Gemini responses were never moderated, keep it that way
+        if is_kids_mode and model != 'gemini-pro':
+            result = kids_moderation.check(generated_text, language, model=model)
+            generated_text = result.text
+            timings.update(result.timings)
 
         return generated_text
     except Exception as e:
         logger.error(f"Error generating {model} response: {str(e)}")
         raise
 
+def stream_response(prompt, model, is_kids_mode=False, language='', ai_role='DM', timings=None, game_id=None, context=None):
+    # Same as generate_response, but yields ('token', text) as the provider
+    # produces them and finishes with ('done', generated_text). In kids mode
+    # the text is yielded a sentence at a time, only once moderation passed it
+    # (see ModerationPipeline.stream).
+    timings = {} if timings is None else timings
+    messages = chat_messages(prompt, model, is_kids_mode, language, ai_role, game_id, context)
+    start = time.perf_counter()
+
+    def provider_tokens():
+        for token in upstream.chat_stream(model, messages, max_tokens=500, temperature=0.7):
+            if 'first_token_ms' not in timings:
+                timings['first_token_ms'] = round((time.perf_counter() - start) * 1000, 3)
+            yield token
+        timings['generation_ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+    tokens = provider_tokens()
+    # Gemini responses were never moderated, keep it that way
+    if is_kids_mode and model != 'gemini-pro':
+        tokens = kids_moderation.stream(tokens, language, timings, model=model)
+    parts = []
+    for text in tokens:
+        parts.append(text)
+        yield 'token', text
+
+    yield 'done', ''.join(parts).strip()
+
+def parse_dm_response(generated_text):
+    # Best effort parse of the DM JSON ({role, content, options}); plain text
+    # responses become the content
+    text = generated_text.strip()
+    if text.startswith("```"):
+        text = text.split("```")[1]
+        if text.startswith("json"):
+            text = text[len("json"):]
+    try:
+        parsed = json.loads(text)
+        if isinstance(parsed, dict):
+            return {
+                'role': parsed.get('role'),
+                'content': parsed.get('content', ''),
+                'options': parsed.get('options') or []
+            }
+    except json.JSONDecodeError:
+        pass
+    return {'role': None, 'content': generated_text, 'options': []}
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
 @app.route('/generate', methods=['POST'])
 def generate_text():
     data = request.json
@@ -389,14 +1210,52 @@ def generate_text():
     is_kids_mode = data.get('isKidsMode', False)  # Get the kids mode status
     language = data.get('language', '')  
     ai_role = data.get('aiRole', 'DM')
+    # Optional: with a game id, long stories are compacted (see StoryContext)
+    game_id = data.get('gameId')
+    stream = str(request.args.get('stream', data.get('stream', ''))).lower() in ('1', 'true')
     try:
         logger.info(f"Generating text with model: {model}, Kids Mode: {is_kids_mode}, Language: {language}, AI Role: {ai_role}")
-        if model in MODEL_MAPPING:
-            generated_text = generate_response(prompt, model, is_kids_mode, language, ai_role)
-        else:
+        if model not in MODEL_MAPPING:
             return jsonify({'error': 'Invalid model specified'}), 400
-        
-        return jsonify({'generated_text': generated_text})
+
+        if stream:
+            def events():
+                timings = {}
+                context = {}
+                try:
+                    for event, text in stream_response(prompt, model, is_kids_mode, language, ai_role, timings, game_id, context):
+                        if event == 'token':
+                            yield sse_event('token', {'text': text})
+                        else:
+                            done = {'generated_text': text, 'message': parse_dm_response(text), 'timings': timings}
+                            if game_id:
+                                done['context'] = context
+                            yield sse_event('done', done)
+                except Exception as e:
+                    logger.error(f"Error in streaming generate_text: {str(e)}")
+                    yield sse_event('error', {'error': str(e)})
+
+            return Response(stream_with_context(events()), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+        def generate(flight):
+            timings = {}
+            context = {}
+            generated_text = generate_response(prompt, model, is_kids_mode, language, ai_role, timings, game_id, context)
+            return generated_text, timings, context
+
+        generated_text, timings, context = generate_flight.do(
+            cache_key('generate', model, bool(is_kids_mode), language, ai_role, game_id, prompt),
+            generate,
+            timeout=COALESCE_TIMEOUT
+        )
+
+        response = {'generated_text': generated_text, 'timings': timings}
+        if game_id:
+            response['context'] = context
+        return jsonify(response)
+    except TimeoutError as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         logger.error(f"Error in generate_text: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -410,10 +1269,85 @@ def get_models():
     logger.info("Fetching available models")
     return jsonify({'models': list(MODEL_MAPPING.keys())})
 
+@app.route('/cache-stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify({
+        'tts': tts_cache.stats(),
+        'image_prompts': image_prompts.cache_stats(),
+        'image_batches': inference.image_batch_stats(),
+        'images': image_store.stats(),
+        'story_context': story_context.stats(),
+        'coalescing': dict(
+            inference.coalescing_stats(),
+            tts=tts_flight.stats(),
+            generate_image=image_flight.stats(),
+            generate=generate_flight.stats(),
+            image_prompt=image_prompts.prompt_flight.stats()
+        )
+    })
+
+@app.route('/scheduler-stats', methods=['GET'])
+def get_scheduler_stats():
+    return jsonify(inference.scheduler_stats())
+
+@app.route('/memory-stats', methods=['GET'])
+def get_memory_stats():
+    return jsonify(inference.memory_stats())
+
+@app.route('/moderation-stats', methods=['GET'])
+def get_moderation_stats():
+    return jsonify({'text': kids_moderation.stats(), 'image_prompts': image_prompts.moderation_stats()})
+
+@app.route('/upstream-stats', methods=['GET'])
+def get_upstream_stats():
+    return jsonify(upstream.stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus text format. In production mode the inference process
+    # returns the sum over itself and every HTTP worker.
+    snapshot = None
+    if INFERENCE_ADDRESS:
+        try:
+            inference.metrics.push(METRICS_SOURCE, metrics.REGISTRY.snapshot())
+            snapshot = inference.metrics.snapshot()
+        except Exception as e:
+            logger.warning(f"Serving this worker's metrics only: {str(e)}")
+    if snapshot is None:
+        snapshot = metrics.REGISTRY.snapshot()
+    return Response(metrics.render_prometheus(snapshot), mimetype='text/plain; version=0.0.4')
+
+# Names the model runs are captured under (inference.lease / animation_lease)
+PROFILED_MODELS = ('whisper', 'sdxl', 'xtts', 'animation')
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def torch_profile():
+    # POST {"model": "sdxl"} records the next SDXL run with the torch profiler
+    # (TORCH_PROFILER=1 only); GET lists what is armed and the captured traces
+    try:
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            model = data.get('model') or request.args.get('model')
+            if model not in PROFILED_MODELS:
+                return jsonify({'error': f"model must be one of {', '.join(PROFILED_MODELS)}"}), 400
+            return jsonify(inference.profiler.arm(model, g.trace.trace_id))
+        return jsonify(inference.profiler.stats())
+    except PermissionError as e:
+        return jsonify({'error': str(e)}), 403
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({'status': 'healthy'}), 200
+    # ?model=whisper reports 503 until that model is ready to serve traffic
+    model_name = request.args.get('model')
+    try:
+        status = inference.model_status()
+        ready = not model_name or inference.is_ready(model_name)
+    except ConnectionError as e:
+        return jsonify({'status': 'unavailable', 'error': str(e)}), 503
+    if not ready:
+        return jsonify({'status': 'loading', 'models': status}), 503
+    return jsonify({'status': 'healthy', 'models': status}), 200
 
 if __name__ == '__main__':
     logger.info("Starting the Flask app...")
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=int(os.getenv("PORT", "5000")))
\ No newline at end of file
@@ -0,0 +1,45 @@
+from io import BytesIO
+
+import torch
+import torchaudio
+
+WHISPER_SAMPLE_RATE = 16000
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def read_upload(stream, max_bytes, chunk_size=64 * 1024):
+    # Reads a request body in chunks into memory, stopping as soon as it goes
+    # past max_bytes instead of buffering an arbitrarily large upload
+    buffer = BytesIO()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buffer.write(chunk)
+        if buffer.tell() > max_bytes:
+            raise UploadTooLarge(f"Audio upload is larger than {max_bytes} bytes")
+    return buffer.getvalue()
+
+
+def decode_audio(data):
+    # Decodes WAV/WebM/OGG/MP3 bytes without touching the disk; returns a
+    # (channels, samples) float tensor and its sample rate
+    return torchaudio.load(BytesIO(data))
+
+
+def to_mono(waveform):
+    # Multi-channel uploads are averaged instead of squeezed
+    if waveform.dim() > 1 and waveform.shape[0] > 1:
+        return waveform.mean(dim=0)
+    return waveform.reshape(-1)
+
+
+def to_whisper_input(waveform, sample_rate):
+    # Mono float32 samples at the 16 kHz Whisper expects, resampled once
+    waveform = to_mono(waveform)
+    if sample_rate != WHISPER_SAMPLE_RATE:
+        waveform = torchaudio.functional.resample(waveform, sample_rate, WHISPER_SAMPLE_RATE)
+    return waveform.to(torch.float32).numpy()
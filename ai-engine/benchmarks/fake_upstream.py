@@ -0,0 +1,210 @@
+# Fake OpenAI and Gemini APIs for the load test, with configurable latency.
+#
+# Serves just enough of both REST APIs for the ai-engine: chat completions
+# (plain and streamed), speech, and Gemini generateContent /
+# streamGenerateContent. Point the ai-engine at it with
+#
+#   OPENAI_BASE_URL=http://127.0.0.1:8400/v1 GEMINI_API_ENDPOINT=http://127.0.0.1:8400
+#
+#   python benchmarks/fake_upstream.py --port 8400 --latency-ms 400 --tokens-per-second 60
+import argparse
+import json
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DM_REPLY = {
+    'role': 'Dungeon Master',
+    'content': 'The torchlight flickers as the party steps into the vaulted hall. Somewhere ahead, water drips onto '
+               'stone, and a faint melody drifts from behind a door carved with running wolves.',
+    'options': ['Open the carved door', 'Follow the sound of water', 'Search the hall for traps']
+}
+IMAGE_PROMPT = 'A vaulted stone hall lit by torches, a carved wooden door with running wolves, adventurers exploring'
+
+
+class FakeUpstream:
+    # latency_ms (+- jitter_ms) is the time to the first byte; streamed
+    # replies then send tokens_per_second. error_rate is the share of
+    # requests answered with a 503, to exercise the retries and the breaker.
+
+    def __init__(self, latency_ms=300, jitter_ms=50, tokens_per_second=50, error_rate=0.0, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def wait(self):
+        with self._lock:
+            delay = self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)
+            fail = self._random.random() < self.error_rate
+            self.requests += 1
+            self.errors += int(fail)
+        time.sleep(max(0.0, delay) / 1000)
+        return fail
+
+    def token_delay(self):
+        return 1.0 / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    @staticmethod
+    def reply_text(messages):
+        # DM turns get the JSON the system prompt asks for; moderation and
+        # prompt expansion get plain text
+        text = ' '.join(messages)
+        if "'role', 'content', 'options'" in text:
+            return json.dumps(DM_REPLY)
+        if 'suitable for children' in text:
+            return 'The text is suitable for children.'
+        if 'image' in text.lower() or 'prompt' in text.lower():
+            return IMAGE_PROMPT
+        return DM_REPLY['content']
+
+    @staticmethod
+    def tokens(text):
+        words = text.split(' ')
+        return [word + (' ' if index < len(words) - 1 else '') for index, word in enumerate(words)]
+
+    def stats(self):
+        return {'requests': self.requests, 'errors': self.errors}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    upstream = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+        try:
+            return json.loads(data or b'{}')
+        except ValueError:
+            return {}
+
+    def _send(self, status, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def _chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def do_POST(self):
+        body = self._body()
+        path = self.path.split('?')[0]
+        if self.upstream.wait():
+            return self._send(503, {'error': {'message': 'Fake upstream overloaded', 'code': 503}})
+
+        if path.endswith('/chat/completions'):
+            return self._chat_completion(body)
+        if path.endswith('/audio/speech'):
+            return self._speech(body)
+        if ':generateContent' in path or ':streamGenerateContent' in path:
+            return self._gemini(body, stream=':streamGenerateContent' in path)
+        self._send(404, {'error': {'message': f"Not faked: {path}"}})
+
+    def _chat_completion(self, body):
+        text = self.upstream.reply_text([str(message.get('content', '')) for message in body.get('messages', [])])
+        model = body.get('model', 'gpt-4o-mini')
+        if not body.get('stream'):
+            return self._send(200, {
+                'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+            })
+
+        self._start_stream('text/event-stream')
+        for token in self.upstream.tokens(text):
+            chunk = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                     'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]}
+            self._chunk(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            time.sleep(self.upstream.token_delay())
+        self._chunk(b'data: [DONE]\n\n')
+        self._end_stream()
+
+    def _speech(self, body):
+        # Silence, about as long as the speech would be (24 kHz, 16-bit mono)
+        pcm = b'\x00\x00' * int(24000 * 0.06 * len(body.get('input', '')))
+        if body.get('response_format') == 'pcm':
+            return self._send(200, pcm, 'audio/pcm')
+        header = b'RIFF' + struct.pack('<I', 36 + len(pcm)) + b'WAVEfmt ' + struct.pack('<IHHIIHH', 16, 1, 1, 24000, 48000, 2, 16)
+        self._send(200, header + b'data' + struct.pack('<I', len(pcm)) + pcm, 'audio/wav')
+
+    def _gemini(self, body, stream):
+        parts = [part.get('text', '') for content in body.get('contents', []) for part in content.get('parts', [])]
+        text = self.upstream.reply_text(parts)
+
+        def candidate(chunk, finished):
+            reply = {'content': {'parts': [{'text': chunk}], 'role': 'model'}, 'index': 0}
+            if finished:
+                reply['finishReason'] = 'STOP'
+            return {'candidates': [reply]}
+
+        if not stream:
+            return self._send(200, candidate(text, True))
+
+        # The REST transport reads a streamed JSON array
+        self._start_stream('application/json')
+        tokens = self.upstream.tokens(text)
+        for index, token in enumerate(tokens):
+            prefix = '[' if index == 0 else ','
+            self._chunk((prefix + json.dumps(candidate(token, index == len(tokens) - 1)) + '\r\n').encode('utf-8'))
+            time.sleep(self.upstream.token_delay())
+        self._chunk(b']')
+        self._end_stream()
+
+
+def serve(upstream, host='127.0.0.1', port=0):
+    # Starts the fake APIs on a daemon thread; returns the server (its
+    # server_address has the port that was picked)
+    handler = type('FakeUpstreamHandler', (Handler,), {'upstream': upstream})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-upstream', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8400)
+    parser.add_argument('--latency-ms', type=float, default=300)
+    parser.add_argument('--jitter-ms', type=float, default=50)
+    parser.add_argument('--tokens-per-second', type=float, default=50)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    upstream = FakeUpstream(args.latency_ms, args.jitter_ms, args.tokens_per_second, args.error_rate)
+    server = serve(upstream, args.host, args.port)
+    print(json.dumps({'listening': f"http://{args.host}:{server.server_address[1]}"}))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print(json.dumps(upstream.stats()))
+
+
+if __name__ == '__main__':
+    main()
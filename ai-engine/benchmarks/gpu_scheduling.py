@@ -0,0 +1,140 @@
+# Benchmark for the GPU scheduler, on CPU with stub workloads.
+#
+# A stand-in GPU runs one kernel at a time (a lock held for the kernel's
+# duration). Transcriptions, utterances and 30-step images are issued by a
+# few games: one busy game keeps several images in flight, the others talk
+# (STT + TTS) and ask for an image now and then. Each model run goes through
+# GpuScheduler.run(), images call checkpoint() between steps, exactly like
+# the batchers do. Reports per-model latency and queue time, images finished
+# per game, preemptions and deadline drops, with the scheduler off (models
+# interleave kernel by kernel, as without it) and on.
+#
+#   python benchmarks/gpu_scheduling.py --seconds 20
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from gpu_scheduler import GpuScheduler, DeadlineExceeded
+
+
+class StubGpu:
+    # Kernels of concurrent callers queue up one after the other
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def kernel(self, ms):
+        with self._lock:
+            time.sleep(ms / 1000)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))], 1)
+
+
+class Workload:
+    def __init__(self, args, scheduler):
+        self.args = args
+        self.scheduler = scheduler
+        self.gpu = StubGpu()
+        self.results = []
+        self._lock = threading.Lock()
+
+    def _record(self, kind, tenant, start, status):
+        with self._lock:
+            self.results.append({'kind': kind, 'tenant': tenant, 'status': status, 'ms': (time.perf_counter() - start) * 1000})
+
+    def _run(self, kind, tenant, kernels, kernel_ms, deadline_s, preemptible=False):
+        start = time.perf_counter()
+        try:
+            with self.scheduler.run(kind, [tenant], time.time() + deadline_s if deadline_s else None):
+                for _ in range(kernels):
+                    self.gpu.kernel(kernel_ms)
+                    if preemptible:
+                        self.scheduler.checkpoint()
+            self._record(kind, tenant, start, 'ok')
+        except DeadlineExceeded:
+            self._record(kind, tenant, start, 'dropped')
+
+    def stt(self, tenant):
+        self._run('whisper', tenant, 4, self.args.stt_ms / 4, self.args.stt_deadline)
+
+    def tts(self, tenant):
+        self._run('xtts', tenant, 8, self.args.tts_ms / 8, self.args.tts_deadline)
+
+    def image(self, tenant):
+        self._run('sdxl', tenant, self.args.steps, self.args.step_ms, self.args.image_deadline, preemptible=True)
+
+
+def busy_game(workload, tenant, stop):
+    while not stop.is_set():
+        workload.image(tenant)
+
+
+def talking_game(workload, tenant, stop, seed):
+    rng = random.Random(seed)
+    while not stop.is_set():
+        time.sleep(rng.expovariate(1 / workload.args.think_s))
+        workload.stt(tenant)
+        workload.tts(tenant)
+        if rng.random() < workload.args.image_share:
+            workload.image(tenant)
+
+
+def run(args, enabled):
+    scheduler = GpuScheduler(enabled=enabled)
+    workload = Workload(args, scheduler)
+    stop = threading.Event()
+    threads = [threading.Thread(target=busy_game, args=(workload, 'busy', stop)) for _ in range(args.busy_images)]
+    threads += [threading.Thread(target=talking_game, args=(workload, f"game-{i}", stop, i)) for i in range(args.games)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    report = {'scheduler': 'on' if enabled else 'off'}
+    for kind in ('whisper', 'xtts', 'sdxl'):
+        done = [r for r in workload.results if r['kind'] == kind]
+        ok = [r['ms'] for r in done if r['status'] == 'ok']
+        report[kind] = {'ok': len(ok), 'dropped': len(done) - len(ok), 'p50_ms': percentile(ok, 50),
+                        'p95_ms': percentile(ok, 95), 'max_ms': round(max(ok), 1) if ok else None}
+    report['images_per_game'] = {}
+    for result in workload.results:
+        if result['kind'] == 'sdxl' and result['status'] == 'ok':
+            report['images_per_game'][result['tenant']] = report['images_per_game'].get(result['tenant'], 0) + 1
+    report['preemptions'] = scheduler.preemptions
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--games', type=int, default=3, help='games talking to the DM')
+    parser.add_argument('--busy-images', type=int, default=3, help='images the busy game keeps in flight')
+    parser.add_argument('--think-s', type=float, default=1.0, help='mean pause between two turns of a talking game')
+    parser.add_argument('--image-share', type=float, default=0.3, help='share of turns that also ask for an image')
+    parser.add_argument('--stt-ms', type=float, default=120)
+    parser.add_argument('--tts-ms', type=float, default=300)
+    parser.add_argument('--steps', type=int, default=30)
+    parser.add_argument('--step-ms', type=float, default=40)
+    parser.add_argument('--stt-deadline', type=float, default=5)
+    parser.add_argument('--tts-deadline', type=float, default=10)
+    parser.add_argument('--image-deadline', type=float, default=60)
+    parser.add_argument('--mode', choices=('off', 'on', 'both'), default='both')
+    args = parser.parse_args()
+
+    modes = {'off': [False], 'on': [True], 'both': [False, True]}[args.mode]
+    print(json.dumps([run(args, enabled) for enabled in modes], indent=2))
+
+
+if __name__ == '__main__':
+    main()
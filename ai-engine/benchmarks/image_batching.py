@@ -0,0 +1,155 @@
+# Benchmark for the SDXL batch scheduler and prompt-embedding cache.
+#
+# Uses a tiny randomly initialised stand-in with the same interface as the
+# diffusers SDXL pipeline (encode_prompt() and __call__ with prompt or
+# prompt_embeds), so it runs on CPU in a few seconds and needs no downloads.
+# Reports images/minute for the batched scheduler and for the previous
+# one-pipe-call-per-image path, which re-encodes every prompt.
+#
+#   python benchmarks/image_batching.py --requests 16 --concurrency 1 2 4
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from image_batcher import ImageBatcher
+
+MAX_TOKENS = 77
+STYLE_SUFFIX = 'in a vibrant, colorful, and whimsical cartoon style, suitable for children'
+NEGATIVE_PROMPT = 'blurry, bad art, poor quality'
+
+
+class StandInConfig:
+    force_zeros_for_empty_prompt = True
+
+
+class StandInOutput:
+    def __init__(self, images):
+        self.images = images
+
+
+class StandInPipeline:
+    # Text encoder, denoiser and decoder small enough for CPU, with the
+    # SDXL call signature used by ImageBatcher and by the unbatched path
+
+    def __init__(self, width=1024):
+        torch.manual_seed(0)
+        self.config = StandInConfig()
+        self.device = torch.device('cpu')
+        self.scheduler = None
+        self.embedding = torch.nn.Embedding(4096, width // 4)
+        self.text_encoder = torch.nn.TransformerEncoder(
+            torch.nn.TransformerEncoderLayer(width // 4, 4, width // 2, batch_first=True), num_layers=4
+        ).eval()
+        self.unet = torch.nn.Sequential(
+            torch.nn.Conv2d(4, 64, 3, padding=1), torch.nn.SiLU(),
+            torch.nn.Conv2d(64, 64, 3, padding=1), torch.nn.SiLU(),
+            torch.nn.Conv2d(64, 4, 3, padding=1)
+        ).eval()
+        self.conditioning = torch.nn.Linear(width // 4, 4)
+        self.decoder = torch.nn.ConvTranspose2d(4, 3, 8, stride=8).eval()
+        self._interrupt = False
+
+    def _tokens(self, text):
+        ids = [hash(word) % 4096 for word in text.split()][:MAX_TOKENS]
+        return torch.tensor([ids + [0] * (MAX_TOKENS - len(ids))])
+
+    def _encode(self, text):
+        hidden = self.text_encoder(self.embedding(self._tokens(text)))
+        return hidden, hidden.mean(dim=1)
+
+    def encode_prompt(self, prompt, device=None, num_images_per_prompt=1, do_classifier_free_guidance=True, negative_prompt=None):
+        with torch.no_grad():
+            prompt_embeds, pooled = self._encode(prompt)
+            if not do_classifier_free_guidance:
+                return prompt_embeds, None, pooled, None
+            negative_embeds, negative_pooled = self._encode(negative_prompt or '')
+            return prompt_embeds, negative_embeds, pooled, negative_pooled
+
+    def __call__(self, prompt=None, negative_prompt=None, prompt_embeds=None, negative_prompt_embeds=None,
+                 pooled_prompt_embeds=None, negative_pooled_prompt_embeds=None, num_inference_steps=50,
+                 guidance_scale=7.5, width=1024, height=1024, callback_on_step_end=None):
+        if prompt_embeds is None:
+            prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds = self.encode_prompt(prompt, negative_prompt=negative_prompt)
+
+        self._interrupt = False
+        with torch.no_grad():
+            batch_size = prompt_embeds.shape[0]
+            conditioning = self.conditioning(torch.cat([negative_pooled_prompt_embeds, pooled_prompt_embeds]))[:, :, None, None]
+            latents = torch.randn(batch_size, 4, height // 8, width // 8)
+            for step in range(num_inference_steps):
+                if self._interrupt:
+                    break
+                noise = self.unet(torch.cat([latents, latents]) + conditioning)
+                uncond, cond = noise.chunk(2)
+                latents = latents - 0.1 * (uncond + guidance_scale * (cond - uncond))
+                if callback_on_step_end:
+                    callback_on_step_end(self, step, step, {})
+            pixels = self.decoder(latents).clamp(-1, 1)
+
+        images = ((pixels + 1) * 127.5).to(torch.uint8).permute(0, 2, 3, 1).numpy()
+        return StandInOutput([Image.fromarray(image) for image in images])
+
+
+def prompts(count):
+    scenes = ['a dragon guarding a castle', 'a ship in a storm', 'a market in the desert', 'a forest at night']
+    return [f"{scenes[i % len(scenes)]}, scene {i}, {STYLE_SUFFIX}" for i in range(count)]
+
+
+def run(render, requests, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(render, prompts(requests)))
+    return requests / (time.perf_counter() - start) * 60
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=16)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--max-batch-size', type=int, default=4)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--size', type=int, default=256)
+    args = parser.parse_args()
+
+    torch.set_num_threads(4)
+    pipe = StandInPipeline()
+    settings = dict(width=args.size, height=args.size, steps=args.steps, guidance_scale=7.5)
+
+    # The previous path: one pipe() call per image, serialised on the device
+    device_lock = threading.Lock()
+
+    def unbatched(prompt):
+        with device_lock:
+            return pipe(prompt=prompt, negative_prompt=NEGATIVE_PROMPT, num_inference_steps=args.steps,
+                        guidance_scale=7.5, width=args.size, height=args.size).images[0]
+
+    batcher = ImageBatcher(lambda batch_size, tenants, deadline: nullcontext(pipe), max_batch_size=args.max_batch_size, max_wait_ms=20)
+
+    def batched(prompt):
+        return batcher.generate(prompt, NEGATIVE_PROMPT, **settings)
+
+    # Warm up
+    unbatched('warm up')
+    batched('warm up')
+
+    for concurrency in args.concurrency:
+        result = {
+            'concurrency': concurrency,
+            'unbatched_images_per_min': round(run(unbatched, args.requests, concurrency), 1),
+            'batched_images_per_min': round(run(batched, args.requests, concurrency), 1),
+        }
+        print(json.dumps(result))
+    print(json.dumps({'scheduler': batcher.stats()}))
+
+
+if __name__ == '__main__':
+    main()
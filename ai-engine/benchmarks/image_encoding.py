@@ -0,0 +1,89 @@
+# Benchmark for the /generate-image response encodings.
+#
+# Renders a synthetic illustration-like image (smooth gradients, flat shapes
+# and some texture, roughly what SDXL produces in the cartoon style) and
+# reports bytes on the wire and encode time for the previous base64 PNG in
+# JSON, the raw PNG, WebP/JPEG at a few qualities and thumbnail variants.
+#
+#   python benchmarks/image_encoding.py --size 1024 --repeat 5
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from image_encoding import encode_image, encode_variants
+
+
+def illustration(size):
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:size, 0:size] / size
+    sky = np.stack([80 + 120 * y, 140 + 80 * y, 230 - 60 * y], axis=-1)
+    image = Image.fromarray(sky.astype(np.uint8))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x0, y0 = rng.integers(0, size, 2)
+        radius = int(rng.integers(size // 40, size // 6))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        draw.ellipse([x0 - radius, y0 - radius, x0 + radius, y0 + radius], fill=color, outline=(20, 20, 20), width=3)
+    image = image.filter(ImageFilter.GaussianBlur(1.5))
+    noise = rng.normal(0, 6, (size, size, 3))
+    return Image.fromarray(np.clip(np.asarray(image) + noise, 0, 255).astype(np.uint8))
+
+
+def timed(encode, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = encode()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return data, best
+
+
+def report(name, data, encode_ms, baseline):
+    print(json.dumps({
+        'encoding': name,
+        'bytes': len(data),
+        'vs_base64_json': round(len(data) / baseline, 3),
+        'encode_ms': round(encode_ms, 1)
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--thumbnails', type=int, nargs='+', default=[256, 512])
+    args = parser.parse_args()
+
+    image = illustration(args.size)
+    png, png_ms = timed(lambda: encode_image(image, 'png'), args.repeat)
+
+    # The previous response: the PNG base64-encoded inside a JSON body
+    body, json_ms = timed(lambda: json.dumps({'image': base64.b64encode(png).decode('utf-8')}).encode('utf-8'), args.repeat)
+    baseline = len(body)
+    report('png_base64_json', body, png_ms + json_ms, baseline)
+    report('png_raw', png, png_ms, baseline)
+
+    for quality in (75, 85, 95):
+        data, encode_ms = timed(lambda: encode_variants(png, 'webp', quality)['full'], args.repeat)
+        report(f"webp_q{quality}", data, encode_ms, baseline)
+    data, encode_ms = timed(lambda: encode_variants(png, 'jpeg', 90)['full'], args.repeat)
+    report('jpeg_q90', data, encode_ms, baseline)
+
+    variants, encode_ms = timed(lambda: encode_variants(png, 'webp', 85, args.thumbnails), args.repeat)
+    print(json.dumps({
+        'encoding': 'webp_q85_with_thumbnails',
+        'bytes': {name: len(data) for name, data in variants.items()},
+        'encode_ms': round(encode_ms, 1)
+    }))
+
+
+if __name__ == '__main__':
+    main()
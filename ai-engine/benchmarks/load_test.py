@@ -0,0 +1,444 @@
+# Load test for the ai-engine HTTP endpoints, with stub backends.
+#
+# Boots app.py (or the gunicorn production mode) against the fake OpenAI and
+# Gemini APIs in fake_upstream.py and the tiny random-weight models in
+# stub_models.py, all on CPU, then drives /generate, /tts, /speech-to-text and
+# /generate-image one after the other at the given concurrency (and, with
+# --mixed, all at once). Reports p50/p95/p99 latency, time to first byte,
+# throughput and the peak RSS of the server processes as JSON, together with
+# the commit it ran on. Inputs are deterministic and every run starts from
+# empty caches, so two commits can be compared with --compare:
+#
+#   python benchmarks/load_test.py --requests 64 --concurrency 8 --output before.json
+#   python benchmarks/load_test.py --requests 64 --concurrency 8 --compare before.json
+import argparse
+import io
+import itertools
+import json
+import math
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import numpy as np
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ENGINE_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+from fake_upstream import FakeUpstream, serve
+
+ENDPOINTS = ('generate', 'tts', 'speech-to-text', 'generate-image')
+SCENES = ['the party enters a flooded crypt', 'a dragon lands on the castle wall', 'the merchant reveals a hidden map',
+          'a storm breaks over the harbour', 'the wizard opens a glowing portal', 'wolves circle the campfire']
+
+
+def speech_wav(index, seconds, sample_rate=16000):
+    # A few seconds of speech-like audio: voiced bursts (harmonics with a
+    # moving pitch) separated by short pauses, different for every request
+    # (the warm-up request has index -1; seeds must be non-negative)
+    rng = np.random.default_rng(index % 2**32)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    pitch = 120 + 40 * np.sin(2 * np.pi * 0.7 * t + index)
+    phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 6))
+    envelope = (np.sin(2 * np.pi * 1.5 * t + rng.uniform(0, np.pi)) > -0.3).astype(np.float32)
+    samples = 0.3 * voiced * envelope + 0.01 * rng.standard_normal(len(t))
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes((np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+    return buffer.getvalue()
+
+
+def build_request(endpoint, index, args):
+    # (method, path, httpx request kwargs) for the index-th request
+    scene = f"{SCENES[index % len(SCENES)]} (turn {index})"
+    if endpoint == 'generate':
+        models = args.models
+        return 'POST', '/generate' + ('?stream=1' if args.stream else ''), {'json': {
+            'prompt': f"Player: I look around. Scene: {scene}.",
+            'model': models[index % len(models)],
+            'language': 'en'
+        }}
+    if endpoint == 'tts':
+        return 'POST', '/tts' + ('?stream=1' if args.stream else ''), {'json': {
+            'text': f"You see that {scene}. The air smells of rain and old stone. What do you do next?",
+            'voice': args.voice,
+            'language': 'en'
+        }}
+    if endpoint == 'speech-to-text':
+        return 'POST', '/speech-to-text', {
+            'content': speech_wav(index, args.audio_seconds),
+            'headers': {'Content-Type': 'audio/wav', 'language': 'en'}
+        }
+    return 'POST', '/generate-image', {
+        'json': {
+            'contextPrompt': f"DM: {scene}.",
+            'currentMessage': f"Player: I draw my sword ({index}).",
+            'style': 'cartoon',
+            'profile': args.image_profile,
+            'format': 'webp'
+        },
+        # Raw image bytes, like the game-server asks for
+        'headers': {'Accept': 'image/webp'}
+    }
+
+
+def percentile(values, q):
+    # Nearest-rank percentile
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def summarize(results, elapsed):
+    ok = [r for r in results if r['status'] < 400]
+    latency = [r['latency_ms'] for r in ok]
+    ttfb = [r['ttfb_ms'] for r in ok if r['ttfb_ms'] is not None]
+    summary = {
+        'requests': len(results),
+        'errors': len(results) - len(ok),
+        'status': {str(status): sum(1 for r in results if r['status'] == status) for status in sorted({r['status'] for r in results})},
+        'throughput_rps': round(len(ok) / elapsed, 3) if elapsed else None,
+        'elapsed_s': round(elapsed, 3),
+        'bytes_per_response': round(sum(r['bytes'] for r in ok) / len(ok)) if ok else None
+    }
+    for name, values in (('latency_ms', latency), ('ttfb_ms', ttfb)):
+        summary[name] = {
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99),
+            'mean': round(sum(values) / len(values), 3) if values else None,
+            'max': max(values) if values else None
+        }
+    return summary
+
+
+def send(client, base_url, request):
+    method, path, kwargs = request
+    start = time.perf_counter()
+    first_byte = None
+    size = 0
+    try:
+        with client.stream(method, base_url + path, **kwargs) as response:
+            for chunk in response.iter_bytes():
+                if first_byte is None:
+                    first_byte = time.perf_counter()
+                size += len(chunk)
+            status = response.status_code
+    except httpx.HTTPError:
+        status = 599
+    end = time.perf_counter()
+    return {
+        'status': status,
+        'latency_ms': round((end - start) * 1000, 3),
+        'ttfb_ms': round((first_byte - start) * 1000, 3) if first_byte is not None else None,
+        'bytes': size
+    }
+
+
+def drive(client, base_url, requests, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda request: send(client, base_url, request), requests))
+    return results, time.perf_counter() - start
+
+
+def process_tree(root):
+    # root and all of its descendants, from /proc
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, todo = [], [root]
+    while todo:
+        pid = todo.pop()
+        tree.append(pid)
+        todo.extend(children.get(pid, []))
+    return tree
+
+
+def memory_kb(pid, field):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def command_name(pid):
+    try:
+        with open(f"/proc/{pid}/cmdline", 'rb') as f:
+            parts = [part.decode('utf-8', 'replace') for part in f.read().split(b'\0') if part]
+    except OSError:
+        return str(pid)
+    return ' '.join(os.path.basename(part) for part in parts[:4])
+
+
+class RssMonitor:
+    # Samples the RSS of the server process tree; the peak of the sum over
+    # all processes, and each process's own high-water mark (VmHWM)
+
+    def __init__(self, root, interval=0.1):
+        self.root = root
+        self.interval = interval
+        self.peak_total_kb = 0
+        self.process_peaks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rss-monitor', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._sample()
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        total = 0
+        for pid in process_tree(self.root):
+            rss = memory_kb(pid, 'VmRSS')
+            if rss is None:
+                continue
+            total += rss
+            key = f"{pid} {command_name(pid)}"
+            self.process_peaks[key] = max(self.process_peaks.get(key, 0), memory_kb(pid, 'VmHWM') or rss)
+        self.peak_total_kb = max(self.peak_total_kb, total)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def report(self):
+        return {
+            'total': round(self.peak_total_kb / 1024, 1),
+            'processes': {name: round(kb / 1024, 1) for name, kb in sorted(self.process_peaks.items())}
+        }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ENGINE_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--', '.'], cwd=ENGINE_DIR, capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def server_env(args, workdir, upstream_url, port):
+    env = dict(os.environ)
+    env.update({
+        'PORT': str(port),
+        'BIND': f"127.0.0.1:{port}",
+        'WEB_WORKERS': str(args.workers),
+        'INFERENCE_ADDRESS': os.path.join(workdir, 'inference.sock'),
+        'OPENAI_BASE_URL': upstream_url + '/v1',
+        'OPENAI_API_KEY': 'load-test',
+        'GEMINI_API_ENDPOINT': upstream_url,
+        'GOOGLE_API_KEY': 'load-test',
+        'MODEL_LOADERS': 'benchmarks.stub_models',
+        'PRELOAD_MODELS': 'all',
+        'SDXL_MODEL_ID': 'load-test-stub',
+        'CUDA_VISIBLE_DEVICES': '',
+        'TORCH_NUM_THREADS': str(args.torch_threads),
+        # Fresh caches, so every run measures the same work
+        'TTS_CACHE_DIR': os.path.join(workdir, 'tts-cache'),
+        'IMAGE_CACHE_DIR': os.path.join(workdir, 'image-cache'),
+        'XTTS_LATENT_CACHE_DIR': '',
+        'PYTHONUNBUFFERED': '1'
+    })
+    if args.server == 'inline':
+        # python app.py has no separate inference process
+        env.pop('INFERENCE_ADDRESS')
+    return env
+
+
+def start_server(args, env, log):
+    if args.server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app']
+    else:
+        command = [sys.executable, 'app.py']
+    # Own process group, so the inference process and workers are stopped too
+    return subprocess.Popen(command, cwd=ENGINE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+
+def stop_server(process):
+    if process.poll() is not None:
+        return
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def wait_until_ready(client, base_url, process, timeout):
+    deadline = time.monotonic() + timeout
+    pending = ['whisper', 'sdxl', 'xtts']
+    while pending:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with {process.returncode} while starting")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Models not ready after {timeout} s: {', '.join(pending)}")
+        try:
+            if client.get(f"{base_url}/health", params={'model': pending[0]}).status_code == 200:
+                pending.pop(0)
+                continue
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+
+
+def compare(current, baseline):
+    # Relative change of every latency percentile and of the throughput
+    changes = {}
+    for scenario in set(current['endpoints']) & set(baseline['endpoints']):
+        now, before = current['endpoints'][scenario], baseline['endpoints'][scenario]
+        rows = {'throughput_rps': (before['throughput_rps'], now['throughput_rps'])}
+        for q in ('p50', 'p95', 'p99'):
+            rows[f"latency_{q}_ms"] = (before['latency_ms'][q], now['latency_ms'][q])
+        changes[scenario] = {
+            name: {'baseline': old, 'current': new, 'change_pct': round((new - old) / old * 100, 1) if old and new is not None else None}
+            for name, (old, new) in rows.items()
+        }
+    rss = (baseline['peak_rss_mb']['total'], current['peak_rss_mb']['total'])
+    changes['peak_rss_mb'] = {'baseline': rss[0], 'current': rss[1], 'change_pct': round((rss[1] - rss[0]) / rss[0] * 100, 1) if rss[0] else None}
+    return {'baseline_commit': baseline.get('commit'), 'current_commit': current.get('commit'), 'changes': changes}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument('--requests', type=int, default=32, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mixed', action='store_true', help='also run all endpoints at once')
+    parser.add_argument('--server', choices=('inline', 'gunicorn'), default='inline')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--torch-threads', type=int, default=4)
+    parser.add_argument('--stream', action='store_true', help='use the streaming /generate and /tts responses')
+    parser.add_argument('--models', nargs='+', default=['gpt4o-mini', 'gemini-pro'])
+    parser.add_argument('--voice', default='alloy')
+    parser.add_argument('--audio-seconds', type=float, default=5.0)
+    parser.add_argument('--image-profile', default='preview')
+    parser.add_argument('--llm-latency-ms', type=float, default=300)
+    parser.add_argument('--llm-jitter-ms', type=float, default=50)
+    parser.add_argument('--llm-tokens-per-second', type=float, default=50)
+    parser.add_argument('--llm-error-rate', type=float, default=0.0)
+    parser.add_argument('--startup-timeout', type=float, default=600)
+    parser.add_argument('--output', help='write the JSON report here (default: stdout)')
+    parser.add_argument('--compare', help='a previous report to compare against')
+    parser.add_argument('--keep-workdir', action='store_true')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ai-engine-load-')
+    upstream = FakeUpstream(args.llm_latency_ms, args.llm_jitter_ms, args.llm_tokens_per_second, args.llm_error_rate)
+    upstream_server = serve(upstream)
+    upstream_url = f"http://127.0.0.1:{upstream_server.server_address[1]}"
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    commit, dirty = git_revision()
+
+    log_path = os.path.join(workdir, 'server.log')
+    log = open(log_path, 'wb')
+    process = start_server(args, server_env(args, workdir, upstream_url, port), log)
+    monitor = RssMonitor(process.pid).start()
+    client = httpx.Client(timeout=httpx.Timeout(600, connect=10),
+                          limits=httpx.Limits(max_connections=args.concurrency * len(ENDPOINTS)))
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'config': vars(args),
+        'endpoints': {}
+    }
+    try:
+        start = time.perf_counter()
+        wait_until_ready(client, base_url, process, args.startup_timeout)
+        report['startup_s'] = round(time.perf_counter() - start, 3)
+
+        # One request per endpoint first (first use of each code path)
+        for endpoint in args.endpoints:
+            send(client, base_url, build_request(endpoint, -1, args))
+
+        for endpoint in args.endpoints:
+            requests = [build_request(endpoint, index, args) for index in range(args.requests)]
+            results, elapsed = drive(client, base_url, requests, args.concurrency)
+            report['endpoints'][endpoint] = summarize(results, elapsed)
+            print(json.dumps({'endpoint': endpoint, **report['endpoints'][endpoint]['latency_ms']}), file=sys.stderr)
+
+        if args.mixed:
+            # Interleaved, with new inputs so nothing comes from the caches
+            endpoints = itertools.cycle(args.endpoints)
+            requests = [build_request(next(endpoints), args.requests + index, args) for index in range(args.requests * len(args.endpoints))]
+            results, elapsed = drive(client, base_url, requests, args.concurrency * len(args.endpoints))
+            report['endpoints']['mixed'] = summarize(results, elapsed)
+
+        metrics = client.get(f"{base_url}/metrics")
+        if metrics.status_code == 200:
+            with open(os.path.join(workdir, 'metrics.txt'), 'w') as f:
+                f.write(metrics.text)
+    except Exception:
+        print(f"Server log: {log_path}", file=sys.stderr)
+        args.keep_workdir = True
+        raise
+    finally:
+        monitor.stop()
+        stop_server(process)
+        log.close()
+        client.close()
+        upstream_server.shutdown()
+
+    report['peak_rss_mb'] = monitor.report()
+    report['upstream'] = upstream.stats()
+    if args.keep_workdir:
+        report['workdir'] = workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            report['comparison'] = compare(report, json.load(f))
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Benchmark for the Whisper micro-batching scheduler.
+#
+# Uses a tiny randomly initialised Whisper model as a stand-in for
+# openai/whisper-small, so it runs on CPU in a few seconds and needs no
+# downloads. Reports requests/sec for the batched scheduler and for the
+# previous one-request-per-generate() path (max_batch_size=1).
+#
+#   python benchmarks/stt_batching.py --requests 64 --concurrency 1 4 16
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import torch
+from transformers import WhisperConfig, WhisperForConditionalGeneration
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from stt_batcher import WhisperBatcher
+
+
+class StandInProcessor:
+    # Only batch_decode is used by the batcher
+    def batch_decode(self, predicted_ids, skip_special_tokens=True):
+        return [' '.join(str(int(i)) for i in ids) for ids in predicted_ids]
+
+
+def build_stand_in_model():
+    torch.manual_seed(0)
+    config = WhisperConfig(
+        vocab_size=512,
+        num_mel_bins=80,
+        d_model=64,
+        encoder_layers=2,
+        decoder_layers=2,
+        encoder_attention_heads=2,
+        decoder_attention_heads=2,
+        encoder_ffn_dim=128,
+        decoder_ffn_dim=128,
+        max_source_positions=1500,
+        max_target_positions=64,
+        decoder_start_token_id=1,
+        pad_token_id=0,
+        eos_token_id=2,
+        bos_token_id=1,
+    )
+    model = WhisperForConditionalGeneration(config).eval()
+    # Random weights never emit EOS, so fix the decode length
+    model.generation_config.max_length = 16
+    model.generation_config.eos_token_id = None
+    return StandInProcessor(), model
+
+
+def run(batcher, features, requests, concurrency):
+    def one(_):
+        return batcher.transcribe(features)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+    return requests / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--max-batch-size', type=int, default=16)
+    parser.add_argument('--max-wait-ms', type=float, default=10)
+    args = parser.parse_args()
+
+    torch.set_num_threads(4)
+    processor, model = build_stand_in_model()
+    features = torch.randn(1, 80, 3000)
+    lease_model = lambda rows, tenants, deadline: nullcontext((processor, model))
+
+    # Warm up
+    WhisperBatcher(lease_model, max_batch_size=1).transcribe(features)
+
+    results = []
+    for concurrency in args.concurrency:
+        unbatched = WhisperBatcher(lease_model, max_batch_size=1, max_wait_ms=0)
+        batched = WhisperBatcher(lease_model, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+        result = {
+            'concurrency': concurrency,
+            'unbatched_rps': round(run(unbatched, features, args.requests, concurrency), 2),
+            'batched_rps': round(run(batched, features, args.requests, concurrency), 2),
+            'avg_batch_size': round(batched.stats()['avg_batch_size'], 2)
+        }
+        results.append(result)
+        print(json.dumps(result))
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+# Tiny random-weight stand-ins for Whisper, SDXL and XTTS, loaded through
+# MODEL_LOADERS=benchmarks.stub_models (run from ai-engine/). They run on CPU
+# in milliseconds and need no downloads, but go through the same code paths
+# as the real models: the Whisper feature extractor and generate(), a real
+# diffusers SDXL pipeline (text encoders, UNet, scheduler, VAE, img2img via
+# from_pipe, AnimateDiff motion modules) and the XTTS conditioning latents +
+# inference() calls. The
+# outputs are noise; only the timings mean anything.
+import json
+import os
+import tempfile
+from types import SimpleNamespace
+
+import torch
+import torchaudio
+from transformers import (WhisperConfig, WhisperFeatureExtractor, WhisperForConditionalGeneration,
+                          CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer)
+
+# Decoded tokens per transcription; random weights never emit EOS
+WHISPER_TOKENS = int(os.getenv("STUB_WHISPER_TOKENS", "24"))
+# Synthesized audio per character of text (XTTS speaks ~15 characters/s)
+XTTS_SECONDS_PER_CHAR = float(os.getenv("STUB_XTTS_SECONDS_PER_CHAR", "0.06"))
+XTTS_SAMPLE_RATE = 24000
+
+
+class StubWhisperProcessor:
+    # The real feature extractor (log-mel, padded to 30 s); token ids are
+    # "decoded" as numbers since there is no vocabulary
+
+    def __init__(self):
+        self.feature_extractor = WhisperFeatureExtractor(feature_size=80)
+
+    def __call__(self, audio, sampling_rate=None, return_tensors=None):
+        return self.feature_extractor(audio, sampling_rate=sampling_rate, return_tensors=return_tensors)
+
+    def batch_decode(self, predicted_ids, skip_special_tokens=True):
+        return [' '.join(str(int(i)) for i in ids) for ids in predicted_ids]
+
+
+class StubWhisper(WhisperForConditionalGeneration):
+    def generate(self, input_features=None, language=None, **kwargs):
+        # The random vocabulary has no language tokens to force
+        return super().generate(input_features, **kwargs)
+
+
+def load_whisper():
+    torch.manual_seed(0)
+    config = WhisperConfig(
+        vocab_size=512,
+        num_mel_bins=80,
+        d_model=64,
+        encoder_layers=2,
+        decoder_layers=2,
+        encoder_attention_heads=2,
+        decoder_attention_heads=2,
+        encoder_ffn_dim=128,
+        decoder_ffn_dim=128,
+        max_source_positions=1500,
+        max_target_positions=64,
+        decoder_start_token_id=1,
+        pad_token_id=0,
+        eos_token_id=2,
+        bos_token_id=1,
+    )
+    model = StubWhisper(config).eval()
+    model.generation_config.max_length = WHISPER_TOKENS
+    model.generation_config.eos_token_id = None
+    return StubWhisperProcessor(), model
+
+
+def byte_characters():
+    # GPT-2/CLIP's printable stand-in character for each byte
+    printable = list(range(ord('!'), ord('~') + 1)) + list(range(ord('¡'), ord('¬') + 1)) + list(range(ord('®'), ord('ÿ') + 1))
+    characters = {byte: chr(byte) for byte in printable}
+    extra = 0
+    for byte in range(256):
+        if byte not in characters:
+            characters[byte] = chr(256 + extra)
+            extra += 1
+    return [characters[byte] for byte in range(256)]
+
+
+def byte_level_tokenizer():
+    # A CLIP tokenizer over single bytes (no merges), written to a temporary
+    # directory instead of downloading a vocabulary
+    characters = byte_characters()
+    vocab = characters + [c + '</w>' for c in characters] + ['<|startoftext|>', '<|endoftext|>']
+    directory = tempfile.mkdtemp(prefix='stub-clip-')
+    with open(os.path.join(directory, 'vocab.json'), 'w', encoding='utf-8') as f:
+        json.dump({token: index for index, token in enumerate(vocab)}, f)
+    with open(os.path.join(directory, 'merges.txt'), 'w', encoding='utf-8') as f:
+        f.write('#version: 0.2\n')
+    return CLIPTokenizer.from_pretrained(directory, model_max_length=77)
+
+
+def load_sdxl():
+    # The UNet and text encoders of the diffusers SDXL unit tests
+    from diffusers import AutoencoderKL, EulerDiscreteScheduler, StableDiffusionXLPipeline, UNet2DConditionModel
+
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=2,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=('DownBlock2D', 'CrossAttnDownBlock2D'),
+        up_block_types=('CrossAttnUpBlock2D', 'UpBlock2D'),
+        attention_head_dim=(2, 4),
+        use_linear_projection=True,
+        addition_embed_type='text_time',
+        addition_time_embed_dim=8,
+        transformer_layers_per_block=(1, 2),
+        # 6 time ids * addition_time_embed_dim + text_encoder_2 projection_dim
+        projection_class_embeddings_input_dim=80,
+        cross_attention_dim=64,
+        norm_num_groups=1,
+    )
+    # Four blocks, so latents are 1/8 of the image size as with the real VAE
+    vae = AutoencoderKL(
+        block_out_channels=[16, 16, 32, 32],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=['DownEncoderBlock2D'] * 4,
+        up_block_types=['UpDecoderBlock2D'] * 4,
+        layers_per_block=1,
+        latent_channels=4,
+        norm_num_groups=8,
+        sample_size=128,
+        mid_block_add_attention=False,
+    )
+    text_config = CLIPTextConfig(
+        bos_token_id=512,
+        eos_token_id=513,
+        pad_token_id=513,
+        hidden_size=32,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=5,
+        vocab_size=1000,
+        hidden_act='gelu',
+        projection_dim=32,
+    )
+    tokenizer = byte_level_tokenizer()
+    pipe = StableDiffusionXLPipeline(
+        vae=vae,
+        text_encoder=CLIPTextModel(text_config),
+        text_encoder_2=CLIPTextModelWithProjection(text_config),
+        tokenizer=tokenizer,
+        tokenizer_2=tokenizer,
+        unet=unet,
+        scheduler=EulerDiscreteScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule='scaled_linear',
+                                         steps_offset=1, timestep_spacing='leading'),
+    )
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
+
+
+def load_animation(sdxl_pipe):
+    # Motion modules sized for the stub SDXL UNet
+    from diffusers import MotionAdapter, UNetMotionModel
+
+    torch.manual_seed(0)
+    adapter = MotionAdapter(
+        block_out_channels=(32, 64),
+        motion_layers_per_block=2,
+        motion_num_attention_heads=2,
+        motion_norm_num_groups=8,
+        motion_max_seq_length=32,
+        use_motion_mid_block=False,
+    )
+    return UNetMotionModel.from_unet2d(sdxl_pipe.unet, adapter)
+
+
+class StubXtts(torch.nn.Module):
+    # Characters -> GRU -> a block of samples per character
+
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.config = SimpleNamespace(temperature=0.75, length_penalty=1.0, repetition_penalty=5.0, top_k=50, top_p=0.85,
+                                      gpt_cond_len=30, max_ref_len=30, sound_norm_refs=False)
+        self.embedding = torch.nn.Embedding(256, 64)
+        self.rnn = torch.nn.GRU(64, 64, batch_first=True)
+        self.vocoder = torch.nn.Linear(64, int(XTTS_SECONDS_PER_CHAR * XTTS_SAMPLE_RATE))
+        self.eval()
+
+    @property
+    def device(self):
+        return self.embedding.weight.device
+
+    def get_conditioning_latents(self, audio_path, gpt_cond_len=30, max_ref_length=30, sound_norm_refs=False):
+        # Reads the reference like XTTS does; the shapes are XTTS v2's
+        waveform, _ = torchaudio.load(audio_path[0])
+        generator = torch.Generator().manual_seed(waveform.shape[-1])
+        return torch.randn(1, 32, 1024, generator=generator), torch.randn(1, 512, 1, generator=generator)
+
+    def inference(self, text, language, gpt_cond_latent, speaker_embedding, **kwargs):
+        ids = torch.tensor([[min(ord(c), 255) for c in text] or [32]], device=self.device)
+        with torch.no_grad():
+            hidden, _ = self.rnn(self.embedding(ids))
+            wav = torch.tanh(self.vocoder(hidden)).flatten() * 0.1
+        return {'wav': wav}
+
+
+class StubTTS:
+    # The part of TTS.api.TTS that inference.py uses
+
+    def __init__(self):
+        self.synthesizer = SimpleNamespace(tts_model=StubXtts())
+
+    def to(self, device):
+        self.synthesizer.tts_model.to(device)
+        return self
+
+
+def load_xtts():
+    return StubTTS()
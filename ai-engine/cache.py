@@ -0,0 +1,288 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(*parts):
+    # Stable content hash of JSON-serialisable parts
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LRUCache:
+    # In-memory LRU bounded by item count and by total size of the stored bytes
+
+    def __init__(self, max_items=256, max_bytes=64 * 1024 * 1024):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, data, **metadata):
+        if len(data) > self.max_bytes or self.max_items <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= len(self._entries.pop(key)[0])
+            self._entries[key] = (data, metadata)
+            self._bytes += len(data)
+            while len(self._entries) > self.max_items or self._bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def stats(self):
+        return {'items': len(self._entries), 'bytes': self._bytes,
+                'max_items': self.max_items, 'max_bytes': self.max_bytes}
+
+
+class DiskCache:
+    # Files stored as <directory>/<key><suffix>, evicted least recently used
+    # first once the directory grows past max_bytes. Several processes (the
+    # gunicorn workers) may share the directory: the index is only a view of
+    # it, refreshed from the directory on every put and on a miss after
+    # another process changed it, and a hit touches the file so every process
+    # sees the same recency.
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._suffixes = set()
+        self._scanned = None
+        self._lock = threading.Lock()
+        if max_bytes > 0:
+            os.makedirs(directory, exist_ok=True)
+            with self._lock:
+                self._scan()
+                self._evict()
+
+    def _scan(self):
+        # Rebuilds the index from the directory, least recently used first
+        # (a hit touches its file). Called with the lock held.
+        self._scanned = os.stat(self.directory).st_mtime_ns
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    # Evicted by another process meanwhile
+                    continue
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        self._entries.clear()
+        self._bytes = 0
+        for _, name, size in sorted(files):
+            key, suffix = os.path.splitext(name)
+            self._entries[key] = (name, size)
+            self._bytes += size
+            self._suffixes.add(suffix)
+
+    def _find(self, key):
+        # Adopts a file another process wrote since the last scan. Called
+        # with the lock held.
+        for suffix in self._suffixes:
+            name = key + suffix
+            try:
+                size = os.stat(os.path.join(self.directory, name)).st_size
+            except OSError:
+                continue
+            self._entries[key] = (name, size)
+            self._bytes += size
+            return self._entries[key]
+        try:
+            changed = os.stat(self.directory).st_mtime_ns != self._scanned
+        except OSError:
+            return None
+        if changed:
+            self._scan()
+            return self._entries.get(key)
+        return None
+
+    def path(self, key):
+        if self.max_bytes <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key) or self._find(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+        path = os.path.join(self.directory, entry[0])
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted by another process
+            with self._lock:
+                if self._entries.get(key) == entry:
+                    del self._entries[key]
+                    self._bytes -= entry[1]
+            return None
+        return path
+
+    def get(self, key):
+        path = self.path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key, data, suffix=''):
+        if self.max_bytes <= 0 or len(data) > self.max_bytes:
+            return None
+        name = key + suffix
+        path = os.path.join(self.directory, name)
+        # Write to a temporary file first so readers never see partial files
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to write cache file {path}: {str(e)}")
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            return None
+
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None and previous[0] != name:
+                self._remove(previous[0])
+            # The budget holds for the directory, whichever process wrote it
+            self._scan()
+            self._evict()
+        return path
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, (name, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self._remove(name)
+
+    def _remove(self, name):
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def stats(self):
+        return {'items': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+
+class TieredCache:
+    # Memory LRU in front of a disk cache, with hit/miss counters
+
+    def __init__(self, memory, disk):
+        self.memory = memory
+        self.disk = disk
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        # Returns ('memory', data, metadata), ('disk', path, metadata) or None
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory_hits += 1
+            return 'memory', entry[0], entry[1]
+
+        path = self.disk.path(key)
+        if path is not None:
+            self.disk_hits += 1
+            return 'disk', path, {'suffix': os.path.splitext(path)[1]}
+
+        self.misses += 1
+        return None
+
+    def put(self, key, data, suffix='', **metadata):
+        self.memory.put(key, data, suffix=suffix, **metadata)
+        return self.disk.put(key, data, suffix)
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0,
+            'memory': self.memory.stats(),
+            'disk': self.disk.stats()
+        }
+
+
+class TTLCache:
+    # Memoizes computed values for ttl seconds, bounded to max_items (least
+    # recently used entries are dropped first)
+
+    def __init__(self, max_items=512, ttl=3600):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.max_items <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute, bypass=False):
+        # bypass skips the lookup but still stores the fresh value
+        if not bypass:
+            value = self.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+        self.misses += 1
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'items': len(self._entries),
+            'max_items': self.max_items,
+            'ttl': self.ttl
+        }
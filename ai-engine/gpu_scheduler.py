@@ -0,0 +1,211 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+# Lower runs first: a player is waiting on a transcription, speech is played
+# while it is synthesized, an image or animation can take a while anyway
+PRIORITIES = {'whisper': 0, 'xtts': 1, 'sdxl': 2, 'animation': 2}
+
+queue_seconds = metrics.REGISTRY.histogram('gpu_queue_seconds', 'Time model work waited for a GPU slot', ('model',))
+preemptions_total = metrics.REGISTRY.counter('gpu_preemptions_total', 'Runs that handed their GPU slot to higher priority work', ('model',))
+dropped_total = metrics.REGISTRY.counter('gpu_dropped_total', 'Model work dropped because its deadline passed', ('model',))
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def expire(batch):
+    # Fails the requests of a batch whose deadline passed while they waited
+    now = time.time()
+    for request in batch:
+        if request.deadline is not None and now > request.deadline and not request.future.done():
+            request.future.set_exception(DeadlineExceeded("The request was still waiting for its batch at its deadline"))
+    return [request for request in batch if not request.future.done()]
+
+
+def batch_lease(batch):
+    # (tenants, deadline) of a batch: it is only dropped while queued for the
+    # GPU once every request in it is past its deadline
+    deadlines = [request.deadline for request in batch]
+    return [request.tenant for request in batch], None if None in deadlines else max(deadlines)
+
+
+class _Ticket:
+    def __init__(self, kind, priority, tenants, deadline, seq):
+        self.kind = kind
+        self.priority = priority
+        self.tenants = tenants
+        self.deadline = deadline
+        self.seq = seq
+        self.granted = False
+        self.dropped = False
+        self.preempted = False
+        self.enqueued_at = time.monotonic()
+        self.started = None
+
+
+class GpuScheduler:
+    # Decides which model work runs on the GPU next. Every model run goes
+    # through run(kind, tenants, deadline), which waits for one of `slots`
+    # GPU slots. Waiting work is served by
+    #
+    #   1. the priority class of its model (PRIORITIES)
+    #   2. the GPU time its tenants (games) were given so far, so a busy game
+    #      cannot starve the others; a tenant that was idle starts at the
+    #      current virtual time instead of with saved-up credit
+    #   3. arrival
+    #
+    # except that a run paused by checkpoint() resumes before new work of its
+    # class (it may hold resources, e.g. the SDXL modules, that work needs).
+    #
+    # Work still waiting at its deadline (a time.time() timestamp) is dropped
+    # with DeadlineExceeded. Long runs call checkpoint() between steps: when
+    # higher priority work is waiting and can_preempt(its kind) allows it (it
+    # fits in GPU memory next to the paused run), the run hands over its slot
+    # and continues once it gets it back.
+    #
+    # Disabled, run() only drops work whose deadline already passed.
+
+    def __init__(self, priorities=PRIORITIES, slots=1, enabled=True, can_preempt=None):
+        self.priorities = priorities
+        self.slots = max(1, slots)
+        self.enabled = enabled
+        self.can_preempt = can_preempt or (lambda kind: True)
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._running = []
+        # GPU seconds per tenant, split evenly between the tenants of a batch
+        self._served = {}
+        self._virtual_time = 0.0
+        self._seq = 0
+        self._local = threading.local()
+        self.runs = 0
+        self.dropped = 0
+        self.preemptions = 0
+
+    @contextmanager
+    def run(self, kind, tenants=(), deadline=None):
+        tenants = tuple(dict.fromkeys(tenants)) or (None,)
+        if not self.enabled:
+            if deadline is not None and time.time() > deadline:
+                self._drop(kind)
+            yield None
+            return
+
+        with self._condition:
+            self._seq += 1
+            ticket = _Ticket(kind, self.priorities.get(kind, max(self.priorities.values(), default=0) + 1), tenants, deadline, self._seq)
+            for tenant in tenants:
+                if not self._backlogged(tenant):
+                    self._served[tenant] = max(self._served.get(tenant, 0.0), self._virtual_time)
+            self._waiting.append(ticket)
+            self._dispatch()
+            self._wait(ticket)
+            self.runs += 1
+        queue_seconds.labels(kind).observe(ticket.started - ticket.enqueued_at)
+
+        previous = getattr(self._local, 'ticket', None)
+        self._local.ticket = ticket
+        try:
+            yield ticket
+        finally:
+            self._local.ticket = previous
+            with self._condition:
+                self._release(ticket)
+                self._prune()
+                self._dispatch()
+
+    def checkpoint(self):
+        # Called by the thread holding a slot between two steps of its run
+        ticket = getattr(self._local, 'ticket', None)
+        if ticket is None:
+            return
+        with self._condition:
+            waiting = [other for other in self._waiting if other.priority < ticket.priority]
+            if not waiting or len(self._running) < self.slots:
+                return
+            if not self.can_preempt(min(waiting, key=self._order).kind):
+                return
+            self._release(ticket)
+            # Keeps its place (seq) among the work of its own class
+            ticket.granted = False
+            ticket.preempted = True
+            self._waiting.append(ticket)
+            self._dispatch()
+            self.preemptions += 1
+            preemptions_total.labels(ticket.kind).inc()
+            self._wait(ticket)
+
+    def fair_order(self, requests):
+        # The requests (anything with a .tenant) of one batcher, least served
+        # tenant first and in arrival order within a tenant; batchers take
+        # the head of this order to decide what to run next
+        if not self.enabled:
+            return requests
+        with self._condition:
+            return sorted(requests, key=lambda request: self._served.get(request.tenant, self._virtual_time))
+
+    def _backlogged(self, tenant):
+        return any(tenant in ticket.tenants for ticket in self._waiting + self._running)
+
+    def _order(self, ticket):
+        return ticket.priority, not ticket.preempted, min(self._served[tenant] for tenant in ticket.tenants), ticket.seq
+
+    def _dispatch(self):
+        now = time.time()
+        for ticket in [t for t in self._waiting if t.deadline is not None and now > t.deadline]:
+            self._waiting.remove(ticket)
+            ticket.dropped = True
+        while self._waiting and len(self._running) < self.slots:
+            ticket = min(self._waiting, key=self._order)
+            self._waiting.remove(ticket)
+            self._running.append(ticket)
+            self._virtual_time = max(self._virtual_time, self._order(ticket)[2])
+            ticket.granted = True
+            ticket.started = time.monotonic()
+            # Only queued work is dropped, a paused run always resumes
+            ticket.deadline = None
+        self._condition.notify_all()
+
+    def _wait(self, ticket):
+        while not ticket.granted and not ticket.dropped:
+            timeout = None if ticket.deadline is None else ticket.deadline - time.time()
+            if timeout is not None and timeout <= 0:
+                self._dispatch()
+                continue
+            self._condition.wait(timeout)
+        if ticket.dropped:
+            self._drop(ticket.kind)
+
+    def _drop(self, kind):
+        self.dropped += 1
+        dropped_total.labels(kind).inc()
+        raise DeadlineExceeded(f"{kind} work was still waiting for the GPU at its deadline")
+
+    def _release(self, ticket):
+        elapsed = time.monotonic() - ticket.started
+        for tenant in ticket.tenants:
+            self._served[tenant] += elapsed / len(ticket.tenants)
+        self._running.remove(ticket)
+
+    def _prune(self):
+        # A tenant without work that is not ahead of the virtual time would
+        # restart from the virtual time anyway
+        for tenant in [t for t, served in self._served.items() if served <= self._virtual_time and not self._backlogged(t)]:
+            del self._served[tenant]
+
+    def stats(self):
+        with self._condition:
+            return {
+                'enabled': self.enabled,
+                'slots': self.slots,
+                'running': [ticket.kind for ticket in self._running],
+                'waiting': {kind: sum(1 for ticket in self._waiting if ticket.kind == kind) for kind in self.priorities},
+                'runs': self.runs,
+                'dropped': self.dropped,
+                'preemptions': self.preemptions,
+                'tenants': len(self._served)
+            }
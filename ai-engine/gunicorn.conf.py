@@ -0,0 +1,67 @@
+# Production serving mode:
+#
+#   gunicorn -c gunicorn.conf.py app:app
+#
+# The gunicorn workers run the HTTP front end (app.py): parsing, validation,
+# caching and the LLM calls. The models are loaded once, by a single inference
+# process (inference.py) that this config starts next to the master and that
+# the workers reach over INFERENCE_ADDRESS. python app.py still serves
+# everything from one process, for development.
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_WORKERS", "4"))
+# Threads per worker: requests mostly wait on the LLM APIs or on the inference process
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "8"))
+# Image renders and long transcriptions hold a request for a while
+timeout = int(os.getenv("WEB_TIMEOUT", "300"))
+graceful_timeout = 30
+keepalive = 5
+
+# Inherited by the workers and by the inference process
+os.environ.setdefault("INFERENCE_ADDRESS", "/tmp/ai-engine-inference.sock")
+os.environ.setdefault("INFERENCE_AUTHKEY", secrets.token_hex(16))
+
+inference_process = None
+stopping = False
+
+
+def start_inference(log):
+    global inference_process
+    inference_process = subprocess.Popen(
+        [sys.executable, "inference.py"],
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    log.info(f"Started inference process {inference_process.pid}")
+
+
+def watch_inference(log):
+    # Restarts the inference process if it dies; the workers reconnect on
+    # their next call
+    while not stopping:
+        if inference_process.poll() is not None:
+            log.error(f"Inference process exited with {inference_process.returncode}, restarting")
+            start_inference(log)
+        time.sleep(1)
+
+
+def on_starting(server):
+    start_inference(server.log)
+    threading.Thread(target=watch_inference, args=(server.log,), name="inference-watch", daemon=True).start()
+
+
+def on_exit(server):
+    global stopping
+    stopping = True
+    if inference_process is not None and inference_process.poll() is None:
+        inference_process.terminate()
+        try:
+            inference_process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            inference_process.kill()
@@ -0,0 +1,273 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, CancelledError
+
+import torch
+
+import metrics
+from cache import TTLCache
+from gpu_scheduler import expire, batch_lease
+
+logger = logging.getLogger(__name__)
+
+batch_size = metrics.REGISTRY.histogram('batch_size', 'Requests per model batch', ('model',), buckets=(1, 2, 4, 8, 16, 32))
+batch_seconds = metrics.REGISTRY.histogram('batch_seconds', 'Model run time per batch', ('model',))
+step_seconds = metrics.REGISTRY.histogram('sdxl_step_seconds', 'SDXL denoising step time (whole batch)',
+                                          buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+
+
+class _PendingImage:
+    def __init__(self, prompt, negative_prompt, settings, init_image, seed, on_step, cancelled, tenant, deadline):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.settings = settings
+        self.init_image = init_image
+        self.seed = seed
+        self.on_step = on_step
+        self.cancelled = cancelled
+        self.tenant = tenant
+        self.deadline = deadline
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class ImageBatcher:
+    # Groups concurrent SDXL requests into a single pipeline call. Requests are
+    # batched when they share size, steps, guidance, scheduler and (for
+    # image-to-image) strength, since those apply to the whole batch; a
+    # batch is flushed when it is full or
+    # when its oldest request has waited max_wait_ms. Prompts are passed as
+    # embeddings, and the output of the two text encoders is kept in an LRU
+    # cache, so a recurring style suffix or the shared negative prompt is
+    # only encoded once. The cache lives in CPU memory, outside the GPU
+    # budget; a batch moves its embeddings to the device.
+
+    def __init__(self, lease_pipeline, max_batch_size=2, max_wait_ms=50, embedding_cache=None,
+                 schedulers=None, image_to_image=None, order=None, checkpoint=None):
+        # lease_pipeline(batch_size, tenants, deadline) returns a context
+        # manager holding the text-to-image pipeline on its device for one
+        # batch. schedulers maps a name to a factory taking the pipeline's
+        # original scheduler config; image_to_image(pipe) builds an img2img
+        # pipeline sharing its modules. order(pending) may reorder the waiting
+        # requests, its head decides what runs next; checkpoint() is called
+        # between denoising steps and may pause the batch.
+        self.lease_pipeline = lease_pipeline
+        self.order = order
+        self.checkpoint = checkpoint
+        self.schedulers = schedulers or {}
+        self.image_to_image = image_to_image
+        self._scheduler_instances = {}
+        self._loaded = None
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.embeddings = embedding_cache if embedding_cache is not None else TTLCache(max_items=256, ttl=24 * 3600)
+        self._pending = []
+        self._condition = threading.Condition()
+        self._worker = None
+        self.batches = 0
+        self.images = 0
+
+    def submit(self, prompt, negative_prompt=None, width=1024, height=1024, steps=50, guidance_scale=7.5,
+               scheduler=None, init_image=None, strength=None, seed=None, on_step=None, cancelled=None, tenant=None,
+               deadline=None):
+        # on_step(step, total) reports progress; cancelled() returning True
+        # drops the request, or stops the batch once every image in it is
+        # cancelled. With init_image the image is refined (img2img) at the
+        # given strength. A seed makes the image reproducible, whichever
+        # batch it lands in. A request not started by its deadline
+        # (time.time()) fails with DeadlineExceeded. The future resolves to a
+        # PIL image.
+        if init_image is not None:
+            if self.image_to_image is None:
+                raise ValueError("Image-to-image is not configured")
+            init_image = init_image.convert('RGB').resize((width, height))
+            strength = 0.6 if strength is None else strength
+        else:
+            strength = None
+        if scheduler is not None and scheduler not in self.schedulers:
+            raise ValueError(f"Unknown scheduler: {scheduler}")
+        settings = (width, height, steps, guidance_scale, scheduler, strength)
+        request = _PendingImage(prompt, negative_prompt or '', settings, init_image, seed, on_step, cancelled, tenant, deadline)
+        with self._condition:
+            self._ensure_worker()
+            self._pending.append(request)
+            self._condition.notify()
+        return request.future
+
+    def generate(self, prompt, negative_prompt=None, timeout=None, **kwargs):
+        return self.submit(prompt, negative_prompt, **kwargs).result(timeout=timeout)
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'images': self.images,
+            'avg_batch_size': self.images / self.batches if self.batches else 0,
+            'pending': len(self._pending),
+            'embedding_cache': self.embeddings.stats()
+        }
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name='image-batcher', daemon=True)
+            self._worker.start()
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+
+            # The oldest request (of the tenant next in line) decides which
+            # settings are served next
+            first = self.order(self._pending)[0] if self.order else self._pending[0]
+            settings = first.settings
+            deadline = first.enqueued_at + self.max_wait
+            while True:
+                pending = self.order(self._pending) if self.order else self._pending
+                compatible = [r for r in pending if r.settings == settings]
+                remaining = deadline - time.monotonic()
+                if len(compatible) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            batch = compatible[:self.max_batch_size]
+            self._pending = [r for r in self._pending if r not in batch]
+            return settings, batch
+
+    def _run(self):
+        while True:
+            settings, batch = self._next_batch()
+            for request in batch:
+                if request.cancelled and request.cancelled():
+                    request.future.cancel()
+            batch = [r for r in expire(batch) if r.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                images = self._render(settings, batch)
+                for request, image in zip(batch, images):
+                    request.future.set_result(image)
+            except CancelledError as e:
+                for request in batch:
+                    request.future.set_exception(e)
+            except Exception as e:
+                logger.error(f"Error in image batch of {len(batch)}: {str(e)}")
+                for request in batch:
+                    request.future.set_exception(e)
+
+    def encode(self, pipe, text):
+        # (prompt_embeds, pooled_prompt_embeds) of one prompt on the CPU, from
+        # the cache when it was encoded before
+        def compute():
+            device = getattr(pipe, '_execution_device', pipe.device)
+            prompt_embeds, _, pooled_prompt_embeds, _ = pipe.encode_prompt(
+                prompt=text,
+                device=device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=False
+            )
+            return prompt_embeds.cpu(), pooled_prompt_embeds.cpu()
+
+        return self.embeddings.get_or_compute(('sdxl', text), compute)
+
+    def encode_negative(self, pipe, text, positive):
+        # SDXL base uses all zeros for an empty negative prompt
+        # (force_zeros_for_empty_prompt), like the pipeline does itself
+        if not text and getattr(pipe.config, 'force_zeros_for_empty_prompt', False):
+            return tuple(torch.zeros_like(embeds) for embeds in positive)
+        return self.encode(pipe, text)
+
+    def _pipeline(self, pipe, scheduler, strength):
+        # The scheduler is swapped on the shared pipeline; batches run one at
+        # a time on the worker thread, so no other call sees the change.
+        # (pipeline, its own scheduler, img2img pipeline) is reset whenever
+        # the pipeline was reloaded.
+        if self._loaded is None or self._loaded[0] is not pipe:
+            self._loaded = [pipe, pipe.scheduler, None]
+        _, default_scheduler, img2img = self._loaded
+
+        if scheduler is None:
+            pipe.scheduler = default_scheduler
+        else:
+            if scheduler not in self._scheduler_instances:
+                self._scheduler_instances[scheduler] = self.schedulers[scheduler](default_scheduler.config)
+            pipe.scheduler = self._scheduler_instances[scheduler]
+        if strength is None:
+            return pipe
+
+        if img2img is None:
+            img2img = self._loaded[2] = self.image_to_image(pipe)
+        img2img.scheduler = pipe.scheduler
+        return img2img
+
+    @staticmethod
+    def _generator(seed):
+        generator = torch.Generator('cpu')
+        if seed is None:
+            generator.seed()
+        else:
+            generator.manual_seed(seed)
+        return generator
+
+    def _render(self, settings, batch):
+        width, height, steps, guidance_scale, scheduler, strength = settings
+        # img2img only runs the last strength * steps denoising steps
+        total_steps = steps if strength is None else max(1, int(steps * strength))
+
+        last_step = [time.perf_counter()]
+        interrupted = [False]
+
+        def on_step_end(pipeline, step, timestep, callback_kwargs):
+            now = time.perf_counter()
+            step_seconds.labels().observe(now - last_step[0])
+            last_step[0] = now
+            for request in batch:
+                if request.on_step:
+                    request.on_step(step + 1, total_steps)
+            if all(request.cancelled and request.cancelled() for request in batch):
+                # Makes the pipeline skip the remaining denoising steps
+                pipeline._interrupt = True
+                interrupted[0] = True
+            elif self.checkpoint and step + 1 < total_steps:
+                # May pause here while more urgent work uses the GPU
+                self.checkpoint()
+                last_step[0] = time.perf_counter()
+            return callback_kwargs
+
+        with self.lease_pipeline(len(batch), *batch_lease(batch)) as pipe:
+            with torch.no_grad():
+                positive = [self.encode(pipe, request.prompt) for request in batch]
+                negative = [self.encode_negative(pipe, request.negative_prompt, embeds) for request, embeds in zip(batch, positive)]
+            device = getattr(pipe, '_execution_device', pipe.device)
+
+            def on_device(tensors):
+                return torch.cat(tensors).to(device=device, dtype=pipe.dtype)
+
+            kwargs = {
+                'prompt_embeds': on_device([embeds for embeds, _ in positive]),
+                'pooled_prompt_embeds': on_device([pooled for _, pooled in positive]),
+                'negative_prompt_embeds': on_device([embeds for embeds, _ in negative]),
+                'negative_pooled_prompt_embeds': on_device([pooled for _, pooled in negative]),
+                'num_inference_steps': steps,
+                'guidance_scale': guidance_scale,
+                # One CPU generator per image, so its initial noise does not
+                # depend on the batch or the device
+                'generator': [self._generator(request.seed) for request in batch],
+                'callback_on_step_end': on_step_end
+            }
+            if strength is None:
+                kwargs.update(width=width, height=height)
+            else:
+                kwargs.update(image=[request.init_image for request in batch], strength=strength)
+            start = last_step[0] = time.perf_counter()
+            images = self._pipeline(pipe, scheduler, strength)(**kwargs).images
+            batch_seconds.labels('sdxl').observe(time.perf_counter() - start)
+            batch_size.labels('sdxl').observe(len(batch))
+        if interrupted[0]:
+            # The pipeline still decodes the half-denoised latents; they are
+            # noise, never a result
+            raise CancelledError()
+
+        self.batches += 1
+        self.images += len(batch)
+        return images
@@ -0,0 +1,58 @@
+from io import BytesIO
+
+from PIL import Image
+
+# Response formats: PIL format name, mimetype and default quality (PNG is lossless)
+IMAGE_FORMATS = {
+    'png': ('PNG', 'image/png', None),
+    'webp': ('WEBP', 'image/webp', 85),
+    'jpeg': ('JPEG', 'image/jpeg', 90)
+}
+
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+
+
+def image_format(name):
+    name = (name or 'png').lower()
+    name = FORMAT_ALIASES.get(name, name)
+    if name not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format: {name} (expected one of {', '.join(IMAGE_FORMATS)})")
+    return name
+
+
+def mimetype(fmt):
+    return IMAGE_FORMATS[fmt][1]
+
+
+def encode_image(image, fmt='png', quality=None):
+    pil_format, _, default_quality = IMAGE_FORMATS[fmt]
+    buffer = BytesIO()
+    if fmt == 'png':
+        image.save(buffer, pil_format)
+    elif fmt == 'webp':
+        image.save(buffer, pil_format, quality=quality or default_quality, method=4)
+    else:
+        image.convert('RGB').save(buffer, pil_format, quality=quality or default_quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def thumbnail(image, size):
+    # Fits the image in a size x size box, keeping its aspect ratio
+    copy = image.copy()
+    copy.thumbnail((size, size), Image.LANCZOS)
+    return copy
+
+
+def encode_variants(png, fmt='png', quality=None, thumbnail_sizes=()):
+    # Encodes a rendered PNG and its thumbnails in one pass over the decoded
+    # image. Returns {'full': bytes, '<size>': bytes, ...}; the full PNG is
+    # passed through without re-encoding.
+    image = None
+    if fmt != 'png' or thumbnail_sizes:
+        image = Image.open(BytesIO(png))
+        image.load()
+
+    variants = {'full': png if fmt == 'png' else encode_image(image, fmt, quality)}
+    for size in thumbnail_sizes:
+        variants[str(size)] = encode_image(thumbnail(image, size), fmt, quality)
+    return variants
@@ -0,0 +1,131 @@
+import os
+import time
+
+import metrics
+from cache import cache_key, TTLCache
+from moderation import ModerationPipeline
+from singleflight import SingleFlight
+
+# Prompt expansion and the kids-mode safety check are memoized on their inputs:
+# regenerate clicks and several players illustrating the same scene send the
+# exact same context, so the LLM round-trips can be reused.
+prompt_cache = TTLCache(
+    max_items=int(os.getenv("IMAGE_PROMPT_CACHE_ITEMS", "512")),
+    ttl=int(os.getenv("IMAGE_PROMPT_CACHE_TTL", "3600"))
+)
+safety_cache = TTLCache(
+    max_items=int(os.getenv("IMAGE_PROMPT_CACHE_ITEMS", "512")),
+    ttl=int(os.getenv("IMAGE_PROMPT_CACHE_TTL", "3600"))
+)
+
+
+def expand_image_prompt(llm, context_prompt, current_message, style='cartoon', theme='', is_kids_mode=False):
+    # Adjust the system message based on kids mode
+    system_message = (
+        "You are an AI that generates detailed image prompts based on story context. "
+        "Create a vivid, descriptive prompt that captures the scene, including relevant details from the context. "
+        "Focus on visual elements and maintain continuity with previous events. "
+        f"The prompt should be suitable for image generation. Apply a {style} art style to the image. "
+    )
+
+    if is_kids_mode:
+        system_message += (
+            "As this is for a children's story, ensure all content is family-friendly and appropriate for young audiences. "
+            "Avoid any scary, violent, or adult themes. Focus on whimsical, colorful, and positive imagery. "
+            "Characters should be cute or friendly-looking. Scenes should be bright and cheerful. "
+        )
+
+    if theme:
+        system_message += (f" The theme of the game is {theme}.")
+
+    # Generate a detailed image prompt
+    detailed_prompt = llm.chat(
+        'gpt4o-mini',
+        [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": f"Context:\n{context_prompt}\n\nCurrent action:\n{current_message}\n\nGenerate a detailed image prompt for this scene in {style} style:"}
+        ],
+        max_tokens=75
+    )
+
+    return detailed_prompt.strip()
+
+
+def check_kids_safety(llm, image_prompt):
+    # Returns the prompt unchanged, or the moderator's child-friendly version
+    safety_response = llm.chat(
+        'gpt4o-mini',
+        [
+            {"role": "system", "content": "You are a content moderator for children's content. Evaluate the following image prompt and determine if it's suitable for children. If it's not suitable, provide a modified, child-friendly version."},
+            {"role": "user", "content": f"Image prompt: {image_prompt}\n\nIs this prompt suitable for children? If not, provide a modified version:"}
+        ],
+        max_tokens=100
+    ).strip()
+    if "not suitable" in safety_response.lower():
+        return safety_response.split("Modified version:")[-1].strip()
+    return image_prompt
+
+
+def moderate_image_prompt(image_prompt, llm, use_cache=True):
+    return safety_cache.get_or_compute(
+        cache_key('image-safety', image_prompt),
+        lambda: check_kids_safety(llm, image_prompt),
+        bypass=not use_cache
+    )
+
+# Kids mode prompts only reach the LLM moderator when the local pre-filter
+# flags them (KIDS_MODERATION_MODE=always restores the unconditional check)
+image_moderation = ModerationPipeline(
+    moderate_image_prompt,
+    always_moderate=os.getenv("KIDS_MODERATION_MODE", "prefilter") == "always"
+)
+
+
+def prompt_inputs(data):
+    # The request fields the image prompt is built from
+    context_prompt = data['contextPrompt']
+    current_message = data['currentMessage']
+    is_kids_mode = bool(data.get('isKidsMode', False))
+    style = data.get('style', 'cartoon')  # Default to 'cartoon' if not provided
+    theme = data.get('theme', '')
+    return context_prompt, current_message, style, theme, is_kids_mode
+
+
+# Identical expansions in flight share one LLM call, and so the same prompt
+# (and derived seed), which lets their renders coalesce too
+prompt_flight = SingleFlight('image_prompt')
+
+
+def build_image_prompt(llm, data, use_cache=True, timings=None):
+    # llm is the shared Upstream client (anything with a chat() method)
+    context_prompt, current_message, style, theme, is_kids_mode = prompt_inputs(data)
+
+    start = time.perf_counter()
+    key = cache_key('image-prompt', context_prompt, current_message, style, theme, is_kids_mode)
+    with metrics.span('prompt_expansion'):
+        # A noCache request must not join an in-flight call that may be
+        # answered from the cache
+        image_prompt = prompt_flight.do(cache_key(key, use_cache), lambda flight: prompt_cache.get_or_compute(
+            key,
+            lambda: expand_image_prompt(llm, context_prompt, current_message, style, theme, is_kids_mode),
+            bypass=not use_cache
+        ))
+    if timings is not None:
+        timings['prompt_expansion_ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+    # Add a safety check for kids mode
+    if is_kids_mode:
+        result = image_moderation.check(image_prompt, llm=llm, use_cache=use_cache)
+        image_prompt = result.text
+        if timings is not None:
+            timings.update(result.timings)
+
+    return image_prompt
+
+
+def cache_stats():
+    return {'prompt_expansion': prompt_cache.stats(), 'kids_safety': safety_cache.stats()}
+
+
+def moderation_stats():
+    return image_moderation.stats()
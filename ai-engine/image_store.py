@@ -0,0 +1,91 @@
+import hashlib
+import json
+import threading
+
+from cache import cache_key
+
+
+def derive_seed(*parts):
+    # Stable 32-bit seed from the request content, so identical requests
+    # render (and hit the store for) the same image
+    return int(cache_key('seed', *parts)[:8], 16)
+
+
+class ImageStore:
+    # Rendered PNGs addressed by everything that determines their pixels
+    # (final prompt, negative prompt, render settings, seed, model id), kept
+    # in a TieredCache (memory LRU in front of a byte-budgeted directory).
+    # Aliases map the raw request inputs to a stored image, so a repeated
+    # request also skips the LLM prompt expansion.
+
+    def __init__(self, cache, model_id):
+        self.cache = cache
+        self.model_id = model_id
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.alias_hits = 0
+        self.alias_misses = 0
+
+    def image_key(self, image_prompt, negative_prompt, settings, seed, init_image=None):
+        # init_image (PNG bytes) is only set when refining a preview
+        init_hash = hashlib.sha256(init_image).hexdigest() if init_image else None
+        return cache_key('image', self.model_id, image_prompt, negative_prompt, settings, seed, init_hash)
+
+    def alias_key(self, *inputs):
+        return cache_key('image-alias', self.model_id, *inputs)
+
+    def _read(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        tier, value, _ = entry
+        if tier == 'memory':
+            return value
+        try:
+            with open(value, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def get(self, key):
+        # Bytes of a stored image, or None
+        data = self._read(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key, data, suffix='.png'):
+        self.cache.put(key, data, suffix)
+
+    def get_alias(self, alias):
+        # Returns (alias entry, PNG bytes) when the raw inputs were rendered
+        # before and the image is still stored, else None
+        data = self._read(alias)
+        entry = json.loads(data) if data else None
+        png = self._read(entry['image_key']) if entry else None
+        with self._lock:
+            if png is None:
+                self.alias_misses += 1
+            else:
+                self.alias_hits += 1
+        return (entry, png) if png is not None else None
+
+    def put_alias(self, alias, image_key, **entry):
+        data = json.dumps(dict(entry, image_key=image_key)).encode('utf-8')
+        self.cache.put(alias, data, '.json')
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'model_id': self.model_id,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'alias_hits': self.alias_hits,
+            'alias_misses': self.alias_misses,
+            'cache': self.cache.stats()
+        }
@@ -0,0 +1,523 @@
+import os
+import logging
+import hashlib
+import importlib
+import tempfile
+import threading
+import numpy as np
+import torch
+from concurrent.futures import CancelledError
+from contextlib import contextmanager, nullcontext
+from io import BytesIO
+from PIL import Image
+from transformers import WhisperProcessor, WhisperForConditionalGeneration
+from TTS.api import TTS
+from diffusers import DPMSolverMultistepScheduler, EulerAncestralDiscreteScheduler, AutoPipelineForText2Image, AutoPipelineForImage2Image
+from diffusers import AnimateDiffSDXLPipeline, DDIMScheduler, MotionAdapter, UNetMotionModel
+from huggingface_hub import login
+from model_registry import ModelRegistry
+from memory_governor import MemoryGovernor
+from gpu_scheduler import GpuScheduler
+from stt_batcher import WhisperBatcher
+from image_batcher import ImageBatcher
+from image_encoding import encode_image
+from voice_latents import VoiceLatentStore
+from cache import TTLCache, cache_key
+from jobs import JobBoard
+from story_context import StoryBoard
+from singleflight import SingleFlight
+from audio_io import WHISPER_SAMPLE_RATE
+import metrics
+
+# Everything that owns a model lives here. app.py imports this module when it
+# serves requests itself (python app.py); in production mode it runs as its
+# own process (python inference.py) and the HTTP workers call it over IPC.
+
+# Set environment variable to accept TTS license agreement
+os.environ["COQUI_TOS_AGREED"] = "1"
+
+# Add safe globals for TTS model loading
+import torch.serialization
+from TTS.tts.configs.xtts_config import XttsConfig
+from TTS.tts.models.xtts import XttsAudioConfig, XttsArgs
+from TTS.config.shared_configs import BaseDatasetConfig
+
+# Fallback if some classes are not available
+torch.serialization.add_safe_globals([
+    XttsConfig,
+    XttsAudioConfig,
+    BaseDatasetConfig,
+    XttsArgs
+])
+
+logger = logging.getLogger(__name__)
+
+# Only login to Hugging Face if token is provided
+hf_token = os.getenv("HUGGING_FACE_TOKEN")
+if hf_token:
+    logger.info("Logging in to Hugging Face with provided token")
+    try:
+        login(token=hf_token)
+        logger.info("Successfully logged in to Hugging Face")
+    except Exception as e:
+        logger.warning(f"Failed to log in to Hugging Face: {str(e)}")
+        logger.warning("Some features may not work without Hugging Face authentication")
+else:
+    logger.warning("No Hugging Face token provided. Some features may not work.")
+
+# Check CUDA availability
+if torch.cuda.is_available():
+    device = torch.device("cuda")
+    logger.info("CUDA available: True")
+    logger.info(f"CUDA version: {torch.version.cuda}")
+else:
+    device = torch.device("cpu")
+    logger.info("CUDA available: False")
+
+# CPU threads for torch ops. TORCH_NUM_THREADS is the default for every
+# model; WHISPER_NUM_THREADS, SDXL_NUM_THREADS and XTTS_NUM_THREADS override
+# it per model (animations run with SDXL's). torch's setting is process wide, so it is applied each time a
+# model is leased and models running at the same time share the latest value.
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", "4"))
+MODEL_THREADS = {
+    name: int(os.getenv(f"{name.upper()}_NUM_THREADS", str(TORCH_NUM_THREADS)))
+    for name in ('whisper', 'sdxl', 'xtts')
+}
+torch.set_num_threads(TORCH_NUM_THREADS)
+if os.getenv("TORCH_NUM_INTEROP_THREADS"):
+    torch.set_num_interop_threads(int(os.getenv("TORCH_NUM_INTEROP_THREADS")))
+
+models = ModelRegistry()
+
+# Whisper, SDXL and XTTS share the GPU. Every use of a model takes a lease from
+# the memory governor, which moves it onto the GPU and offloads (or, with
+# GPU_EVICTION_POLICY=unload, drops) the least recently used idle models when
+# the lease does not fit in the budget. It is a no-op on CPU-only hosts.
+gpu_budget_mb = os.getenv("GPU_MEMORY_BUDGET_MB")
+if gpu_budget_mb is None and device.type == "cuda":
+    gpu_budget_mb = torch.cuda.get_device_properties(device).total_memory * float(os.getenv("GPU_MEMORY_FRACTION", "0.9")) / 2**20
+memory_governor = MemoryGovernor(
+    models,
+    device,
+    budget_bytes=int(float(gpu_budget_mb) * 2**20) if gpu_budget_mb is not None else None,
+    policy=os.getenv("GPU_EVICTION_POLICY", "offload"),
+    enabled=os.getenv("GPU_MEMORY_GOVERNOR", "1") == "1" and device.type == "cuda"
+)
+
+# TORCH_PROFILER=1 enables one-shot profiler captures (POST /debug/profile)
+profiler = metrics.ProfilerToggle(
+    os.getenv("TORCH_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "ai-engine-profiles")),
+    enabled=os.getenv("TORCH_PROFILER", "0") == "1"
+)
+
+# Model work takes turns on the GPU: transcriptions before speech before
+# images, fairly between games (tenants), and work still queued at its
+# deadline is dropped. SDXL hands over its slot between denoising steps when
+# a transcription or utterance is waiting and fits in memory next to it.
+# GPU_SCHEDULER_SLOTS runs that many models at once. On by default with CUDA;
+# GPU_SCHEDULER=1 turns it on for CPU too (e.g. with the stub models).
+gpu_scheduler = GpuScheduler(
+    slots=int(os.getenv("GPU_SCHEDULER_SLOTS", "1")),
+    enabled=os.getenv("GPU_SCHEDULER", "1" if device.type == "cuda" else "0") == "1",
+    can_preempt=memory_governor.fits
+)
+
+# Images and animations run on the same SDXL modules (an animation swaps the
+# scheduler config and upcasts the VAE), so only one of them uses them at a time
+sdxl_modules = threading.Lock()
+
+@contextmanager
+def lease(name, units=1, tenants=(), deadline=None):
+    # The model's run time (not the wait for the lease) is the <model>_run
+    # stage. The model is loaded before queueing for the GPU, so a load does
+    # not hold a slot.
+    models.get(name)
+    with gpu_scheduler.run(name, tenants, deadline), sdxl_modules if name == 'sdxl' else nullcontext():
+        torch.set_num_threads(MODEL_THREADS[name])
+        with memory_governor.lease(name, units=units) as model, profiler.capture(name), metrics.span(f"{name}_run"):
+            yield model
+
+@contextmanager
+def animation_lease(tenants=(), deadline=None):
+    # One GPU slot for the SDXL modules and the motion UNet together
+    models.get('sdxl')
+    models.get('animation')
+    with gpu_scheduler.run('animation', tenants, deadline), sdxl_modules:
+        torch.set_num_threads(MODEL_THREADS['sdxl'])
+        with memory_governor.lease('sdxl') as sdxl, memory_governor.lease('animation') as motion_unet, \
+                profiler.capture('animation'), metrics.span('animation_run'):
+            yield sdxl, motion_unet
+
+# With the governor enabled, models are loaded into CPU memory and only moved
+# to the GPU when a request leases them
+load_device = torch.device("cpu") if memory_governor.enabled else device
+
+# SDXL_CPU_OFFLOAD=1 keeps SDXL on CPU and streams one sub-model at a time to
+# the GPU instead (slow, for GPUs that cannot hold the whole pipeline)
+SDXL_CPU_OFFLOAD = os.getenv("SDXL_CPU_OFFLOAD", "0") == "1"
+
+# Models are loaded on demand the first time an endpoint needs them
+def load_whisper():
+    processor = WhisperProcessor.from_pretrained("openai/whisper-small")
+    model = WhisperForConditionalGeneration.from_pretrained("openai/whisper-small", low_cpu_mem_usage=True).to(load_device)
+    return processor, model
+
+# Must match the model id the image store keys its images by (app.py)
+SDXL_MODEL_ID = os.getenv("SDXL_MODEL_ID", "stabilityai/stable-diffusion-xl-base-1.0")
+
+def load_sdxl():
+    sdxl_pipe = AutoPipelineForText2Image.from_pretrained(SDXL_MODEL_ID, torch_dtype=torch.float16, variant="fp16")
+    sdxl_pipe.scheduler = DPMSolverMultistepScheduler.from_config(sdxl_pipe.scheduler.config)
+    if SDXL_CPU_OFFLOAD and device.type == "cuda":
+        sdxl_pipe.enable_model_cpu_offload()
+    else:
+        sdxl_pipe.to(load_device)
+    return sdxl_pipe
+
+# Speaker conditioning for the reference voices is computed once per voice and
+# persisted next to the samples (XTTS_LATENT_CACHE_DIR="" keeps it in memory only)
+voice_latents = VoiceLatentStore("voice_samples", os.getenv("XTTS_LATENT_CACHE_DIR", "voice_samples/.latents") or None)
+
+def load_xtts():
+    tts = TTS(model_name="tts_models/multilingual/multi-dataset/xtts_v2", progress_bar=False).to(load_device)
+    if os.getenv("XTTS_PRECOMPUTE_LATENTS", "0") == "1":
+        voice_latents.preload(tts.synthesizer.tts_model)
+    return tts
+
+# AnimateDiff motion modules for SDXL
+ANIMATION_ADAPTER_ID = os.getenv("ANIMATION_ADAPTER_ID", "guoyww/animatediff-motion-adapter-sdxl-beta")
+
+def load_animation(sdxl_pipe):
+    # The SDXL UNet with the motion modules inserted. It is a copy of the UNet
+    # weights; the text encoders, tokenizers and VAE stay SDXL's own.
+    adapter = MotionAdapter.from_pretrained(ANIMATION_ADAPTER_ID, torch_dtype=torch.float16)
+    return UNetMotionModel.from_unet2d(sdxl_pipe.unet, adapter).to(load_device)
+
+# MODEL_LOADERS names a module whose load_whisper/load_sdxl/load_xtts/
+# load_animation replace the loaders above, e.g. MODEL_LOADERS=benchmarks.stub_models
+# for the tiny random-weight stand-ins the load test runs on
+loaders = {'whisper': load_whisper, 'sdxl': load_sdxl, 'xtts': load_xtts, 'animation': load_animation}
+if os.getenv("MODEL_LOADERS"):
+    loader_module = importlib.import_module(os.getenv("MODEL_LOADERS"))
+    loaders = {name: getattr(loader_module, f"load_{name}", loader) for name, loader in loaders.items()}
+    logger.info(f"Model loaders from {os.getenv('MODEL_LOADERS')}")
+
+animation_loader = loaders.pop('animation')
+for name, loader in loaders.items():
+    models.register(name, loader)
+models.register('animation', lambda: animation_loader(models.get('sdxl')))
+
+# Working memory on top of the weights (activations, VAE decode), per image
+# of an SDXL batch and per 30 s window of a Whisper batch
+memory_governor.register('whisper', move=lambda model, target: (model[0], model[1].to(target)),
+                         working_bytes=int(os.getenv("WHISPER_WORKING_MB", "256")) * 2**20)
+if not SDXL_CPU_OFFLOAD:
+    memory_governor.register('sdxl', working_bytes=int(os.getenv("SDXL_WORKING_MB", "6144")) * 2**20)
+memory_governor.register('xtts', working_bytes=int(os.getenv("XTTS_WORKING_MB", "1536")) * 2**20)
+# On top of SDXL's: the latents and activations of every frame
+memory_governor.register('animation', working_bytes=int(os.getenv("ANIMATION_WORKING_MB", "4096")) * 2**20)
+
+# Comma separated list of models to load at startup, e.g. PRELOAD_MODELS=whisper,xtts
+# (use "all" to preload every model)
+preload_models = os.getenv("PRELOAD_MODELS", "")
+if preload_models.strip() == "all":
+    models.preload(models.names())
+else:
+    models.preload([name.strip() for name in preload_models.split(",")])
+
+# Concurrent transcriptions are grouped into one Whisper generate() call
+whisper_batcher = WhisperBatcher(
+    lambda rows, tenants, deadline: lease('whisper', units=rows, tenants=tenants, deadline=deadline),
+    max_batch_size=int(os.getenv("WHISPER_MAX_BATCH_SIZE", "8")),
+    max_wait_ms=float(os.getenv("WHISPER_MAX_WAIT_MS", "20")),
+    order=gpu_scheduler.fair_order
+)
+
+IMAGE_SCHEDULERS = {
+    'dpmpp_2m': lambda config: DPMSolverMultistepScheduler.from_config(config),
+    'dpmpp_2m_karras': lambda config: DPMSolverMultistepScheduler.from_config(config, use_karras_sigmas=True),
+    'euler_a': lambda config: EulerAncestralDiscreteScheduler.from_config(config)
+}
+
+# Concurrent SDXL requests with the same size, steps and guidance are rendered
+# as one batch; text encoder outputs are cached per prompt
+image_batcher = ImageBatcher(
+    lambda batch_size, tenants, deadline: lease('sdxl', units=batch_size, tenants=tenants, deadline=deadline),
+    max_batch_size=int(os.getenv("IMAGE_MAX_BATCH_SIZE", "2")),
+    max_wait_ms=float(os.getenv("IMAGE_MAX_WAIT_MS", "50")),
+    embedding_cache=TTLCache(
+        max_items=int(os.getenv("IMAGE_EMBEDDING_CACHE_ITEMS", "256")),
+        ttl=int(os.getenv("IMAGE_EMBEDDING_CACHE_TTL", str(24 * 3600)))
+    ),
+    schedulers=IMAGE_SCHEDULERS,
+    # Shares the SDXL modules, so refining needs no extra memory
+    image_to_image=AutoPipelineForImage2Image.from_pipe,
+    order=gpu_scheduler.fair_order,
+    checkpoint=gpu_scheduler.checkpoint
+)
+
+# Image jobs of every HTTP worker, so any worker can answer a poll
+job_board = JobBoard(result_ttl=int(os.getenv("IMAGE_JOB_RESULT_TTL", "600")))
+
+# Story summaries and windows of every HTTP worker, so all of them send the
+# same prompt prefix for a game
+story_board = StoryBoard(
+    max_games=int(os.getenv("STORY_CONTEXT_MAX_GAMES", "1024")),
+    ttl=int(os.getenv("STORY_CONTEXT_TTL", str(24 * 3600)))
+)
+
+def transcribe(samples, language, tenant=None, deadline=None):
+    # samples: mono float32 at 16 kHz. The batcher moves the features to the
+    # STT device and runs generate together with any other requests waiting
+    # for the same language. tenant (a game) and deadline (time.time()) are
+    # for the GPU scheduler.
+    whisper_processor, _ = models.get('whisper')
+    with metrics.span('whisper_features'):
+        input_features = whisper_processor(samples, sampling_rate=WHISPER_SAMPLE_RATE, return_tensors="pt").input_features
+    with metrics.span('whisper_generate'):
+        return whisper_batcher.transcribe(input_features, language, tenant=tenant, deadline=deadline)
+
+def transcribe_windows(windows, language, tenant=None, deadline=None):
+    # Several windows (sample arrays) of one recording, kept in one batch;
+    # returns one transcript per window
+    whisper_processor, _ = models.get('whisper')
+    with metrics.span('whisper_features'):
+        input_features = whisper_processor(windows, sampling_rate=WHISPER_SAMPLE_RATE, return_tensors="pt").input_features
+    with metrics.span('whisper_generate'):
+        return whisper_batcher.transcribe_batch(input_features, language, tenant=tenant, deadline=deadline)
+
+# Identical renders and utterances in flight (from any HTTP worker) run once
+render_flight = SingleFlight('sdxl_render')
+speech_flight = SingleFlight('xtts_synthesis')
+
+def render_image(prompt, negative_prompt=None, init_image=None, on_step=None, cancelled=None, tenant=None, deadline=None, **settings):
+    # Returns PNG bytes. init_image (PNG bytes) is refined instead of
+    # generating from scratch. The batcher's thread only runs the pipeline;
+    # the PNG is encoded here, on the calling thread. A render identical to
+    # one in flight waits for it; the shared render reports its progress to
+    # every caller and is only cancelled once all of them have cancelled.
+    # Unseeded renders are meant to differ, so they never share. A shared
+    # render is scheduled for the tenant and deadline of its first caller.
+    key = cache_key('render', prompt, negative_prompt, hashlib.sha256(init_image).hexdigest() if init_image else None, settings)
+    seeded = settings.get('seed') is not None
+    settings = dict(settings, tenant=tenant, deadline=deadline)
+    if not seeded:
+        return _render_image(prompt, negative_prompt, init_image, on_step, cancelled, settings)
+    return render_flight.do(
+        key,
+        lambda flight: _render_image(prompt, negative_prompt, init_image, flight.on_step, flight.cancelled, settings),
+        on_step=on_step,
+        cancelled=cancelled
+    )
+
+def _render_image(prompt, negative_prompt, init_image, on_step, cancelled, settings):
+    with metrics.span('sdxl_render'):
+        image = image_batcher.generate(
+            prompt,
+            negative_prompt,
+            init_image=Image.open(BytesIO(init_image)) if init_image else None,
+            on_step=on_step,
+            cancelled=cancelled,
+            **settings
+        )
+    with metrics.span('image_encode'):
+        return encode_image(image, 'png')
+
+def xtts_synthesize(text, voice, language, tenant=None, deadline=None):
+    return speech_flight.do(cache_key('xtts', text, voice, language),
+                            lambda flight: _xtts_synthesize(text, voice, language, tenant, deadline))
+
+def _xtts_synthesize(text, voice, language, tenant, deadline):
+    # Runs XTTS directly with the cached conditioning latents of the voice, so
+    # the reference WAV is not decoded and re-encoded for every utterance
+    with metrics.span('xtts_synthesis'), lease('xtts', tenants=[tenant], deadline=deadline) as tts:
+        xtts_model = tts.synthesizer.tts_model
+        gpt_cond_latent, speaker_embedding = voice_latents.get(voice, xtts_model)
+        config = xtts_model.config
+        output = xtts_model.inference(
+            text,
+            language[:2],
+            gpt_cond_latent.to(xtts_model.device),
+            speaker_embedding.to(xtts_model.device),
+            temperature=config.temperature,
+            length_penalty=config.length_penalty,
+            repetition_penalty=config.repetition_penalty,
+            top_k=config.top_k,
+            top_p=config.top_p
+        )
+    wav = output['wav']
+    if torch.is_tensor(wav):
+        wav = wav.squeeze().cpu().numpy()
+    return np.asarray(wav, dtype=np.float32)
+
+# AnimateDiff's motion modules are trained with this schedule
+def animation_scheduler(config):
+    return DDIMScheduler.from_config(config, clip_sample=False, timestep_spacing='linspace', beta_schedule='linear', steps_offset=1)
+
+animation_pipelines = {}
+
+def animation_pipeline(sdxl_pipe, motion_unet):
+    # An AnimateDiff pipeline over SDXL's text encoders, tokenizers and VAE;
+    # rebuilt only when one of the models was reloaded
+    pipe = animation_pipelines.get('pipe')
+    if pipe is None or pipe.unet is not motion_unet or pipe.vae is not sdxl_pipe.vae or pipe.text_encoder is not sdxl_pipe.text_encoder:
+        pipe = AnimateDiffSDXLPipeline(
+            vae=sdxl_pipe.vae,
+            text_encoder=sdxl_pipe.text_encoder,
+            text_encoder_2=sdxl_pipe.text_encoder_2,
+            tokenizer=sdxl_pipe.tokenizer,
+            tokenizer_2=sdxl_pipe.tokenizer_2,
+            unet=motion_unet,
+            motion_adapter=None,
+            scheduler=animation_scheduler(sdxl_pipe.scheduler.config)
+        )
+        pipe.set_progress_bar_config(disable=True)
+        animation_pipelines['pipe'] = pipe
+    return pipe
+
+def decode_animation(pipe, latents, frames_per_decode, on_frame):
+    # Decodes video latents (batch, channels, frames, height, width) to PIL
+    # frames, frames_per_decode frames per VAE call, handing each frame to
+    # on_frame as soon as it is decoded
+    vae = pipe.vae
+    upcast = vae.dtype == torch.float16 and vae.config.force_upcast
+    if upcast:
+        vae.to(dtype=torch.float32)
+    try:
+        latents = latents[0].permute(1, 0, 2, 3) / vae.config.scaling_factor
+        for start in range(0, latents.shape[0], frames_per_decode):
+            chunk = latents[start:start + frames_per_decode].to(vae.device, vae.dtype)
+            with torch.no_grad():
+                decoded = vae.decode(chunk).sample
+            for frame in pipe.video_processor.postprocess(decoded.float(), output_type='pil'):
+                on_frame(frame)
+    finally:
+        if upcast:
+            vae.to(dtype=torch.float16)
+
+def animate(prompt, negative_prompt=None, width=1024, height=1024, frames=16, steps=20, guidance_scale=8.0, seed=None,
+            vae_slicing=True, on_step=None, cancelled=None, tenant=None, deadline=None):
+    # Renders an AnimateDiff clip and returns its frames as JPEG bytes.
+    # Progress counts the denoising steps, then one step per decoded frame:
+    # on_step(step, total, frame) gets every frame as soon as it is decoded.
+    # vae_slicing decodes one frame at a time (least memory, the first frame
+    # arrives soonest), otherwise every frame goes through the VAE at once.
+    total = steps + frames
+    generator = torch.Generator('cpu').manual_seed(seed) if seed is not None else None
+    encoded = []
+
+    def on_step_end(pipeline, step, timestep, callback_kwargs):
+        if on_step:
+            on_step(step + 1, total)
+        if cancelled and cancelled():
+            pipeline._interrupt = True
+        elif step + 1 < steps:
+            gpu_scheduler.checkpoint()
+        return callback_kwargs
+
+    def on_frame(frame):
+        # JPEG encodes in a few ms, so the GPU slot is not held up for it
+        encoded.append(encode_image(frame, 'jpeg', quality=92))
+        if on_step:
+            on_step(steps + len(encoded), total, encoded[-1])
+
+    with metrics.span('animation_render'), animation_lease([tenant], deadline) as (sdxl_pipe, motion_unet):
+        pipe = animation_pipeline(sdxl_pipe, motion_unet)
+        with torch.no_grad():
+            latents = pipe(
+                prompt=prompt,
+                negative_prompt=negative_prompt,
+                num_frames=frames,
+                width=width,
+                height=height,
+                num_inference_steps=steps,
+                guidance_scale=guidance_scale,
+                generator=generator,
+                output_type='latent',
+                callback_on_step_end=on_step_end
+            ).frames
+        if cancelled and cancelled():
+            raise CancelledError()
+        decode_animation(pipe, latents, 1 if vae_slicing else frames, on_frame)
+    return encoded
+
+def model_status():
+    return models.status()
+
+def is_ready(name):
+    return models.is_ready(name)
+
+def memory_stats():
+    return memory_governor.stats()
+
+def image_batch_stats():
+    return image_batcher.stats()
+
+def scheduler_stats():
+    return gpu_scheduler.stats()
+
+def coalescing_stats():
+    return {'sdxl_render': render_flight.stats(), 'xtts_synthesis': speech_flight.stats()}
+
+def gpu_memory():
+    if device.type != "cuda":
+        return {}
+    return {
+        ('allocated',): torch.cuda.memory_allocated(device),
+        ('reserved',): torch.cuda.memory_reserved(device),
+        ('governor_leased',): memory_governor.used_bytes(),
+        ('governor_budget',): memory_governor.budget_bytes
+    }
+
+metrics.REGISTRY.gauge('batcher_pending', 'Requests waiting for a model batch', lambda: {
+    ('whisper',): len(whisper_batcher._pending),
+    ('sdxl',): len(image_batcher._pending)
+}, ('model',))
+metrics.REGISTRY.gauge('gpu_queue_depth', 'Model runs waiting for a GPU slot', lambda: {
+    (name,): waiting for name, waiting in gpu_scheduler.stats()['waiting'].items()
+}, ('model',))
+metrics.REGISTRY.gauge('gpu_memory_bytes', 'GPU memory by kind', gpu_memory, ('kind',))
+metrics.REGISTRY.gauge('model_loaded', '1 when the model is loaded', lambda: {
+    (name,): int(models.is_ready(name)) for name in models.names()
+}, ('model',))
+
+# HTTP workers push their metrics here, so a scrape of any worker sees all
+metrics_hub = metrics.MetricsHub(metrics.REGISTRY)
+
+# What the HTTP workers can call in production mode
+CALLS = {
+    'transcribe': transcribe,
+    'transcribe_windows': transcribe_windows,
+    'render_image': render_image,
+    'xtts_synthesize': xtts_synthesize,
+    'animate': animate,
+    'model_status': model_status,
+    'is_ready': is_ready,
+    'memory_stats': memory_stats,
+    'image_batch_stats': image_batch_stats,
+    'coalescing_stats': coalescing_stats,
+    'scheduler_stats': scheduler_stats,
+    'job_board.publish': job_board.publish,
+    'job_board.get': job_board.get,
+    'job_board.add_frame': job_board.add_frame,
+    'job_board.frames': job_board.frames,
+    'job_board.cancel': job_board.cancel,
+    'story_board.plan': story_board.plan,
+    'story_board.state': story_board.state,
+    'story_board.finish': story_board.finish,
+    'story_board.stats': story_board.stats,
+    'metrics.push': metrics_hub.push,
+    'metrics.snapshot': metrics_hub.snapshot,
+    'profiler.arm': profiler.arm,
+    'profiler.stats': profiler.stats
+}
+
+if __name__ == '__main__':
+    from inference_ipc import InferenceServer
+    logging.basicConfig(level=logging.INFO)
+    InferenceServer(
+        CALLS,
+        os.getenv("INFERENCE_ADDRESS", "/tmp/ai-engine-inference.sock"),
+        authkey=os.getenv("INFERENCE_AUTHKEY", "").encode('utf-8') or None,
+        threads=int(os.getenv("INFERENCE_THREADS", "32"))
+    ).serve_forever()
@@ -0,0 +1,254 @@
+import itertools
+import logging
+import os
+import pickle
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Listener, Client
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Messages, as pickled tuples over a multiprocessing connection:
+#   front end -> inference  ('call', call_id, name, args, kwargs, progress, trace_id)
+#                           ('cancel', call_id)
+#   inference -> front end  ('progress', call_id, step, total, *extra)
+#                           ('result', call_id, value, stages)
+#                           ('error', call_id, exception, stages)
+# stages are the (stage, seconds) spans the call recorded, added to the
+# caller's trace.
+
+
+def require_authkey(authkey):
+    # Messages are pickles, and unpickling runs code: without the handshake
+    # anyone who can reach the address could run code in the other process
+    if not authkey:
+        raise ValueError("The inference connection needs an authkey (set INFERENCE_AUTHKEY)")
+    return authkey
+
+
+def parse_address(address):
+    # "host:port" for TCP, anything else is a Unix socket path
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+class InferenceServer:
+    # Runs in the inference process and serves its model calls to the HTTP
+    # front end workers, one connection per worker. Every call runs on its
+    # own pool thread, so concurrent calls still meet in the batchers.
+
+    def __init__(self, calls, address, authkey=None, threads=32):
+        self.calls = calls
+        self.address = parse_address(address)
+        self.authkey = require_authkey(authkey)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='inference-call')
+
+    def serve_forever(self):
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            # Left behind by a previous run that did not shut down cleanly
+            os.unlink(self.address)
+        with Listener(self.address, authkey=self.authkey) as listener:
+            logger.info(f"Inference server listening on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    logger.warning(f"Rejected inference connection: {str(e)}")
+                    continue
+                threading.Thread(target=self._serve_connection, args=(conn,), name='inference-connection', daemon=True).start()
+
+    def _serve_connection(self, conn):
+        send_lock = threading.Lock()
+        cancel_events = {}
+
+        def send(message):
+            with send_lock:
+                try:
+                    conn.send(message)
+                except (pickle.PicklingError, TypeError, AttributeError) as e:
+                    # Results and exceptions that cannot cross the process boundary
+                    conn.send(('error', message[1], RuntimeError(f"Unpicklable inference reply: {str(e)}"), message[3]))
+
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                # The worker went away, stop whatever it was waiting for
+                for event in list(cancel_events.values()):
+                    event.set()
+                conn.close()
+                return
+
+            if message[0] == 'cancel':
+                event = cancel_events.get(message[1])
+                if event is not None:
+                    event.set()
+                continue
+
+            _, call_id, name, args, kwargs, progress, trace_id = message
+            cancel_events[call_id] = threading.Event()
+            self._executor.submit(self._call, send, cancel_events, call_id, name, args, kwargs, progress, trace_id)
+
+    def _call(self, send, cancel_events, call_id, name, args, kwargs, progress, trace_id):
+        event = cancel_events[call_id]
+        with metrics.trace(trace_id) as trace:
+            try:
+                if progress:
+                    kwargs = dict(kwargs, on_step=lambda step, total=None, *extra: send(('progress', call_id, step, total) + extra), cancelled=event.is_set)
+                result = self.calls[name](*args, **kwargs)
+                send(('result', call_id, result, trace.stages))
+            except Exception as e:
+                send(('error', call_id, e, trace.stages))
+            finally:
+                cancel_events.pop(call_id, None)
+
+
+class RemoteCall:
+    # client.transcribe(...) calls "transcribe" in the inference process;
+    # client.job_board.get(...) calls "job_board.get"
+
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __call__(self, *args, **kwargs):
+        return self._client.call(self._name, *args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return RemoteCall(self._client, f"{self._name}.{name}")
+
+
+class InferenceClient:
+    # Used by the HTTP front end workers instead of the models. Connects
+    # lazily (so it is safe to create before a fork) and reconnects after the
+    # inference process restarts. Progress callbacks run on the calling
+    # thread, never on the connection's reader thread. Status calls (what
+    # /health asks) try to connect once and fail fast instead of waiting for
+    # the inference process to come up.
+
+    def __init__(self, address, authkey=None, timeout=None, connect_timeout=60, poll_interval=0.5,
+                 status_calls=('model_status', 'is_ready'), status_timeout=5):
+        self.address = parse_address(address)
+        self.authkey = require_authkey(authkey)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.status_calls = set(status_calls)
+        self.status_timeout = status_timeout
+        self.poll_interval = poll_interval
+        self._conn = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._ids = itertools.count()
+        self.calls = 0
+        self.errors = 0
+
+    def call(self, name, *args, on_step=None, cancelled=None, **kwargs):
+        # With on_step or cancelled, the remote function gets its own on_step
+        # and cancelled arguments, relayed to these while the call runs
+        progress = on_step is not None or cancelled is not None
+        status = name in self.status_calls
+        timeout = self.status_timeout if status else self.timeout
+        call_id = next(self._ids)
+        replies = queue.Queue()
+        conn = self._connection(wait=not status)
+        self._pending[call_id] = (conn, replies)
+        trace = metrics.current_trace()
+        try:
+            self._send(conn, ('call', call_id, name, args, kwargs, progress, trace.trace_id if trace else None))
+            deadline = time.monotonic() + timeout if timeout else None
+            cancel_sent = False
+            while True:
+                if deadline is not None and time.monotonic() > deadline:
+                    self._send(conn, ('cancel', call_id))
+                    raise TimeoutError(f"Inference call {name} timed out after {timeout} s")
+                try:
+                    reply = replies.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    reply = None
+
+                if reply is not None and reply[0] == 'progress':
+                    if on_step:
+                        on_step(reply[2], reply[3], *reply[4:])
+                elif reply is not None:
+                    self.calls += 1
+                    if trace is not None:
+                        for stage, seconds in reply[3]:
+                            trace.add(stage, seconds)
+                    if reply[0] == 'error':
+                        self.errors += 1
+                        raise reply[2]
+                    return reply[2]
+
+                if cancelled and not cancel_sent and cancelled():
+                    self._send(conn, ('cancel', call_id))
+                    cancel_sent = True
+        finally:
+            self._pending.pop(call_id, None)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return RemoteCall(self, name)
+
+    def stats(self):
+        return {'address': str(self.address), 'connected': self._conn is not None, 'calls': self.calls,
+                'errors': self.errors, 'in_flight': len(self._pending)}
+
+    def _send(self, conn, message):
+        with self._send_lock:
+            conn.send(message)
+
+    def _connection(self, wait=True):
+        # With wait, keeps trying for connect_timeout while the inference
+        # process may still be importing its libraries; otherwise tries once.
+        # The lock is only held to install the connection, so a waiting call
+        # never holds up the others
+        deadline = time.monotonic() + (self.connect_timeout if wait else 0)
+        while True:
+            conn = self._conn
+            if conn is not None:
+                return conn
+            try:
+                conn = Client(self.address, authkey=self.authkey)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() >= deadline:
+                    raise ConnectionError(f"Inference server at {self.address} is not reachable")
+                time.sleep(0.5)
+
+        with self._lock:
+            if self._conn is not None:
+                # Another call connected first
+                conn.close()
+                return self._conn
+            self._conn = conn
+        threading.Thread(target=self._read, args=(conn,), name='inference-reader', daemon=True).start()
+        return conn
+
+    def _read(self, conn):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            pending = self._pending.get(message[1])
+            if pending is not None:
+                pending[1].put(message)
+
+        logger.warning("Lost the connection to the inference server")
+        with self._lock:
+            if self._conn is conn:
+                self._conn = None
+        # Pending calls on this connection will never get their reply
+        for call_id, (pending_conn, replies) in list(self._pending.items()):
+            if pending_conn is conn:
+                replies.put(('error', call_id, ConnectionError("Inference server connection lost"), []))
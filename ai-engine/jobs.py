@@ -0,0 +1,307 @@
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+job_wait_seconds = metrics.REGISTRY.histogram('job_wait_seconds', 'Time jobs spent queued', ('kind',))
+job_seconds = metrics.REGISTRY.histogram('job_seconds', 'Job run time by outcome', ('kind', 'status'))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, kind, payload, board=None, trace_id=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.payload = payload
+        self.status = QUEUED
+        self.step = 0
+        self.total_steps = None
+        self.result = None
+        self.partial_result = None
+        # Outputs produced one at a time (e.g. animation frames), read from an
+        # offset by clients while the job runs
+        self.frames = []
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.board = board
+        # The trace of the request that submitted the job, continued by the job
+        self.trace_id = trace_id
+        self._cancel = threading.Event()
+
+    @property
+    def cancel_requested(self):
+        return self._cancel.is_set()
+
+    def set_progress(self, step, total_steps=None):
+        self.step = step
+        if total_steps is not None:
+            self.total_steps = total_steps
+        if self.total_steps:
+            self.publish({'progress': {'step': self.step, 'total': self.total_steps}})
+
+    def set_partial_result(self, result):
+        # An intermediate result (e.g. a preview image) served while the job
+        # keeps running; replaced by the final result when it is done
+        self.partial_result = result
+        self.publish({'partial_result': result})
+
+    def add_frame(self, frame):
+        # Appends one output; only that one is sent to the job board
+        self.frames.append(frame)
+        if self.board is None:
+            return
+        try:
+            if self.board.add_frame(self.id, len(self.frames) - 1, frame):
+                self._cancel.set()
+        except Exception as e:
+            logger.warning(f"Could not publish a frame of job {self.id}: {str(e)}")
+
+    def publish(self, fields=None):
+        # Sends the changed fields (everything by default) to the job board,
+        # which answers whether another worker asked to cancel the job
+        if self.board is None:
+            return
+        try:
+            if self.board.publish(self.id, fields or self.to_dict()):
+                self._cancel.set()
+        except Exception as e:
+            logger.warning(f"Could not publish job {self.id}: {str(e)}")
+
+    def check_cancelled(self):
+        # Handlers call this between units of work to stop early
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def to_dict(self):
+        job = {
+            'job_id': self.id,
+            'type': self.kind,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+        if self.total_steps:
+            job['progress'] = {'step': self.step, 'total': self.total_steps}
+        if self.frames:
+            job['frame_count'] = len(self.frames)
+        if self.status == DONE:
+            job['result'] = self.result
+        elif self.partial_result is not None:
+            job['partial_result'] = self.partial_result
+        if self.error:
+            job['error'] = self.error
+        return job
+
+
+class JobBoard:
+    # Snapshots (to_dict() form) of the jobs of several processes. With more
+    # than one HTTP worker a job only lives in the worker that accepted it;
+    # the workers publish their jobs here (the inference process hosts the
+    # board) so any of them can answer a poll or a cancel for it.
+
+    def __init__(self, result_ttl=600):
+        self.result_ttl = result_ttl
+        self._jobs = {}
+        self._frames = {}
+        self._cancelled = set()
+        self._lock = threading.Lock()
+
+    def publish(self, job_id, fields):
+        # Returns True when the job should stop
+        with self._lock:
+            self._prune()
+            job = self._jobs.setdefault(job_id, {'job_id': job_id})
+            job.update(fields)
+            if job.get('status') in (DONE, FAILED, CANCELLED):
+                job.pop('partial_result', None)
+                self._cancelled.discard(job_id)
+                return False
+            return job_id in self._cancelled
+
+    def add_frame(self, job_id, index, frame):
+        # Stores frame index of a job; returns True when the job should stop
+        with self._lock:
+            frames = self._frames.setdefault(job_id, [])
+            frames.extend([None] * (index + 1 - len(frames)))
+            frames[index] = frame
+            job = self._jobs.setdefault(job_id, {'job_id': job_id})
+            job['frame_count'] = len(frames)
+            return job_id in self._cancelled
+
+    def get(self, job_id):
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def frames(self, job_id, start=0):
+        # Frames [start:] of a job, None for an unknown job
+        with self._lock:
+            if job_id not in self._jobs:
+                return None
+            return self._frames.get(job_id, [])[start:]
+
+    def cancel(self, job_id):
+        # The worker running the job stops at its next published update
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job.get('status') in (QUEUED, RUNNING):
+                self._cancelled.add(job_id)
+            return dict(job)
+
+    def _prune(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.get('finished_at') is not None and now - job['finished_at'] > self.result_ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+            self._frames.pop(job_id, None)
+
+
+class JobQueue:
+    # Bounded FIFO of jobs processed by dedicated worker threads (one by
+    # default), so GPU work never runs inside an HTTP request thread. Finished
+    # jobs are kept for result_ttl seconds for clients to poll. With a board,
+    # jobs are also published there and jobs of other processes can be read
+    # and cancelled through it.
+
+    def __init__(self, max_queued=8, result_ttl=600, name='job-worker', workers=1, board=None):
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self.name = name
+        self.workers = max(1, workers)
+        self.board = board
+        self._handlers = {}
+        self._jobs = {}
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._workers = []
+
+    def register(self, kind, handler):
+        # handler(job) returns the job result; it may call job.set_progress()
+        # and job.check_cancelled() while it runs
+        self._handlers[kind] = handler
+
+    def submit(self, kind, payload):
+        if kind not in self._handlers:
+            raise KeyError(f"Unknown job type: {kind}")
+        with self._condition:
+            self._prune()
+            if len(self._queue) >= self.max_queued:
+                raise QueueFull(f"{len(self._queue)} jobs already queued")
+            trace = metrics.current_trace()
+            job = Job(kind, payload, self.board, trace.trace_id if trace else None)
+            self._jobs[job.id] = job
+            self._queue.append(job)
+            self._ensure_worker()
+            self._condition.notify()
+        job.publish()
+        return job
+
+    def get(self, job_id):
+        with self._condition:
+            self._prune()
+            return self._jobs.get(job_id)
+
+    def snapshot(self, job_id):
+        # to_dict() of a job of this queue, or of another process's job from the board
+        job = self.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        return self.board.get(job_id) if self.board is not None else None
+
+    def frames(self, job_id, start=0):
+        # Frames [start:] of a job of this queue, or of another process's job
+        # from the board; None for an unknown job
+        job = self.get(job_id)
+        if job is not None:
+            return job.frames[start:]
+        return self.board.frames(job_id, start) if self.board is not None else None
+
+    def cancel(self, job_id):
+        # Returns the job's snapshot, or None for an unknown job
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                if job.status == QUEUED:
+                    self._queue.remove(job)
+                    self._finish(job, CANCELLED)
+                elif job.status == RUNNING:
+                    # The handler notices at its next progress checkpoint
+                    job._cancel.set()
+        if job is not None:
+            return job.to_dict()
+        return self.board.cancel(job_id) if self.board is not None else None
+
+    def depth(self):
+        return len(self._queue)
+
+    def _finish(self, job, status, result=None, error=None):
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished_at = time.time()
+        job.publish()
+
+    def _prune(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.result_ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _ensure_worker(self):
+        self._workers = [worker for worker in self._workers if worker.is_alive()]
+        while len(self._workers) < self.workers:
+            worker = threading.Thread(target=self._run, name=f"{self.name}-{len(self._workers)}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                job = self._queue.popleft()
+                job.status = RUNNING
+                job.started_at = time.time()
+
+            job_wait_seconds.labels(job.kind).observe(job.started_at - job.created_at)
+            with metrics.trace(job.trace_id) as trace:
+                try:
+                    job.publish({'status': RUNNING, 'started_at': job.started_at})
+                    job.check_cancelled()
+                    result = self._handlers[job.kind](job)
+                    job.check_cancelled()
+                    self._finish(job, DONE, result=result)
+                except JobCancelled:
+                    logger.info(f"Job {job.id} cancelled")
+                    self._finish(job, CANCELLED)
+                except Exception as e:
+                    logger.error(f"Error in {job.kind} job {job.id}: {str(e)}")
+                    self._finish(job, FAILED, error=str(e))
+            job_seconds.labels(job.kind, job.status).observe(job.finished_at - job.started_at)
+            logger.info(f"Job {job.id} {job.status} trace={trace.trace_id} stages={trace.stage_ms()}")
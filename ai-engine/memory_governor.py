@@ -0,0 +1,210 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# What happens to the least recently used idle model when a lease needs room
+OFFLOAD = 'offload'  # moved to CPU memory, moved back on its next lease
+UNLOAD = 'unload'  # dropped from the registry, loaded again on its next lease
+
+RESIDENT = 'resident'
+OFFLOADED = 'offloaded'
+UNLOADED = 'unloaded'
+
+
+def module_bytes(model):
+    # Parameter and buffer bytes of a model: a torch module, a diffusers
+    # pipeline (summed over its components) or a tuple of those
+    if isinstance(model, torch.nn.Module):
+        tensors = list(model.parameters()) + list(model.buffers())
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+    if isinstance(model, (tuple, list)):
+        return sum(module_bytes(part) for part in model)
+    components = getattr(model, 'components', None)
+    if isinstance(components, dict):
+        return sum(module_bytes(part) for part in components.values())
+    return 0
+
+
+def default_move(model, device):
+    return model.to(device)
+
+
+class _ManagedModel:
+    def __init__(self, name, move, working_bytes):
+        self.name = name
+        self.move = move
+        self.working_bytes = working_bytes
+        self.footprint = 0
+        self.state = UNLOADED
+        self.leases = 0
+        self.working_reserved = 0
+        self.last_used = 0.0
+        self.evictions = 0
+
+
+class MemoryGovernor:
+    # Decides which models live on the accelerator. Every use of a model goes
+    # through lease(name): the model is loaded from the registry if needed,
+    # moved onto the device, and held there until the lease ends. A lease
+    # reserves the model's weights plus its working memory (activations,
+    # VAE decode, ...); when that does not fit in the budget, the least
+    # recently used models without an active lease are offloaded to CPU (or
+    # unloaded). If nothing can be evicted the lease waits for others to end.
+    #
+    # On a CPU-only host the governor is disabled and lease() just hands out
+    # the model, so nothing is moved or accounted.
+
+    def __init__(self, registry, device, budget_bytes=None, policy=OFFLOAD, enabled=None, wait_timeout=60):
+        self.registry = registry
+        self.device = torch.device(device)
+        self.enabled = self.device.type == 'cuda' if enabled is None else enabled
+        if budget_bytes is None:
+            budget_bytes = torch.cuda.get_device_properties(self.device).total_memory if self.enabled and self.device.type == 'cuda' else 0
+        self.budget_bytes = budget_bytes
+        self.policy = policy
+        self.wait_timeout = wait_timeout
+        self._models = {}
+        self._condition = threading.Condition()
+        self.lease_waits = 0
+
+    def register(self, name, move=default_move, working_bytes=0):
+        # move(model, device) puts the model on a device; working_bytes is the
+        # memory one request needs on top of the weights
+        self._models[name] = _ManagedModel(name, move, working_bytes)
+
+    @contextmanager
+    def lease(self, name, units=1):
+        # units scales the working memory, e.g. the number of images in a batch
+        if not self.enabled or name not in self._models:
+            yield self.registry.get(name)
+            return
+
+        managed = self._models[name]
+        working_bytes = managed.working_bytes * units
+        while True:
+            # Loading can take minutes, so it happens without the lock; if an
+            # eviction unloads the model again meanwhile, it is loaded again
+            self.registry.get(name)
+            with self._condition:
+                model = self._acquire(managed, working_bytes)
+            if model is not None:
+                break
+        try:
+            yield model
+        finally:
+            with self._condition:
+                managed.leases -= 1
+                managed.working_reserved -= working_bytes
+                managed.last_used = time.monotonic()
+                self._condition.notify_all()
+
+    def _acquire(self, managed, working_bytes):
+        # Returns the model once its lease is granted, or None when the model
+        # is not loaded (any more) and lease() has to load it first
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            model = self.registry.loaded(managed.name)
+            if model is None:
+                return None
+            if not managed.footprint:
+                managed.footprint = module_bytes(model)
+
+            needed = working_bytes + (0 if managed.state == RESIDENT else managed.footprint)
+            self._evict_for(needed, exclude=managed)
+
+            active = [other for other in self._models.values() if other.leases and other is not managed]
+            if self.used_bytes() + needed <= self.budget_bytes or not active or time.monotonic() >= deadline:
+                if self.used_bytes() + needed > self.budget_bytes:
+                    logger.warning(f"Lease for {managed.name} exceeds the memory budget ({self.used_bytes() + needed} > {self.budget_bytes} bytes)")
+                break
+
+            # Everything left on the device is in use; wait for a lease to end
+            self.lease_waits += 1
+            self._condition.wait(max(0.0, deadline - time.monotonic()))
+
+        if managed.state != RESIDENT:
+            logger.info(f"Moving {managed.name} to {self.device} ({managed.footprint / 2**20:.0f} MiB)")
+            model = managed.move(model, self.device) or model
+            managed.state = RESIDENT
+        managed.leases += 1
+        managed.working_reserved += working_bytes
+        managed.last_used = time.monotonic()
+        return model
+
+    def _evict_for(self, needed, exclude):
+        idle = sorted(
+            (other for other in self._models.values() if other is not exclude and other.state == RESIDENT and not other.leases),
+            key=lambda other: other.last_used
+        )
+        for other in idle:
+            if self.used_bytes() + needed <= self.budget_bytes:
+                break
+            self._evict(other)
+
+    def _evict(self, managed):
+        logger.info(f"Evicting {managed.name} from {self.device} ({self.policy})")
+        if self.policy == UNLOAD:
+            self.registry.unload(managed.name)
+            managed.state = UNLOADED
+        else:
+            managed.move(self.registry.get(managed.name), torch.device('cpu'))
+            managed.state = OFFLOADED
+        managed.evictions += 1
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def fits(self, name, units=1):
+        # Whether a lease of name would fit in the budget next to the leases
+        # held now, after evicting idle models
+        if not self.enabled or name not in self._models:
+            return True
+        with self._condition:
+            managed = self._models[name]
+            needed = managed.working_bytes * units + (0 if managed.state == RESIDENT else managed.footprint)
+            evictable = sum(
+                other.footprint for other in self._models.values()
+                if other is not managed and other.state == RESIDENT and not other.leases
+            )
+            return self.used_bytes() - evictable + needed <= self.budget_bytes
+
+    def used_bytes(self):
+        # Weights of the resident models plus the working memory of the
+        # leases currently held
+        return sum(
+            (managed.footprint if managed.state == RESIDENT else 0) + managed.working_reserved
+            for managed in self._models.values()
+        )
+
+    def stats(self):
+        stats = {
+            'enabled': self.enabled,
+            'device': str(self.device),
+            'policy': self.policy,
+            'budget_bytes': self.budget_bytes,
+            'leased_bytes': self.used_bytes(),
+            'lease_waits': self.lease_waits,
+            'models': {
+                name: {
+                    'state': managed.state,
+                    'footprint_bytes': managed.footprint,
+                    'working_bytes': managed.working_bytes,
+                    'leases': managed.leases,
+                    'working_reserved_bytes': managed.working_reserved,
+                    'evictions': managed.evictions,
+                    'idle_seconds': round(time.monotonic() - managed.last_used, 1) if managed.last_used else None
+                }
+                for name, managed in self._models.items()
+            }
+        }
+        if self.enabled and self.device.type == 'cuda':
+            stats['cuda'] = {
+                'allocated_bytes': torch.cuda.memory_allocated(self.device),
+                'reserved_bytes': torch.cuda.memory_reserved(self.device),
+                'max_allocated_bytes': torch.cuda.max_memory_allocated(self.device)
+            }
+        return stats
@@ -0,0 +1,333 @@
+import contextvars
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a fast cached call to a long generation
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    # Cumulative bucket counts, like a Prometheus histogram
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, count in zip(self.buckets, self._counts):
+            if count >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'count': self.count,
+                'sum': round(self.sum, 6),
+                'buckets': {str(bound): count for bound, count in zip(self.buckets, self._counts)},
+                'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95)
+            }
+
+
+class HistogramFamily:
+    # One histogram per label combination, created on first use
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *labels):
+        histogram = self._histograms.get(labels)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(labels, Histogram(self.buckets))
+        return histogram
+
+    def items(self):
+        return list(self._histograms.items())
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class CounterFamily:
+    # One counter per label combination, created on first use
+
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *labels):
+        counter = self._counters.get(labels)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(labels, Counter())
+        return counter
+
+    def items(self):
+        return list(self._counters.items())
+
+
+class MetricsRegistry:
+    # Named metric families, exported as plain snapshots (picklable, so the
+    # processes of the production mode can merge them) and rendered in the
+    # Prometheus text format. Counters and gauges can also be read from a
+    # collect() callback returning {labels tuple: value}.
+
+    def __init__(self, prefix='ai_engine_'):
+        self.prefix = prefix
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, kind, name, help, label_names, family=None, collect=None):
+        name = self.prefix + name
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = (kind, help, tuple(label_names), family, collect)
+            return self._metrics[name][3]
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS, family=None):
+        return self._register('histogram', name, help, label_names, family or HistogramFamily(buckets))
+
+    def counter(self, name, help, label_names=(), collect=None):
+        return self._register('counter', name, help, label_names, None if collect else CounterFamily(), collect)
+
+    def gauge(self, name, help, collect, label_names=()):
+        self._register('gauge', name, help, label_names, collect=collect)
+
+    def snapshot(self):
+        # {name: {'type', 'help', 'labels', 'samples': {labels: value}}}, where
+        # a histogram value is {'buckets': [(bound, cumulative count)], 'sum', 'count'}
+        snapshot = {}
+        for name, (kind, help, label_names, family, collect) in list(self._metrics.items()):
+            samples = {}
+            if kind == 'histogram':
+                for labels, histogram in family.items():
+                    with histogram._lock:
+                        samples[labels] = {'buckets': list(zip(histogram.buckets, histogram._counts)),
+                                           'sum': histogram.sum, 'count': histogram.count}
+            elif family is not None:
+                samples = {labels: counter.value for labels, counter in family.items()}
+            else:
+                try:
+                    values = collect()
+                except Exception:
+                    continue
+                samples = values if isinstance(values, dict) else {(): values}
+            snapshot[name] = {'type': kind, 'help': help, 'labels': label_names, 'samples': samples}
+        return snapshot
+
+
+def merge_snapshots(snapshots):
+    # Sums the samples of several processes' snapshots
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for labels, value in metric['samples'].items():
+                current = target['samples'].get(labels)
+                if current is None:
+                    target['samples'][labels] = value
+                elif metric['type'] == 'histogram':
+                    target['samples'][labels] = {
+                        'buckets': [(bound, a + b) for (bound, a), (_, b) in zip(current['buckets'], value['buckets'])],
+                        'sum': current['sum'] + value['sum'],
+                        'count': current['count'] + value['count']
+                    }
+                else:
+                    target['samples'][labels] = current + value
+    return merged
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def render_prometheus(snapshot):
+    lines = []
+    for name in sorted(snapshot):
+        metric = snapshot[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for labels, value in sorted(metric['samples'].items(), key=lambda item: [str(label) for label in item[0]]):
+            if metric['type'] == 'histogram':
+                for bound, count in value['buckets']:
+                    lines.append(f"{name}_bucket{_label_text(metric['labels'], labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{_label_text(metric['labels'], labels, [('le', '+Inf')])} {value['count']}")
+                lines.append(f"{name}_sum{_label_text(metric['labels'], labels)} {value['sum']}")
+                lines.append(f"{name}_count{_label_text(metric['labels'], labels)} {value['count']}")
+            else:
+                lines.append(f"{name}{_label_text(metric['labels'], labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHub:
+    # Kept by the inference process in production mode: every HTTP worker
+    # pushes its registry snapshot here, and a scrape of any worker returns
+    # the sum over all of them. Workers that stopped pushing are dropped.
+
+    def __init__(self, registry, max_age=300):
+        self.registry = registry
+        self.max_age = max_age
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def push(self, source, snapshot):
+        with self._lock:
+            self._sources[source] = (time.monotonic(), snapshot)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            self._sources = {source: entry for source, entry in self._sources.items() if now - entry[0] <= self.max_age}
+            snapshots = [snapshot for _, snapshot in self._sources.values()]
+        return merge_snapshots([self.registry.snapshot()] + snapshots)
+
+
+# The process wide registry every module records into
+REGISTRY = MetricsRegistry()
+
+stage_seconds = REGISTRY.histogram('stage_seconds', 'Time spent per processing stage', ('stage',))
+stage_errors = REGISTRY.counter('stage_errors_total', 'Stages that raised', ('stage',))
+
+
+class Trace:
+    # Stages of one request (or job), collected across threads and processes
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.stages = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.stages.append((stage, seconds))
+
+    def stage_ms(self):
+        # Total ms per stage, in the order the stages first ran
+        totals = {}
+        with self._lock:
+            for stage, seconds in self.stages:
+                totals[stage] = totals.get(stage, 0.0) + seconds * 1000
+        return {stage: round(ms, 3) for stage, ms in totals.items()}
+
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def begin_trace(trace_id=None):
+    # Makes a new Trace current; returns it and the token for end_trace()
+    current = Trace(trace_id)
+    return current, _current_trace.set(current)
+
+
+def end_trace(token):
+    _current_trace.reset(token)
+
+
+@contextmanager
+def trace(trace_id=None):
+    # A Trace current for the block (spans inside it are recorded in it)
+    current, token = begin_trace(trace_id)
+    try:
+        yield current
+    finally:
+        end_trace(token)
+
+
+@contextmanager
+def span(stage):
+    # Times a stage into ai_engine_stage_seconds and the current trace
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        stage_errors.labels(stage).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.labels(stage).observe(elapsed)
+        current = _current_trace.get()
+        if current is not None:
+            current.add(stage, elapsed)
+
+
+class ProfilerToggle:
+    # One-shot torch profiler captures: after arm('sdxl') the next run of
+    # that model is recorded and written to <directory>/<model>-<trace>.json
+    # (Chrome trace format, open it in chrome://tracing or Perfetto)
+
+    def __init__(self, directory, enabled=False, keep=20):
+        self.directory = directory
+        self.enabled = enabled
+        self._armed = {}
+        self._captures = deque(maxlen=keep)
+        self._lock = threading.Lock()
+
+    def arm(self, model, trace_id=None):
+        if not self.enabled:
+            raise PermissionError("The torch profiler is disabled (set TORCH_PROFILER=1)")
+        with self._lock:
+            self._armed[model] = trace_id or uuid.uuid4().hex[:16]
+        return self.stats()
+
+    @contextmanager
+    def capture(self, model):
+        with self._lock:
+            trace_id = self._armed.pop(model, None)
+        if trace_id is None:
+            yield
+            return
+
+        import torch
+        from torch.profiler import profile, ProfilerActivity
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        with profile(activities=activities, record_shapes=True, profile_memory=True) as profiler:
+            yield
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{model}-{trace_id}.json")
+        profiler.export_chrome_trace(path)
+        with self._lock:
+            self._captures.append({'model': model, 'trace_id': trace_id, 'path': path, 'captured_at': time.time()})
+
+    def stats(self):
+        with self._lock:
+            return {'enabled': self.enabled, 'armed': dict(self._armed), 'captures': list(self._captures)}
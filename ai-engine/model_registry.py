@@ -0,0 +1,103 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+UNLOADED = 'unloaded'
+LOADING = 'loading'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class ModelRegistry:
+    # Keeps track of the heavy models used by the endpoints. Each model is
+    # loaded the first time it is requested, and only once even when several
+    # requests ask for it at the same time.
+
+    def __init__(self):
+        self._loaders = {}
+        self._models = {}
+        self._states = {}
+        self._errors = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, loader):
+        with self._lock:
+            self._loaders[name] = loader
+            self._states.setdefault(name, UNLOADED)
+            self._locks.setdefault(name, threading.Lock())
+
+    def names(self):
+        return list(self._loaders)
+
+    def get(self, name):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        if name not in self._loaders:
+            raise KeyError(f"Unknown model: {name}")
+
+        with self._locks[name]:
+            # Another request may have finished loading while we were waiting
+            model = self._models.get(name)
+            if model is not None:
+                return model
+
+            self._states[name] = LOADING
+            logger.info(f"Loading model: {name}")
+            try:
+                model = self._loaders[name]()
+            except Exception as e:
+                self._states[name] = FAILED
+                self._errors[name] = str(e)
+                logger.error(f"Failed to load model {name}: {str(e)}")
+                raise
+
+            self._models[name] = model
+            self._errors.pop(name, None)
+            self._states[name] = READY
+            logger.info(f"Model ready: {name}")
+            return model
+
+    def loaded(self, name):
+        # The model when it is loaded, None otherwise; never loads it
+        return self._models.get(name)
+
+    def is_ready(self, name):
+        return self._states.get(name) == READY
+
+    def unload(self, name):
+        with self._locks[name]:
+            self._models.pop(name, None)
+            self._states[name] = UNLOADED
+
+    def status(self):
+        status = {}
+        for name in self._loaders:
+            status[name] = {'state': self._states[name]}
+            if name in self._errors:
+                status[name]['error'] = self._errors[name]
+        return status
+
+    def preload(self, names):
+        # Load the given models in the background so the HTTP server can start
+        # accepting requests (and answering /health) right away
+        def load_all():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception:
+                    pass
+
+        names = [name for name in names if name]
+        unknown = [name for name in names if name not in self._loaders]
+        if unknown:
+            logger.warning(f"Ignoring unknown models in preload list: {', '.join(unknown)}")
+        names = [name for name in names if name in self._loaders]
+        if names:
+            logger.info(f"Preloading models: {', '.join(names)}")
+            thread = threading.Thread(target=load_all, name='model-preload', daemon=True)
+            thread.start()
+            return thread
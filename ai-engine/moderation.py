@@ -0,0 +1,192 @@
+import logging
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+from tts_stream import SENTENCE_BOUNDARY
+
+logger = logging.getLogger(__name__)
+
+# Words that send kids mode text to the LLM moderator. They are matched as
+# whole words with their plural, verb and -er forms (stab -> stabs, stabbed,
+# stabbing; kill -> killer; explode -> exploding), never as prefixes, so
+# "explore", "terrific", "whiskers" or "breastplate" stay clean. Forms the
+# rules do not produce (knives, bloodbath) are listed themselves.
+DEFAULT_FLAGGED_TERMS = [
+    'kill', 'murder', 'blood', 'bloodbath', 'bloodshed', 'corpse', 'dead body', 'dead bodies', 'decapitate',
+    'behead', 'torture', 'stab', 'slaughter', 'massacre', 'mutilate', 'suicide', 'die', 'dead', 'deadly',
+    'death', 'dying', 'wounded', 'bleed', 'gore', 'gory', 'poison', 'strangle', 'hanged',
+    'weapon', 'knife', 'knives', 'dagger', 'gun', 'pistol', 'rifle', 'shoot', 'bomb', 'explode', 'explosion',
+    'explosive', 'grenade',
+    'drug', 'cocaine', 'heroin', 'alcohol', 'beer', 'wine', 'vodka', 'whiskey', 'whisky', 'drunk', 'cigarette',
+    'sex', 'nude', 'naked', 'kiss', 'seduce', 'breast',
+    'hell', 'damn', 'shit', 'fuck', 'bitch', 'bastard', 'ass',
+    'demon', 'satan', 'zombie', 'horror', 'horrific', 'terrified', 'terrifying', 'scream', 'nightmare'
+]
+
+
+def term_pattern(term):
+    # stab: stab, stabs, stabbed, stabbing, stabber; explode: explodes,
+    # exploded, exploding, exploder
+    forms = re.escape(term) + r'(?:s|es|d|ed|ing|er|ers|y)?'
+    if term[-1].isalpha():
+        forms += '|' + re.escape(term + term[-1]) + r'(?:ed|ing|er|ers|y)'
+    if term.endswith('e') and len(term) > 4:
+        forms += '|' + re.escape(term[:-1]) + r'(?:ing|er|ers)'
+    return forms
+
+
+# Function words that make up a good part of any English sentence
+ENGLISH_WORDS = {
+    'the', 'a', 'an', 'and', 'or', 'of', 'to', 'in', 'on', 'at', 'for', 'with', 'is', 'are', 'was', 'were',
+    'you', 'your', 'it', 'its', 'he', 'she', 'they', 'we', 'his', 'her', 'their', 'this', 'that', 'as', 'by',
+    'from', 'be', 'has', 'have', 'not', 'but', 'what', 'will', 'can', 'into', 'there'
+}
+
+
+def is_english(text, language=None):
+    # The terms above are English, so anything else goes to the moderator. An
+    # explicit language decides; otherwise the text must be plain ASCII and,
+    # past a few words, read like English.
+    if language:
+        return language.lower().startswith('en')
+    if not text.isascii():
+        return False
+    words = re.findall(r"[a-z']+", text.lower())
+    if len(words) < 6:
+        return True
+    return sum(word in ENGLISH_WORDS for word in words) / len(words) >= 0.15
+
+
+class ModerationResult:
+    def __init__(self, text, original_text, flagged_terms, moderated, timings):
+        self.text = text
+        self.original_text = original_text
+        self.flagged_terms = flagged_terms
+        self.moderated = moderated
+        self.timings = timings
+
+    @property
+    def changed(self):
+        return self.text != self.original_text
+
+
+class ModerationPipeline:
+    # Kids mode moderation in two stages: a local keyword pre-filter, then the
+    # LLM moderator only for text the pre-filter flags, and for any text that
+    # is not English (which the pre-filter cannot read). submit() runs the
+    # check on a thread pool so callers can keep working (e.g. synthesize
+    # sentences that were already approved) while the moderator answers.
+
+    def __init__(self, moderator, terms=None, always_moderate=False, max_workers=4):
+        # moderator(text, **kwargs) returns the text, rewritten if unsuitable.
+        # terms are flagged words (see above).
+        self.moderator = moderator
+        self.always_moderate = always_moderate
+        terms = DEFAULT_FLAGGED_TERMS if terms is None else terms
+        alternatives = [term_pattern(term) for term in terms]
+        self._pattern = re.compile(r'\b(?:' + '|'.join(alternatives) + r')\b', re.IGNORECASE) if alternatives else None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='moderation')
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.flagged = 0
+        self.not_english = 0
+        self.moderator_calls = 0
+        self.prefilter_seconds = 0.0
+        self.moderator_seconds = 0.0
+
+    def prefilter(self, text):
+        if self._pattern is None:
+            return []
+        return sorted({match.lower() for match in self._pattern.findall(text)})
+
+    def needs_moderator(self, text, language=None):
+        return self.always_moderate or not is_english(text, language) or bool(self.prefilter(text))
+
+    def check(self, text, language=None, **kwargs):
+        # language is the language the text was asked in, when known
+        start = time.perf_counter()
+        flagged_terms = self.prefilter(text)
+        english = is_english(text, language)
+        prefilter_time = time.perf_counter() - start
+        timings = {'prefilter_ms': round(prefilter_time * 1000, 3), 'moderator_ms': 0.0}
+
+        moderated_text = text
+        needs_moderator = bool(flagged_terms) or not english or self.always_moderate
+        moderator_time = 0.0
+        if needs_moderator:
+            start = time.perf_counter()
+            with metrics.span('moderation'):
+                moderated_text = self.moderator(text, **kwargs)
+            moderator_time = time.perf_counter() - start
+            timings['moderator_ms'] = round(moderator_time * 1000, 3)
+
+        with self._lock:
+            self.checks += 1
+            self.flagged += bool(flagged_terms)
+            self.not_english += not english
+            self.moderator_calls += needs_moderator
+            self.prefilter_seconds += prefilter_time
+            self.moderator_seconds += moderator_time
+
+        return ModerationResult(moderated_text, text, flagged_terms, needs_moderator, timings)
+
+    def submit(self, text, language=None, **kwargs):
+        # Clean text is approved on the calling thread, so its future is
+        # already resolved; only text for the moderator waits for it
+        if not self.needs_moderator(text, language):
+            future = Future()
+            future.set_result(self.check(text, language, **kwargs))
+            return future
+        return self._executor.submit(self.check, text, language, **kwargs)
+
+    def stream(self, tokens, language=None, timings=None, **kwargs):
+        # Yields the text of a token stream once it is approved, a run of
+        # complete sentences at a time. Sentences the pre-filter passes go out
+        # right away; from the first one that needs the moderator on, the rest
+        # is held and moderated as a whole when the stream ends, so nothing
+        # unmoderated is ever yielded. timings, when given, adds up the
+        # prefilter_ms and moderator_ms of the checks.
+        timings = {} if timings is None else timings
+        pending = ''
+        holding = False
+        for token in tokens:
+            pending += token
+            if holding:
+                continue
+            boundaries = list(SENTENCE_BOUNDARY.finditer(pending))
+            if not boundaries:
+                continue
+            end = boundaries[-1].end()
+            if self.needs_moderator(pending[:end], language):
+                holding = True
+                continue
+            result = self.check(pending[:end], language, **kwargs)
+            self._add_timings(timings, result)
+            pending = pending[end:]
+            yield result.text
+
+        text = pending.strip()
+        if text:
+            result = self.check(text, language, **kwargs)
+            self._add_timings(timings, result)
+            yield pending[:len(pending) - len(pending.lstrip())] + result.text
+
+    @staticmethod
+    def _add_timings(timings, result):
+        for name, ms in result.timings.items():
+            timings[name] = round(timings.get(name, 0.0) + ms, 3)
+
+    def stats(self):
+        return {
+            'checks': self.checks,
+            'flagged': self.flagged,
+            'not_english': self.not_english,
+            'moderator_calls': self.moderator_calls,
+            'moderator_calls_saved': self.checks - self.moderator_calls,
+            'prefilter_ms_total': round(self.prefilter_seconds * 1000, 3),
+            'moderator_ms_total': round(self.moderator_seconds * 1000, 3),
+            'always_moderate': self.always_moderate
+        }
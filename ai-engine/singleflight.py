@@ -0,0 +1,133 @@
+import threading
+import time
+from concurrent.futures import Future, CancelledError
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import metrics
+
+coalesced_total = metrics.REGISTRY.counter('coalesced_total', 'Calls that joined an identical call already in flight', ('flight',))
+
+
+class _Caller:
+    def __init__(self, on_step, cancelled):
+        self.on_step = on_step
+        self.cancelled = cancelled
+
+
+class Flight:
+    # One computation and the callers attached to it. Its on_step reports
+    # progress to every caller; cancelled() is True only once every caller
+    # still attached has cancelled.
+
+    def __init__(self):
+        self.future = Future()
+        self._callers = []
+        self._last_step = None
+        self._lock = threading.Lock()
+
+    def join(self, caller):
+        with self._lock:
+            self._callers.append(caller)
+            last_step = self._last_step
+        # A late joiner starts from the progress made so far
+        if last_step and caller.on_step:
+            caller.on_step(*last_step)
+
+    def leave(self, caller):
+        with self._lock:
+            self._callers.remove(caller)
+
+    def on_step(self, step, total=None):
+        with self._lock:
+            self._last_step = (step, total)
+            callers = list(self._callers)
+        for caller in callers:
+            if caller.on_step:
+                caller.on_step(step, total)
+
+    def cancelled(self):
+        with self._lock:
+            callers = list(self._callers)
+        return all(caller.cancelled is not None and caller.cancelled() for caller in callers)
+
+
+class SingleFlight:
+    # Coalesces concurrent identical calls: the first call for a key (the
+    # leader) runs fn(flight) on its own thread, calls with the same key that
+    # arrive while it runs wait for and share its result or exception.
+    # Nothing is kept once the call finished; caching is up to fn.
+    #
+    # A waiting caller gives up after timeout seconds (TimeoutError) or when
+    # its own cancelled() turns True (CancelledError). Either way it only
+    # detaches: the computation goes on for the others, unless every caller
+    # left has cancelled, which fn sees through flight.cancelled().
+
+    def __init__(self, name, poll_interval=0.25):
+        self.name = name
+        self.poll_interval = poll_interval
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def do(self, key, fn, on_step=None, cancelled=None, timeout=None):
+        caller = _Caller(on_step, cancelled)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+            self.calls += 1
+            if not leader:
+                self.coalesced += 1
+        flight.join(caller)
+
+        if leader:
+            try:
+                result = fn(flight)
+            except BaseException as e:
+                self._finish(key, flight, caller)
+                flight.future.set_exception(e)
+                raise
+            self._finish(key, flight, caller)
+            flight.future.set_result(result)
+            return result
+
+        coalesced_total.labels(self.name).inc()
+        try:
+            return self._wait(flight, cancelled, timeout)
+        finally:
+            flight.leave(caller)
+
+    def _finish(self, key, flight, caller):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.leave(caller)
+
+    def _wait(self, flight, cancelled, timeout):
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            wait = self.poll_interval if cancelled else None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise TimeoutError(f"Timed out after {timeout} s waiting for an identical {self.name} call")
+                wait = remaining if wait is None else min(wait, remaining)
+            try:
+                return flight.future.result(timeout=wait)
+            except FutureTimeout:
+                pass
+            if cancelled and cancelled():
+                raise CancelledError()
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'timeouts': self.timeouts,
+            'in_flight': len(self._flights)
+        }
@@ -0,0 +1,275 @@
+import hashlib
+import itertools
+import logging
+import math
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# A turn of the story as the game-server writes it: "Sender: content"
+TURN_PATTERN = re.compile(r'^[^\n:]{1,40}: ')
+
+tokens_total = metrics.REGISTRY.counter('context_tokens_total', 'Estimated prompt tokens of /generate requests with a game id', ('kind',))
+
+
+def estimate_tokens(text):
+    # About 4 bytes per token with the OpenAI and Gemini tokenizers; close
+    # enough for budgeting without a tokenizer dependency
+    return math.ceil(len(text.encode('utf-8')) / 4) if text else 0
+
+
+def split_turns(prompt):
+    # The story lines of a prompt, one entry per turn (continuation lines stay
+    # with their turn), and the closing instruction after the last blank line
+    # ("As the DM, respond to this:"), if there is one
+    body, instruction = prompt.rstrip(), ''
+    head, separator, tail = body.rpartition('\n\n')
+    if separator and head.strip() and not TURN_PATTERN.match(tail):
+        body, instruction = head, tail
+    turns = []
+    for line in body.split('\n'):
+        if turns and not TURN_PATTERN.match(line):
+            turns[-1] += '\n' + line
+        else:
+            turns.append(line)
+    return turns, instruction
+
+
+def fingerprint(turns):
+    return hashlib.sha256('\n'.join(turns).encode('utf-8')).hexdigest()
+
+
+class _GameContext:
+    def __init__(self):
+        self.summary = ''
+        # Turns [0, summarized) are folded into the summary, turns from
+        # window_start on are sent verbatim
+        self.summarized = 0
+        self.fingerprint = fingerprint([])
+        self.window_start = 0
+        # The claim of the request extending the summary, and when it was made
+        self.summarizing = None
+        self.summarizing_since = 0
+
+
+class StoryBoard:
+    # The summary and window of every game. With more than one HTTP worker
+    # the turns of a game reach any of them; the inference process hosts the
+    # board (like the JobBoard) so they all send the same summary and window,
+    # and only one of them extends the summary at a time. The summaries
+    # themselves are still written by the workers (they make the LLM calls).
+
+    def __init__(self, max_games=1024, ttl=24 * 3600, summary_timeout=300):
+        self.games = TTLCache(max_items=max_games, ttl=ttl)
+        # A claim older than this (its worker died or hung) can be taken over
+        self.summary_timeout = summary_timeout
+        self._claims = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _game(self, game_id):
+        state = self.games.get(game_id)
+        if state is None:
+            state = _GameContext()
+        # Refreshes the expiry of an active game
+        self.games.put(game_id, state)
+        return state
+
+    def plan(self, game_id, turns, instruction_tokens, token_budget, keep_ratio):
+        # Moves the window of the game for a request with these turns.
+        # Returns the summary and window to send, whether the story was reset
+        # and, when the window passed the summary, a claim for extending it
+        # up to the window start (see finish)
+        with self._lock:
+            state = self._game(game_id)
+            reset = state.summarized > len(turns) or fingerprint(turns[:state.summarized]) != state.fingerprint
+            if reset:
+                # The story was edited or restarted under the same game id
+                state.summary, state.summarized, state.fingerprint, state.window_start = '', 0, fingerprint([]), 0
+                state.summarizing = None
+
+            budget = max(0, token_budget - estimate_tokens(state.summary) - instruction_tokens)
+            start = min(max(state.window_start, state.summarized), len(turns) - 1)
+            state.window_start = _window_start(turns, start, budget, keep_ratio)
+            claim = None
+            stale = time.monotonic() - state.summarizing_since > self.summary_timeout
+            if state.window_start > state.summarized and (state.summarizing is None or stale):
+                claim = state.summarizing = next(self._claims)
+                state.summarizing_since = time.monotonic()
+            return {
+                'reset': reset,
+                'summary': state.summary,
+                'summarized': state.summarized,
+                'window_start': state.window_start,
+                'claim': claim
+            }
+
+    def state(self, game_id):
+        with self._lock:
+            state = self._game(game_id)
+            return {'summary': state.summary, 'summarized': state.summarized, 'window_start': state.window_start}
+
+    def finish(self, game_id, claim, begin, begin_fingerprint, summary=None, end=None, end_fingerprint=None):
+        # Stores the summary of turns [0, end) extended from turns [0, begin),
+        # unless the story was reset in the meantime, and releases the claim
+        # (summary None only releases it)
+        with self._lock:
+            state = self._game(game_id)
+            if summary is not None and state.summarized == begin and state.fingerprint == begin_fingerprint:
+                state.summary = summary
+                state.summarized = end
+                state.fingerprint = end_fingerprint
+            if state.summarizing == claim:
+                state.summarizing = None
+
+    def stats(self):
+        return self.games.stats()
+
+
+def _window_start(turns, start, budget, keep_ratio):
+    # Keeps the window where it is while it fits; otherwise moves it forward
+    # until the turns left take keep_ratio of the budget (the last turn is
+    # always kept)
+    sizes = [estimate_tokens(turn) + 1 for turn in turns]
+    if sum(sizes[start:]) <= budget:
+        return start
+    target = budget * keep_ratio
+    start = len(turns) - 1
+    kept = sizes[start]
+    while start > 0 and kept + sizes[start - 1] <= target:
+        start -= 1
+        kept += sizes[start]
+    return start
+
+
+class StoryContext:
+    # Keeps /generate prompts of long games within a token budget. The story
+    # turns of a game that no longer fit are folded into a rolling summary,
+    # kept per game id and extended incrementally in the background, so each
+    # turn is summarized once. The request is sent as
+    #
+    #   system:  the system message (identical for every request of the game)
+    #   system:  the summary of the earlier turns
+    #   user:    the recent turns verbatim, then the instruction
+    #
+    # The verbatim window only moves when it outgrows the budget, and then
+    # shrinks to keep_ratio of it, so for several turns in a row the request
+    # starts with the same bytes and the providers' prompt caches can hit.
+    # Turns that left the window but are not in the summary yet (it is being
+    # extended) are still sent verbatim, over budget, rather than dropped.
+    # The per game state lives on board (a StoryBoard, by default of this
+    # process only).
+
+    def __init__(self, summarizer, token_budget=2000, keep_ratio=0.5, summary_chunk_tokens=3000,
+                 max_games=1024, ttl=24 * 3600, max_workers=2, board=None):
+        # summarizer(summary, turns) returns the summary extended with the turns
+        self.summarizer = summarizer
+        self.token_budget = token_budget
+        self.keep_ratio = keep_ratio
+        self.summary_chunk_tokens = summary_chunk_tokens
+        self.board = board or StoryBoard(max_games=max_games, ttl=ttl)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='story-summary')
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.summaries = 0
+        self.summary_errors = 0
+        self.resets = 0
+        self.tokens_sent = 0
+        self.tokens_saved = 0
+
+    def compact(self, game_id, system_message, prompt):
+        # Returns the chat messages for the prompt and what compaction saved
+        turns, instruction = split_turns(prompt)
+        plan = self.board.plan(game_id, turns, estimate_tokens(instruction), self.token_budget, self.keep_ratio)
+        if plan['reset']:
+            logger.info(f"Story of game {game_id} changed, starting a new summary")
+            with self._lock:
+                self.resets += 1
+        summary, summarized, window_start = plan['summary'], plan['summarized'], plan['window_start']
+
+        if plan['claim'] is not None:
+            job = (game_id, plan['claim'], turns[:window_start], summary, summarized)
+            if summary:
+                self._executor.submit(self._summarize, *job)
+            else:
+                # Nothing stands in for the older turns yet, so the request
+                # waits for the first summary; later ones are extended in the
+                # background
+                self._summarize(*job)
+                state = self.board.state(game_id)
+                summary, summarized, window_start = state['summary'], state['summarized'], state['window_start']
+
+        # Nothing is left out: turns the summary does not cover yet go verbatim
+        verbatim_start = min(window_start, summarized)
+        verbatim = '\n'.join(turns[verbatim_start:])
+        messages = [{"role": "system", "content": system_message}]
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the story so far:\n{summary}"})
+        messages.append({"role": "user", "content": verbatim + ('\n\n' + instruction if instruction else '')})
+
+        full = estimate_tokens(system_message) + estimate_tokens(prompt)
+        sent = sum(estimate_tokens(message['content']) for message in messages)
+        with self._lock:
+            self.requests += 1
+            self.tokens_sent += sent
+            self.tokens_saved += max(0, full - sent)
+        tokens_total.labels('sent').inc(sent)
+        tokens_total.labels('saved').inc(max(0, full - sent))
+        return messages, {
+            'tokens_sent': sent,
+            'tokens_full': full,
+            'tokens_saved': max(0, full - sent),
+            'turns': len(turns),
+            'verbatim_turns': len(turns) - verbatim_start,
+            'summarized_turns': summarized,
+            # Older turns sent verbatim until the summary covers them
+            'pending_turns': max(0, window_start - summarized)
+        }
+
+    def _chunks(self, turns):
+        chunk, size = [], 0
+        for turn in turns:
+            tokens = estimate_tokens(turn)
+            if chunk and size + tokens > self.summary_chunk_tokens:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(turn)
+            size += tokens
+        if chunk:
+            yield chunk
+
+    def _summarize(self, game_id, claim, turns, summary, begin):
+        # Extends the summary of turns [0, begin) with the rest of turns, the
+        # story up to the window start
+        try:
+            with metrics.span('story_summary'):
+                for chunk in self._chunks(turns[begin:]):
+                    summary = self.summarizer(summary, chunk)
+            self.board.finish(game_id, claim, begin, fingerprint(turns[:begin]), summary, len(turns), fingerprint(turns))
+            with self._lock:
+                self.summaries += 1
+        except Exception as e:
+            logger.warning(f"Could not summarize the story of game {game_id}: {str(e)}")
+            with self._lock:
+                self.summary_errors += 1
+            try:
+                self.board.finish(game_id, claim, begin, None)
+            except Exception as e:
+                logger.warning(f"Could not release the summary of game {game_id}: {str(e)}")
+
+    def stats(self):
+        return {
+            'games': self.board.stats(),
+            'requests': self.requests,
+            'summaries': self.summaries,
+            'summary_errors': self.summary_errors,
+            'resets': self.resets,
+            'tokens_sent': self.tokens_sent,
+            'tokens_saved': self.tokens_saved,
+            'token_budget': self.token_budget
+        }
@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+import metrics
+from gpu_scheduler import expire, batch_lease
+
+logger = logging.getLogger(__name__)
+
+batch_size = metrics.REGISTRY.histogram('batch_size', 'Requests per model batch', ('model',), buckets=(1, 2, 4, 8, 16, 32))
+batch_seconds = metrics.REGISTRY.histogram('batch_seconds', 'Model run time per batch', ('model',))
+
+
+class _PendingTranscription:
+    def __init__(self, input_features, language, tenant, deadline):
+        self.input_features = input_features
+        self.size = input_features.shape[0]
+        self.language = language
+        self.tenant = tenant
+        self.deadline = deadline
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class WhisperBatcher:
+    # Groups concurrent /speech-to-text requests into a single Whisper
+    # generate() call. Requests are batched per language (the language is
+    # forced through the decoder prompt, so it has to be the same for the
+    # whole batch); a batch is flushed when it is full or when its oldest
+    # request has waited max_wait_ms.
+
+    def __init__(self, lease_model, max_batch_size=8, max_wait_ms=20, generate_kwargs=None, order=None):
+        # lease_model(rows, tenants, deadline) returns a context manager
+        # holding (processor, model) on its device for the duration of one
+        # generate() call over rows feature windows (its working memory). order(pending) may reorder the waiting requests (e.g. fairly
+        # between tenants); its head decides what runs next.
+        self.lease_model = lease_model
+        self.order = order
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.generate_kwargs = generate_kwargs or {}
+        self._pending = []
+        self._condition = threading.Condition()
+        self._worker = None
+        self.batches = 0
+        self.items = 0
+
+    def submit(self, input_features, language=None, tenant=None, deadline=None):
+        # input_features is the (n, n_mels, frames) tensor produced by the
+        # WhisperProcessor; the future resolves to the list of n transcripts.
+        # A request not started by its deadline (time.time()) fails with
+        # DeadlineExceeded.
+        request = _PendingTranscription(input_features, language, tenant, deadline)
+        with self._condition:
+            self._ensure_worker()
+            self._pending.append(request)
+            self._condition.notify()
+        return request.future
+
+    def transcribe(self, input_features, language=None, timeout=None, tenant=None, deadline=None):
+        return self.submit(input_features, language, tenant, deadline).result(timeout=timeout)[0]
+
+    def transcribe_batch(self, input_features, language=None, timeout=None, tenant=None, deadline=None):
+        # Several windows of one recording, kept together in a single generate()
+        return self.submit(input_features, language, tenant, deadline).result(timeout=timeout)
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'avg_batch_size': self.items / self.batches if self.batches else 0,
+            'pending': len(self._pending)
+        }
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name='whisper-batcher', daemon=True)
+            self._worker.start()
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+
+            # The oldest request (of the tenant next in line) decides which
+            # language is served next, so no language can be starved by a
+            # busier one
+            first = self.order(self._pending)[0] if self.order else self._pending[0]
+            language = first.language
+            deadline = first.enqueued_at + self.max_wait
+            while True:
+                pending = self.order(self._pending) if self.order else self._pending
+                same_language = [r for r in pending if r.language == language]
+                remaining = deadline - time.monotonic()
+                if sum(r.size for r in same_language) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            # Fill the batch up to max_batch_size items; a single request
+            # bigger than that still runs, on its own
+            batch = []
+            items = 0
+            for request in same_language:
+                if batch and items + request.size > self.max_batch_size:
+                    break
+                batch.append(request)
+                items += request.size
+            self._pending = [r for r in self._pending if r not in batch]
+            return language, batch
+
+    def _run(self):
+        while True:
+            language, batch = self._next_batch()
+            batch = [r for r in expire(batch) if r.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                transcripts = self._generate(language, batch)
+                offset = 0
+                for request in batch:
+                    request.future.set_result(transcripts[offset:offset + request.size])
+                    offset += request.size
+            except Exception as e:
+                logger.error(f"Error in Whisper batch of {len(batch)}: {str(e)}")
+                for request in batch:
+                    request.future.set_exception(e)
+
+    def _generate(self, language, batch):
+        generate_kwargs = dict(self.generate_kwargs)
+        if language:
+            generate_kwargs['language'] = language
+
+        with self.lease_model(sum(r.size for r in batch), *batch_lease(batch)) as (processor, model):
+            # Whisper features are always padded to 30 s, so a batch is a plain concat
+            input_features = torch.cat([r.input_features for r in batch], dim=0).to(model.device, model.dtype)
+            start = time.perf_counter()
+            with torch.no_grad():
+                predicted_ids = model.generate(input_features, **generate_kwargs)
+            batch_seconds.labels('whisper').observe(time.perf_counter() - start)
+            batch_size.labels('whisper').observe(input_features.shape[0])
+
+        self.batches += 1
+        self.items += input_features.shape[0]
+        return processor.batch_decode(predicted_ids, skip_special_tokens=True)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The engine's modules are flat files in ai-engine/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
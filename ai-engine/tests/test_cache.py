@@ -0,0 +1,45 @@
+import os
+import time
+
+from cache import DiskCache
+
+
+def directory_bytes(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def test_processes_sharing_a_directory_see_each_others_files(tmp_path):
+    a = DiskCache(str(tmp_path), max_bytes=100)
+    b = DiskCache(str(tmp_path), max_bytes=100)
+    a.put('first', b'x' * 40, '.wav')
+    assert b.get('first') == b'x' * 40
+
+    # A suffix b has never seen
+    a.put('second', b'y' * 10, '.mp3')
+    assert b.path('second').endswith('second.mp3')
+
+
+def test_the_budget_holds_for_the_whole_directory(tmp_path):
+    a = DiskCache(str(tmp_path), max_bytes=100)
+    b = DiskCache(str(tmp_path), max_bytes=100)
+    a.put('a1', b'a' * 30)
+    a.put('a2', b'a' * 30)
+    b.put('b1', b'b' * 30)
+    b.put('b2', b'b' * 30)
+    assert directory_bytes(str(tmp_path)) <= 100
+    assert a.get('a1') is None
+    assert b.get('b2') == b'b' * 30
+
+
+def test_a_hit_in_one_process_keeps_the_file_for_the_others(tmp_path):
+    a = DiskCache(str(tmp_path), max_bytes=100)
+    b = DiskCache(str(tmp_path), max_bytes=100)
+    a.put('old', b'o' * 40)
+    time.sleep(0.01)
+    a.put('newer', b'n' * 40)
+    time.sleep(0.01)
+    assert a.get('old') is not None
+    time.sleep(0.01)
+    b.put('third', b't' * 40)
+    assert b.get('old') is not None
+    assert b.get('newer') is None
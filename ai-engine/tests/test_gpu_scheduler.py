@@ -0,0 +1,165 @@
+import threading
+import time
+
+import pytest
+
+from gpu_scheduler import GpuScheduler, DeadlineExceeded
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.005)
+
+
+def waiting(scheduler):
+    return sum(scheduler.stats()['waiting'].values())
+
+
+class Blocker:
+    # Holds the only GPU slot until released, so work can queue up behind it
+    def __init__(self, scheduler, kind='sdxl', tenant='blocker'):
+        self.release = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(scheduler, kind, tenant), daemon=True)
+        self.thread.start()
+        wait_until(lambda: scheduler.stats()['running'])
+
+    def _run(self, scheduler, kind, tenant):
+        with scheduler.run(kind, [tenant]):
+            self.release.wait()
+
+    def done(self):
+        self.release.set()
+        self.thread.join(5)
+
+
+def submit(scheduler, order, kind, tenant, label=None):
+    # Queues a run behind the blocker
+    def work():
+        with scheduler.run(kind, [tenant]):
+            order.append(label or kind)
+
+    thread = threading.Thread(target=work, daemon=True)
+    before = waiting(scheduler)
+    thread.start()
+    wait_until(lambda: waiting(scheduler) > before)
+    return thread
+
+
+def test_higher_priority_models_run_first():
+    scheduler = GpuScheduler()
+    blocker = Blocker(scheduler)
+    order = []
+    threads = [submit(scheduler, order, kind, 'game') for kind in ('sdxl', 'xtts', 'whisper')]
+    blocker.done()
+    for thread in threads:
+        thread.join(5)
+    assert order == ['whisper', 'xtts', 'sdxl']
+
+
+def test_tenants_that_used_less_gpu_time_go_first():
+    scheduler = GpuScheduler()
+    order = []
+    # The busy game already had the GPU for a while
+    with scheduler.run('sdxl', ['busy']):
+        time.sleep(0.1)
+
+    blocker = Blocker(scheduler)
+    threads = [submit(scheduler, order, 'sdxl', 'busy', 'busy-1'),
+               submit(scheduler, order, 'sdxl', 'busy', 'busy-2'),
+               submit(scheduler, order, 'sdxl', 'quiet', 'quiet-1')]
+    blocker.done()
+    for thread in threads:
+        thread.join(5)
+    assert order == ['quiet-1', 'busy-1', 'busy-2']
+
+
+def test_fair_order_puts_the_least_served_tenant_first():
+    scheduler = GpuScheduler()
+    with scheduler.run('sdxl', ['busy']):
+        time.sleep(0.05)
+
+    class Request:
+        def __init__(self, tenant):
+            self.tenant = tenant
+
+    requests = [Request('busy'), Request('busy'), Request('new')]
+    assert [request.tenant for request in scheduler.fair_order(requests)] == ['new', 'busy', 'busy']
+
+
+def test_work_still_queued_at_its_deadline_is_dropped():
+    scheduler = GpuScheduler()
+    blocker = Blocker(scheduler)
+    ran = []
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        with scheduler.run('whisper', ['game'], deadline=time.time() + 0.05):
+            ran.append(True)
+    assert time.monotonic() - start < 1
+    assert not ran
+    assert scheduler.stats()['dropped'] == 1
+    blocker.done()
+
+    # Work that got its slot in time is never dropped
+    with scheduler.run('whisper', ['game'], deadline=time.time() + 0.05):
+        time.sleep(0.1)
+
+
+def image_run(scheduler, events, label, steps=5):
+    with scheduler.run('sdxl', ['game']):
+        for step in range(steps):
+            events.append(f"{label}:{step}")
+            time.sleep(0.02)
+            scheduler.checkpoint()
+
+
+def test_checkpoint_hands_the_slot_to_urgent_work_and_resumes():
+    scheduler = GpuScheduler()
+    events = []
+    image = threading.Thread(target=image_run, args=(scheduler, events, 'image'), daemon=True)
+    image.start()
+    wait_until(lambda: 'image:1' in events)
+
+    with scheduler.run('whisper', ['other']):
+        events.append('whisper')
+    image.join(5)
+
+    assert events.index('whisper') < events.index('image:4')
+    assert [event for event in events if event.startswith('image')] == [f"image:{step}" for step in range(5)]
+    assert scheduler.stats()['preemptions'] == 1
+
+
+def test_a_paused_run_resumes_before_new_work_of_its_class():
+    scheduler = GpuScheduler()
+    events = []
+    first = threading.Thread(target=image_run, args=(scheduler, events, 'first'), daemon=True)
+    first.start()
+    wait_until(lambda: 'first:1' in events)
+
+    # Queued while the first image runs, so it waits next to the paused run
+    second = threading.Thread(target=image_run, args=(scheduler, events, 'second', 1), daemon=True)
+    second.start()
+    wait_until(lambda: waiting(scheduler) == 1)
+    with scheduler.run('whisper', ['other']):
+        events.append('whisper')
+    first.join(5)
+    second.join(5)
+
+    assert events.index('first:4') < events.index('second:0')
+
+
+def test_no_preemption_when_the_urgent_work_does_not_fit():
+    scheduler = GpuScheduler(can_preempt=lambda kind: False)
+    events = []
+    image = threading.Thread(target=image_run, args=(scheduler, events, 'image'), daemon=True)
+    image.start()
+    wait_until(lambda: 'image:1' in events)
+
+    with scheduler.run('whisper', ['other']):
+        events.append('whisper')
+    image.join(5)
+
+    assert events[-1] == 'whisper'
+    assert scheduler.stats()['preemptions'] == 0
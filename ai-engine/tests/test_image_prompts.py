@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+import image_prompts
+from cache import TTLCache
+from moderation import ModerationPipeline
+
+
+class FakeChat:
+    # Stands in for the Upstream client: answers chat() from canned texts and
+    # records every call
+    def __init__(self, expansion, safety='This prompt is suitable for children.'):
+        self.expansion = expansion
+        self.safety = safety
+        self.calls = []
+
+    def chat(self, model, messages, max_tokens=None, temperature=None):
+        moderating = 'content moderator' in messages[0]['content']
+        self.calls.append('safety' if moderating else 'expand')
+        return self.safety if moderating else self.expansion
+
+    def count(self, kind):
+        return self.calls.count(kind)
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches(monkeypatch):
+    monkeypatch.setattr(image_prompts, 'prompt_cache', TTLCache())
+    monkeypatch.setattr(image_prompts, 'safety_cache', TTLCache())
+    monkeypatch.setattr(image_prompts, 'image_moderation', ModerationPipeline(image_prompts.moderate_image_prompt))
+
+
+def request(**fields):
+    return dict({'contextPrompt': 'The party reaches the castle gate.', 'currentMessage': 'I knock on the door.'}, **fields)
+
+
+def test_repeated_input_hits_the_cache():
+    llm = FakeChat('  A wooden castle gate at dusk, cartoon style  ')
+    timings = {}
+    first = image_prompts.build_image_prompt(llm, request(), timings=timings)
+    second = image_prompts.build_image_prompt(llm, request())
+    assert first == second == 'A wooden castle gate at dusk, cartoon style'
+    assert llm.count('expand') == 1
+    assert 'prompt_expansion_ms' in timings
+
+    stats = image_prompts.cache_stats()['prompt_expansion']
+    assert (stats['hits'], stats['misses'], stats['items']) == (1, 1, 1)
+
+
+def test_different_inputs_do_not_share_a_prompt():
+    llm = FakeChat('A castle gate')
+    image_prompts.build_image_prompt(llm, request())
+    image_prompts.build_image_prompt(llm, request(style='watercolor'))
+    image_prompts.build_image_prompt(llm, request(currentMessage='I climb the wall.'))
+    assert llm.count('expand') == 3
+
+
+def test_use_cache_false_bypasses_the_lookup_but_refreshes_the_entry():
+    llm = FakeChat('A castle gate')
+    image_prompts.build_image_prompt(llm, request())
+    llm.expansion = 'A castle gate in the rain'
+    assert image_prompts.build_image_prompt(llm, request(), use_cache=False) == 'A castle gate in the rain'
+    assert llm.count('expand') == 2
+    # The fresh expansion replaced the cached one
+    assert image_prompts.build_image_prompt(llm, request()) == 'A castle gate in the rain'
+    assert llm.count('expand') == 2
+
+
+def test_use_cache_false_does_not_join_a_cached_call_in_flight():
+    release = threading.Event()
+
+    class SlowChat(FakeChat):
+        def chat(self, model, messages, max_tokens=None, temperature=None):
+            text = super().chat(model, messages, max_tokens, temperature)
+            if len(self.calls) == 1:
+                release.wait(5)
+            return text
+
+    llm = SlowChat('A castle gate')
+    cached = threading.Thread(target=image_prompts.build_image_prompt, args=(llm, request()), daemon=True)
+    cached.start()
+    while not llm.calls:
+        time.sleep(0.005)
+
+    llm.expansion = 'A castle gate in the rain'
+    try:
+        assert image_prompts.build_image_prompt(llm, request(), use_cache=False) == 'A castle gate in the rain'
+        assert llm.count('expand') == 2
+    finally:
+        release.set()
+        cached.join(5)
+
+
+def test_kids_mode_rewrites_an_unsuitable_prompt():
+    llm = FakeChat('A knight stabbing a troll with a sword',
+                   safety='This prompt is not suitable for children. Modified version: A knight and a troll having a picnic')
+    prompt = image_prompts.build_image_prompt(llm, request(isKidsMode=True))
+    assert prompt == 'A knight and a troll having a picnic'
+    assert llm.count('safety') == 1
+
+    # The safety verdict is cached too
+    image_prompts.build_image_prompt(llm, request(isKidsMode=True))
+    assert llm.count('safety') == 1
+    assert llm.count('expand') == 1
+    stats = image_prompts.cache_stats()['kids_safety']
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+
+def test_kids_mode_keeps_a_suitable_prompt():
+    llm = FakeChat('A knight with a dagger guarding the gate')
+    assert image_prompts.build_image_prompt(llm, request(isKidsMode=True)) == 'A knight with a dagger guarding the gate'
+    assert llm.count('safety') == 1
+
+
+def test_kids_mode_skips_the_moderator_for_clean_prompts():
+    llm = FakeChat('A sunny meadow with a friendly fox')
+    assert image_prompts.build_image_prompt(llm, request(isKidsMode=True)) == 'A sunny meadow with a friendly fox'
+    assert llm.count('safety') == 0
+    assert image_prompts.moderation_stats()['moderator_calls_saved'] == 1
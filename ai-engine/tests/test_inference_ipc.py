@@ -0,0 +1,45 @@
+import threading
+import time
+
+import pytest
+
+from inference_ipc import InferenceClient, InferenceServer
+
+AUTHKEY = b'test-key'
+
+
+def test_status_calls_fail_fast_while_another_call_waits_for_the_server(tmp_path):
+    client = InferenceClient(str(tmp_path / 'inference.sock'), authkey=AUTHKEY, connect_timeout=30)
+    waiting = threading.Thread(target=lambda: pytest.raises(ConnectionError, client.call, 'transcribe'), daemon=True)
+    waiting.start()
+    time.sleep(0.1)
+
+    start = time.monotonic()
+    with pytest.raises(ConnectionError):
+        client.model_status()
+    assert time.monotonic() - start < 1
+    assert waiting.is_alive()
+
+
+def test_waiting_call_connects_once_the_server_is_up(tmp_path):
+    address = str(tmp_path / 'inference.sock')
+    client = InferenceClient(address, authkey=AUTHKEY, connect_timeout=10)
+    server = InferenceServer({'is_ready': lambda name: name == 'whisper', 'echo': lambda value: value}, address, authkey=AUTHKEY)
+
+    result = []
+    caller = threading.Thread(target=lambda: result.append(client.echo('hello')), daemon=True)
+    caller.start()
+    time.sleep(0.6)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    caller.join(5)
+
+    assert result == ['hello']
+    assert client.is_ready('whisper') is True
+
+
+@pytest.mark.parametrize('address', ['/tmp/inference.sock', '127.0.0.1:7000'])
+def test_server_and_client_refuse_to_run_without_an_authkey(address):
+    with pytest.raises(ValueError):
+        InferenceServer({}, address)
+    with pytest.raises(ValueError):
+        InferenceClient(address, authkey=None)
@@ -0,0 +1,85 @@
+import threading
+
+from jobs import JobQueue, JobBoard, DONE, CANCELLED, JobCancelled
+
+
+def wait_for(queue, job_id, status, timeout=5):
+    event = threading.Event()
+    for _ in range(int(timeout / 0.01)):
+        job = queue.snapshot(job_id)
+        if job and job['status'] == status:
+            return job
+        event.wait(0.01)
+    raise AssertionError(f"job {job_id} did not reach {status}")
+
+
+class RecordingBoard(JobBoard):
+    # Counts the bytes published, as they would cross the IPC connection
+    def __init__(self):
+        super().__init__()
+        self.frame_bytes = 0
+
+    def add_frame(self, job_id, index, frame):
+        self.frame_bytes += len(frame)
+        return super().add_frame(job_id, index, frame)
+
+
+def test_frames_are_published_one_by_one_and_read_from_an_offset():
+    board = RecordingBoard()
+    worker = JobQueue(board=board)
+    other_worker = JobQueue(board=board)
+    release = threading.Event()
+
+    def handler(job):
+        for index in range(3):
+            job.add_frame(bytes([index]) * 10)
+        release.wait(5)
+        job.add_frame(b'\x03' * 10)
+        return {'frame_count': len(job.frames)}
+
+    worker.register('frames', handler)
+    job = worker.submit('frames', {})
+    for _ in range(500):
+        if other_worker.frames(job.id) and len(other_worker.frames(job.id)) == 3:
+            break
+        release.wait(0.01)
+    assert other_worker.frames(job.id) == [b'\x00' * 10, b'\x01' * 10, b'\x02' * 10]
+    assert other_worker.frames(job.id, 2) == [b'\x02' * 10]
+    assert other_worker.snapshot(job.id)['frame_count'] == 3
+
+    release.set()
+    snapshot = wait_for(other_worker, job.id, DONE)
+    assert snapshot['result'] == {'frame_count': 4}
+    assert other_worker.frames(job.id, 3) == [b'\x03' * 10]
+    assert worker.frames(job.id, 1) == other_worker.frames(job.id, 1)
+    # Every frame crossed once
+    assert board.frame_bytes == 40
+
+
+def test_unknown_job_has_no_frames():
+    assert JobQueue().frames('nope') is None
+    assert JobQueue(board=JobBoard()).frames('nope') is None
+
+
+def test_cancel_through_the_board_stops_a_job_at_its_next_frame():
+    board = JobBoard()
+    worker = JobQueue(board=board)
+    other_worker = JobQueue(board=board)
+    started = threading.Event()
+    proceed = threading.Event()
+
+    def handler(job):
+        job.add_frame(b'first')
+        started.set()
+        proceed.wait(5)
+        job.add_frame(b'second')
+        if job.cancel_requested:
+            raise JobCancelled()
+        return {}
+
+    worker.register('frames', handler)
+    job = worker.submit('frames', {})
+    started.wait(5)
+    other_worker.cancel(job.id)
+    proceed.set()
+    wait_for(other_worker, job.id, CANCELLED)
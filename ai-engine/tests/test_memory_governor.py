@@ -0,0 +1,137 @@
+import threading
+import time
+
+import torch
+
+from memory_governor import MemoryGovernor, OFFLOADED, RESIDENT, UNLOAD, UNLOADED, module_bytes
+from model_registry import ModelRegistry
+
+# The governor on a CPU "device" with a small budget: moving models is a no-op,
+# but the accounting, eviction and waiting are the same as on a GPU
+
+MODEL_BYTES = module_bytes(torch.nn.Linear(256, 256))
+
+
+def governor(budget_models=1.5, policy='offload', working_bytes=0, load_delay=0.0, wait_timeout=5):
+    registry = ModelRegistry()
+    loads = []
+
+    def loader(name):
+        def load():
+            loads.append(name)
+            time.sleep(load_delay)
+            return torch.nn.Linear(256, 256)
+        return load
+
+    for name in ('a', 'b', 'c'):
+        registry.register(name, loader(name))
+    governor = MemoryGovernor(registry, 'cpu', budget_bytes=int(budget_models * MODEL_BYTES), policy=policy,
+                              enabled=True, wait_timeout=wait_timeout)
+    for name in ('a', 'b', 'c'):
+        governor.register(name, working_bytes=working_bytes)
+    return governor, registry, loads
+
+
+def state(governor, name):
+    return governor.stats()['models'][name]['state']
+
+
+def test_idle_model_is_evicted_when_the_next_does_not_fit():
+    gov, _, _ = governor()
+    with gov.lease('a'):
+        assert state(gov, 'a') == RESIDENT
+    with gov.lease('b'):
+        pass
+    assert state(gov, 'a') == OFFLOADED
+    assert state(gov, 'b') == RESIDENT
+    assert gov.stats()['models']['a']['evictions'] == 1
+    assert gov.used_bytes() == MODEL_BYTES
+
+
+def test_both_stay_resident_when_they_fit():
+    gov, _, _ = governor(budget_models=2.5)
+    with gov.lease('a'), gov.lease('b'):
+        assert gov.used_bytes() == 2 * MODEL_BYTES
+    assert state(gov, 'a') == state(gov, 'b') == RESIDENT
+
+
+def test_lease_waits_for_a_leased_model_to_be_released():
+    gov, _, _ = governor()
+    with gov.lease('b'):
+        pass
+    granted = threading.Event()
+
+    def lease_b():
+        with gov.lease('b'):
+            granted.set()
+
+    with gov.lease('a'):
+        thread = threading.Thread(target=lease_b)
+        thread.start()
+        time.sleep(0.2)
+        # a is leased and cannot be evicted, so b has to wait
+        assert not granted.is_set()
+        assert gov.stats()['lease_waits'] >= 1
+    thread.join(5)
+    assert granted.is_set()
+    assert state(gov, 'a') == OFFLOADED
+
+
+def test_lease_goes_over_budget_after_the_wait_timeout():
+    gov, _, _ = governor(wait_timeout=0.1)
+    with gov.lease('b'):
+        pass
+    with gov.lease('a'), gov.lease('b'):
+        assert gov.used_bytes() == 2 * MODEL_BYTES
+
+
+def test_fits_accounts_for_leases_evictable_models_and_units():
+    gov, _, _ = governor(budget_models=3, working_bytes=MODEL_BYTES // 2)
+    for name in ('a', 'b'):
+        with gov.lease(name):
+            pass
+    with gov.lease('a'):
+        # b is idle and can be evicted
+        assert gov.fits('b')
+        assert not gov.fits('b', units=3)
+    # Both idle: b would be evicted for a
+    assert gov.fits('a', units=4)
+    assert not gov.fits('a', units=5)
+
+
+def test_working_memory_scales_with_units():
+    gov, _, _ = governor(budget_models=10, working_bytes=1000)
+    with gov.lease('a', units=4):
+        assert gov.used_bytes() == MODEL_BYTES + 4000
+    assert gov.used_bytes() == MODEL_BYTES
+
+
+def test_unloaded_model_is_reloaded_without_holding_the_governor_lock():
+    gov, registry, loads = governor(budget_models=2.6, policy=UNLOAD, working_bytes=MODEL_BYTES // 2, load_delay=0.5)
+    for name in ('a', 'c'):
+        registry.get(name)
+    with gov.lease('a'):
+        pass
+
+    def lease(name):
+        with gov.lease(name):
+            time.sleep(0.1)
+
+    with gov.lease('b'):
+        # a waits for room next to b, and is unloaded meanwhile to make room for c
+        waiting_a = threading.Thread(target=lease, args=('a',))
+        waiting_a.start()
+        time.sleep(0.1)
+        waiting_c = threading.Thread(target=lease, args=('c',))
+        waiting_c.start()
+        time.sleep(0.1)
+        assert state(gov, 'a') == UNLOADED
+    time.sleep(0.05)
+
+    # a is being loaded again; the governor keeps answering meanwhile
+    start = time.perf_counter()
+    gov.fits('b')
+    assert time.perf_counter() - start < 0.25
+    waiting_a.join(5)
+    waiting_c.join(5)
+    assert loads.count('a') == 2
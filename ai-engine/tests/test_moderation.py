@@ -0,0 +1,117 @@
+import pytest
+
+from moderation import ModerationPipeline, is_english
+
+
+def rewrite(text, **kwargs):
+    return 'A friendly story.'
+
+
+@pytest.fixture
+def pipeline():
+    return ModerationPipeline(rewrite)
+
+
+@pytest.mark.parametrize('text', [
+    'The knight stabbed the troll.',
+    'He kept stabbing at the shadows.',
+    'The killer waited in the tower.',
+    'A murderer escaped from the dungeon.',
+    'The battle ended in a bloodbath.',
+    'The goblins drew their knives.',
+    'They carried weapons into the cave.',
+    'The dragon died in a pool of gore.',
+    'What the hell was that?',
+    'The tower exploded.',
+    'The guard was terrified.',
+    'They were shooting at the wagon.',
+])
+def test_prefilter_flags_inflected_and_weapon_terms(pipeline, text):
+    assert pipeline.prefilter(text)
+    assert pipeline.check(text).moderated
+
+
+@pytest.mark.parametrize('text', [
+    'Hello adventurers, the sun is shining over the meadow.',
+    'Can you assist the baker with the bread?',
+    'The party shares a picnic with a friendly fox in the forest.',
+    'Let us explore the cave! The fox explores the meadow.',
+    'What a terrific idea, well done!',
+    'The kitten cleans its whiskers.',
+    'The knight polishes his shiny breastplate.',
+    'The path wound up the hill to the castle.',
+    'Great shot, you hit the target with the ball!',
+    'A friendly monster waves from the bridge.',
+    'Exploration and discovery are the best part of the adventure.',
+    'Ding ding, the ice cream cart is here.',
+])
+def test_clean_english_is_approved_locally(pipeline, text):
+    result = pipeline.check(text, 'en')
+    assert not result.moderated
+    assert result.text == text
+
+
+def test_non_english_language_always_reaches_the_moderator(pipeline):
+    text = 'O dragão matou o cavaleiro e havia sangue'
+    assert pipeline.prefilter(text) == []
+    result = pipeline.check(text, 'pt-br')
+    assert result.moderated
+    assert result.text == 'A friendly story.'
+    assert pipeline.stats()['not_english'] == 1
+
+
+def test_language_is_guessed_when_unknown():
+    assert not is_english('O dragão matou o cavaleiro e havia sangue')
+    assert not is_english('O dragao matou o cavaleiro e havia sangue no chao da caverna')
+    assert is_english('The dragon flies over the castle and the knights wave at it')
+    assert is_english('Roll for initiative!')
+
+
+def test_submit_only_waits_for_text_that_needs_the_moderator(pipeline):
+    clean = pipeline.submit('The sun rises over the quiet village.', 'en')
+    assert clean.done()
+    assert clean.result().text == 'The sun rises over the quiet village.'
+    flagged = pipeline.submit('Der Drache greift an', 'de')
+    assert flagged.result(timeout=5).text == 'A friendly story.'
+
+
+def test_always_moderate():
+    always = ModerationPipeline(rewrite, always_moderate=True)
+    assert always.check('The sun rises.', 'en').moderated
+
+
+def tokens_of(text):
+    # Roughly how a provider streams: a few characters at a time
+    return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+
+def test_stream_yields_clean_sentences_before_the_stream_ends(pipeline):
+    seen = []
+
+    def provider():
+        for token in tokens_of('The sun rises over the village. The baker waves hello. '):
+            seen.append(token)
+            yield token
+        seen.append('<end>')
+        yield from tokens_of('Everyone smiles.')
+
+    chunks = []
+    for chunk in pipeline.stream(provider(), 'en'):
+        chunks.append((chunk, '<end>' in seen))
+    assert chunks[0] == ('The sun rises over the village. ', False)
+    assert ''.join(chunk for chunk, _ in chunks) == 'The sun rises over the village. The baker waves hello. Everyone smiles.'
+    assert pipeline.stats()['moderator_calls'] == 0
+
+
+def test_stream_never_yields_flagged_text(pipeline):
+    text = 'The sun rises. The knight stabs the troll. Then he walks home.'
+    timings = {}
+    chunks = list(pipeline.stream(tokens_of(text), 'en', timings))
+    assert chunks == ['The sun rises. ', 'A friendly story.']
+    assert 'stab' not in ''.join(chunks)
+    assert timings['moderator_ms'] >= 0
+    assert pipeline.stats()['moderator_calls'] == 1
+
+
+def test_stream_holds_non_english_text_for_the_moderator(pipeline):
+    assert list(pipeline.stream(tokens_of('O dragão voa. O cavaleiro acena.'), 'pt')) == ['A friendly story.']
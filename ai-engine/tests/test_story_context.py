@@ -0,0 +1,115 @@
+import threading
+import time
+
+from inference_ipc import InferenceClient, InferenceServer
+from story_context import StoryContext, StoryBoard, fingerprint
+
+
+def story(turns):
+    return '\n'.join(f"Player: turn {i} " + 'x' * 40 for i in range(turns)) + '\n\nAs the DM, respond to this:'
+
+
+def summarizer(summary, turns):
+    return (summary + ' ' if summary else '') + f"[{len(turns)} turns]"
+
+
+def sent_turns(messages):
+    return [line for line in messages[-1]['content'].split('\n') if line.startswith('Player:')]
+
+
+def test_long_story_is_summarized_and_windowed():
+    context = StoryContext(summarizer, token_budget=200)
+    messages, info = context.compact('game', 'You are the DM.', story(30))
+    assert info['summarized_turns'] > 0
+    assert info['verbatim_turns'] + info['summarized_turns'] == 30
+    assert info['pending_turns'] == 0
+    assert messages[1]['content'].startswith('Summary of the story so far:')
+    assert sent_turns(messages)[-1].startswith('Player: turn 29 ')
+    assert info['tokens_saved'] > 0
+
+
+def test_turns_are_sent_verbatim_while_the_summary_catches_up():
+    release = threading.Event()
+    calls = []
+
+    def slow_summarizer(summary, turns):
+        calls.append(len(turns))
+        if len(calls) > 1:
+            release.wait(5)
+        return summarizer(summary, turns)
+
+    context = StoryContext(slow_summarizer, token_budget=200)
+    _, first = context.compact('game', 'You are the DM.', story(30))
+    summarized = first['summarized_turns']
+
+    # The background summary is stuck; every turn it does not cover yet is
+    # still in the prompt
+    for turns in range(31, 60):
+        messages, info = context.compact('game', 'You are the DM.', story(turns))
+        assert info['summarized_turns'] == summarized
+        assert info['verbatim_turns'] == turns - summarized
+        assert len(sent_turns(messages)) == turns - summarized
+        assert sent_turns(messages)[0].startswith(f"Player: turn {summarized} ")
+    assert info['pending_turns'] > 0
+
+    release.set()
+    for _ in range(100):
+        if context.stats()['summaries'] == 2:
+            break
+        time.sleep(0.05)
+    _, info = context.compact('game', 'You are the DM.', story(60))
+    assert info['summarized_turns'] > summarized
+    assert info['verbatim_turns'] + info['summarized_turns'] == 60
+
+
+def test_edited_story_restarts_the_summary():
+    context = StoryContext(summarizer, token_budget=200)
+    context.compact('game', 'You are the DM.', story(30))
+    _, info = context.compact('game', 'You are the DM.', 'Player: a new adventure\n\nAs the DM, respond to this:')
+    assert info['summarized_turns'] == 0
+    assert context.stats()['resets'] == 1
+
+
+def test_workers_sharing_a_board_summarize_once_and_send_the_same_prefix():
+    calls = []
+
+    def counting_summarizer(summary, turns):
+        calls.append(len(turns))
+        return summarizer(summary, turns)
+
+    board = StoryBoard()
+    workers = [StoryContext(counting_summarizer, token_budget=200, board=board) for _ in range(2)]
+    prefixes = set()
+    for turns in range(30, 35):
+        # The turns of the game alternate between the workers
+        messages, info = workers[turns % 2].compact('game', 'You are the DM.', story(turns))
+        prefixes.add((messages[1]['content'], sent_turns(messages)[0]))
+    assert len(calls) == 1
+    assert len(prefixes) == 1
+
+
+def test_a_board_in_another_process_is_shared(tmp_path):
+    address = str(tmp_path / 'inference.sock')
+    board = StoryBoard()
+    server = InferenceServer({f"story_board.{name}": getattr(board, name) for name in ('plan', 'state', 'finish', 'stats')},
+                             address, authkey=b'test-key')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = InferenceClient(address, authkey=b'test-key', connect_timeout=5)
+
+    context = StoryContext(summarizer, token_budget=200, board=client.story_board)
+    _, info = context.compact('game', 'You are the DM.', story(30))
+    assert info['summarized_turns'] > 0
+    assert board.state('game')['summarized'] == info['summarized_turns']
+
+
+def test_a_stale_summary_claim_is_taken_over():
+    board = StoryBoard(summary_timeout=0)
+    turns = story(30).split('\n\n')[0].split('\n')
+    first = board.plan('game', turns, 0, 200, 0.5)
+    second = board.plan('game', turns, 0, 200, 0.5)
+    assert first['claim'] and second['claim'] and first['claim'] != second['claim']
+
+    # The late first summary still counts, but does not release the new claim
+    board.finish('game', first['claim'], 0, fingerprint([]), 'summary', first['window_start'], fingerprint(turns[:first['window_start']]))
+    assert board.state('game')['summary'] == 'summary'
+    assert board.games.get('game').summarizing == second['claim']
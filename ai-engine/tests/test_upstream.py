@@ -0,0 +1,181 @@
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pytest
+from openai import OpenAI
+
+from benchmarks.fake_upstream import FakeUpstream, Handler
+from upstream import Upstream, CircuitBreaker, UpstreamUnavailable, CLOSED, OPEN, HALF_OPEN
+
+
+class ScriptedHandler(Handler):
+    # The fake APIs, except that a model's next requests can be answered with
+    # the errors queued in script[model]: (status, headers)
+    script = None
+    seen = None
+
+    def _chat_completion(self, body):
+        model = body.get('model')
+        self.seen.append(model)
+        queued = self.script.get(model)
+        if queued:
+            status, headers = queued.pop(0)
+            payload = f'{{"error": {{"message": "scripted {status}"}}}}'.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        super()._chat_completion(body)
+
+
+@pytest.fixture
+def fake():
+    script, seen = {}, []
+    handler = type('Handler', (ScriptedHandler,), {
+        'upstream': FakeUpstream(latency_ms=0, jitter_ms=0, tokens_per_second=0),
+        'script': script,
+        'seen': seen
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server, script, seen
+    server.shutdown()
+
+
+def make_upstream(server, **kwargs):
+    host, port = server.server_address
+    # The client's own retries are off; Upstream does the retrying
+    client = OpenAI(api_key='test', base_url=f"http://{host}:{port}/v1", max_retries=0)
+    kwargs = dict(dict(max_retries=2, backoff_base=0.01, backoff_max=1.0, failure_threshold=3, reset_timeout=0.2), **kwargs)
+    return Upstream(client, None, {'primary': 'gpt-4o-mini', 'backup': 'gpt-4o'}, **kwargs)
+
+
+MESSAGES = [{'role': 'user', 'content': 'Hello'}]
+
+
+def test_429_and_5xx_are_retried(fake):
+    server, script, seen = fake
+    script['gpt-4o-mini'] = [(429, {}), (503, {})]
+    upstream = make_upstream(server)
+    assert upstream.chat('primary', MESSAGES)
+    assert seen == ['gpt-4o-mini'] * 3
+    assert upstream.stats()['providers']['openai']['state'] == CLOSED
+
+
+def test_retry_after_is_honoured(fake):
+    server, script, seen = fake
+    script['gpt-4o-mini'] = [(429, {'Retry-After': '0.3'})]
+    upstream = make_upstream(server)
+    start = time.monotonic()
+    upstream.chat('primary', MESSAGES)
+    assert time.monotonic() - start >= 0.3
+    assert len(seen) == 2
+
+
+def test_client_errors_are_not_retried(fake):
+    server, script, seen = fake
+    script['gpt-4o-mini'] = [(400, {})]
+    upstream = make_upstream(server)
+    with pytest.raises(Exception) as error:
+        upstream.chat('primary', MESSAGES)
+    assert getattr(error.value, 'status_code', None) == 400
+    assert seen == ['gpt-4o-mini']
+    assert upstream.stats()['providers']['openai']['consecutive_failures'] == 0
+
+
+def test_breaker_opens_lets_one_trial_through_and_closes(fake):
+    server, script, seen = fake
+    upstream = make_upstream(server, max_retries=0, failure_threshold=2)
+    script['gpt-4o-mini'] = [(503, {})] * 3
+
+    for _ in range(2):
+        with pytest.raises(Exception):
+            upstream.chat('primary', MESSAGES, failover=False)
+    assert upstream.stats()['providers']['openai']['state'] == OPEN
+
+    # Open: rejected without reaching the provider
+    with pytest.raises(UpstreamUnavailable):
+        upstream.chat('primary', MESSAGES, failover=False)
+    assert len(seen) == 2
+
+    # Half open: the failed trial opens the circuit again
+    time.sleep(0.25)
+    with pytest.raises(Exception):
+        upstream.chat('primary', MESSAGES, failover=False)
+    assert len(seen) == 3
+    assert upstream.stats()['providers']['openai']['state'] == OPEN
+
+    # The next trial succeeds and closes it
+    time.sleep(0.25)
+    assert upstream.chat('primary', MESSAGES, failover=False)
+    assert upstream.stats()['providers']['openai']['state'] == CLOSED
+
+
+def test_half_open_allows_a_single_trial_until_it_is_released():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    # A trial that ended without an outcome frees the slot
+    breaker.release_trial()
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+def test_chat_fails_over_to_the_secondary_model(fake):
+    server, script, seen = fake
+    script['gpt-4o-mini'] = [(503, {})] * 3
+    upstream = make_upstream(server, failure_threshold=10)
+    assert upstream.chat('primary', MESSAGES)
+    assert seen == ['gpt-4o-mini'] * 3 + ['gpt-4o']
+    assert upstream.stats()['failovers'] == 1
+
+
+def test_stream_retries_opening_and_fails_over(fake):
+    server, script, seen = fake
+    script['gpt-4o-mini'] = [(502, {})] * 3
+    upstream = make_upstream(server, failure_threshold=10)
+    text = ''.join(upstream.chat_stream('primary', MESSAGES))
+    assert text.startswith('The torchlight flickers')
+    assert seen == ['gpt-4o-mini'] * 3 + ['gpt-4o']
+    assert upstream.stats()['failovers'] == 1
+
+
+def open_circuit(upstream, script):
+    script['gpt-4o-mini'] = [(503, {})]
+    with pytest.raises(Exception):
+        upstream.chat('primary', MESSAGES, failover=False)
+    time.sleep(0.25)
+
+
+def test_a_trial_that_times_out_waiting_for_a_slot_is_released(fake):
+    server, script, seen = fake
+    upstream = make_upstream(server, max_retries=0, failure_threshold=1, max_concurrency=1, acquire_timeout=0.05)
+    open_circuit(upstream, script)
+
+    semaphore = upstream.providers['openai'].semaphore
+    semaphore.acquire()
+    with pytest.raises(UpstreamUnavailable):
+        upstream.chat('primary', MESSAGES, failover=False)
+    semaphore.release()
+    assert upstream.chat('primary', MESSAGES, failover=False)
+    assert upstream.stats()['providers']['openai']['state'] == CLOSED
+
+
+def test_a_trial_that_fails_before_calling_the_provider_is_released(fake):
+    server, script, seen = fake
+    upstream = make_upstream(server, max_retries=0, failure_threshold=1)
+    open_circuit(upstream, script)
+
+    with pytest.raises(RuntimeError):
+        with upstream.slot('openai'):
+            raise RuntimeError('bad request body')
+    assert upstream.chat('primary', MESSAGES, failover=False)
@@ -0,0 +1,94 @@
+import logging
+import queue
+import re
+import struct
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Sentence boundaries: terminal punctuation followed by whitespace, or line breaks
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?;…。！？])\s+|\n+')
+
+# Data size used in streamed WAV headers, where the final length is unknown.
+# Most decoders treat it as "read until the end of the stream".
+STREAMING_DATA_SIZE = 0xFFFFFFFF - 36
+
+
+def split_sentences(text, min_chars=20):
+    # Very short fragments ("Yes.", "Oh!") are merged into the next sentence so
+    # every synthesis call has enough context to sound natural
+    sentences = []
+    current = ''
+    for part in SENTENCE_BOUNDARY.split(text):
+        part = part.strip()
+        if not part:
+            continue
+        current = f"{current} {part}" if current else part
+        if len(current) >= min_chars:
+            sentences.append(current)
+            current = ''
+    if current:
+        if sentences and len(current) < min_chars:
+            sentences[-1] = f"{sentences[-1]} {current}"
+        else:
+            sentences.append(current)
+    return sentences
+
+
+def wav_header(sample_rate, data_size=STREAMING_DATA_SIZE, channels=1, bits_per_sample=16):
+    byte_rate = sample_rate * channels * bits_per_sample // 8
+    block_align = channels * bits_per_sample // 8
+    return (
+        b'RIFF' + struct.pack('<I', 36 + data_size) + b'WAVE'
+        + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels, sample_rate, byte_rate, block_align, bits_per_sample)
+        + b'data' + struct.pack('<I', data_size)
+    )
+
+
+def pcm16(samples):
+    # Float samples in [-1, 1] to little-endian 16-bit PCM
+    samples = np.clip(np.asarray(samples, dtype=np.float32), -1.0, 1.0)
+    return (samples * 32767).astype('<i2').tobytes()
+
+
+def encode_wav(pcm, sample_rate):
+    return wav_header(sample_rate, data_size=len(pcm)) + pcm
+
+
+def pipelined(items, produce, prefetch=1):
+    # Yields produce(item) for each item in order, producing the next items in
+    # a background thread while the caller is still consuming the current one
+    results = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def worker():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                results.put((produce(item), None))
+        except Exception as e:
+            results.put((None, e))
+        results.put((done, None))
+
+    thread = threading.Thread(target=worker, name='tts-stream', daemon=True)
+    thread.start()
+    try:
+        while True:
+            result, error = results.get()
+            if error is not None:
+                raise error
+            if result is done:
+                return
+            yield result
+    finally:
+        # The client went away (or we failed): stop producing and unblock the worker
+        stop.set()
+        while thread.is_alive():
+            try:
+                results.get_nowait()
+            except queue.Empty:
+                thread.join(0.05)
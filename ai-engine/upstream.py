@@ -0,0 +1,343 @@
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class UpstreamUnavailable(Exception):
+    pass
+
+
+def status_code(error):
+    # OpenAI errors carry .status_code, google.api_core errors carry .code
+    for attribute in ('status_code', 'code'):
+        code = getattr(error, attribute, None)
+        if isinstance(code, int):
+            return code
+    return None
+
+
+def is_retryable(error):
+    code = status_code(error)
+    if code is not None:
+        return code in RETRYABLE_STATUS
+    # Timeouts and dropped connections have no status code
+    name = type(error).__name__
+    return isinstance(error, (TimeoutError, ConnectionError)) or 'Timeout' in name or 'Connection' in name
+
+
+def retry_after(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive upstream failures; after
+    # reset_timeout seconds a single trial call is let through (half open)
+    # and its outcome closes or re-opens the circuit
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._trial_thread = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._trial_running = False
+            if self.state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                self._trial_thread = threading.get_ident()
+                return True
+            return False
+
+    def release_trial(self):
+        # Frees this thread's trial call when it ended without an outcome
+        # (never started, or stopped early), so the next call can be the trial
+        with self._lock:
+            if self._trial_running and self._trial_thread == threading.get_ident():
+                self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+    def snapshot(self):
+        return {'state': self.state, 'consecutive_failures': self.failures}
+
+
+class Provider:
+    def __init__(self, name, max_concurrency, failure_threshold, reset_timeout):
+        self.name = name
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.in_flight = 0
+
+
+class Upstream:
+    # Shared access to the hosted LLM providers. Every call is bounded by a
+    # per-provider concurrency limit, retried with jittered exponential backoff
+    # on 429/5xx/timeouts, and guarded by a circuit breaker. Chat calls fail
+    # over to the other models in model_mapping when a provider is down.
+    # Latency is recorded per provider and model.
+
+    def __init__(self, openai_client, gemini_model_factory, model_mapping,
+                 max_concurrency=8, max_retries=2, backoff_base=0.5, backoff_max=8.0,
+                 acquire_timeout=30, request_timeout=60, failure_threshold=5, reset_timeout=30):
+        self.openai_client = openai_client
+        self.gemini_model_factory = gemini_model_factory
+        self.model_mapping = model_mapping
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.acquire_timeout = acquire_timeout
+        self.request_timeout = request_timeout
+        self.providers = {
+            name: Provider(name, max_concurrency, failure_threshold, reset_timeout)
+            for name in ('openai', 'gemini')
+        }
+        self.latency = metrics.REGISTRY.histogram('upstream_seconds', 'Successful upstream API call latency', ('provider', 'model'))
+        self.errors = metrics.REGISTRY.counter('upstream_errors_total', 'Upstream API calls that failed after retries', ('provider', 'model'))
+        metrics.REGISTRY.gauge('upstream_in_flight', 'Upstream API calls in progress', lambda: {
+            (name,): provider.in_flight for name, provider in self.providers.items()
+        }, ('provider',))
+        metrics.REGISTRY.gauge('upstream_circuit_open', '1 while the provider circuit breaker is open', lambda: {
+            (name,): int(provider.breaker.state == OPEN) for name, provider in self.providers.items()
+        }, ('provider',))
+        metrics.REGISTRY.counter('upstream_failovers_total', 'Chat requests served by a failover model', collect=lambda: self.failovers)
+        self.failovers = 0
+        self._gemini_models = {}
+        self._gemini_lock = threading.Lock()
+
+    @staticmethod
+    def provider_for(model):
+        return 'gemini' if model.startswith('gemini') else 'openai'
+
+    def gemini_model(self, name):
+        # GenerativeModel instances are reused instead of built per request
+        model = self._gemini_models.get(name)
+        if model is None:
+            with self._gemini_lock:
+                model = self._gemini_models.get(name)
+                if model is None:
+                    model = self._gemini_models[name] = self.gemini_model_factory(name)
+        return model
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        hinted = retry_after(error)
+        if hinted is not None:
+            delay = max(delay, min(hinted, self.backoff_max))
+        return delay
+
+    @contextmanager
+    def slot(self, provider_name):
+        # Holds one of the provider's concurrency slots, unless its circuit is
+        # open. The outcome is recorded by _with_retries; a half-open trial
+        # that ends without one is released on the way out.
+        provider = self.providers[provider_name]
+        if not provider.breaker.allow():
+            raise UpstreamUnavailable(f"Circuit open for {provider_name}")
+        if not provider.semaphore.acquire(timeout=self.acquire_timeout):
+            provider.breaker.release_trial()
+            raise UpstreamUnavailable(f"Timed out waiting for a {provider_name} slot")
+        provider.in_flight += 1
+        try:
+            yield provider
+        finally:
+            provider.in_flight -= 1
+            provider.semaphore.release()
+            provider.breaker.release_trial()
+
+    def _with_retries(self, provider, model, fn):
+        with metrics.span('upstream'):
+            return self._retry(provider, model, fn)
+
+    def _retry(self, provider, model, fn):
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_retryable(e):
+                    # The request itself is wrong; the provider is fine
+                    provider.breaker.record_success()
+                    self.errors.labels(provider.name, model).inc()
+                    raise
+                if attempt >= self.max_retries:
+                    provider.breaker.record_failure()
+                    self.errors.labels(provider.name, model).inc()
+                    raise
+                delay = self._backoff(attempt, e)
+                logger.warning(f"{provider.name} {model} failed ({str(e)}), retrying in {delay:.2f}s")
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self.latency.labels(provider.name, model).observe(time.perf_counter() - start)
+            provider.breaker.record_success()
+            return result
+
+    def call(self, provider_name, model, fn):
+        # Runs fn() against the provider with the concurrency limit, retries
+        # and circuit breaker applied
+        with self.slot(provider_name) as provider:
+            return self._with_retries(provider, model, fn)
+
+    def call_stream(self, provider_name, model, open_stream):
+        # Yields the chunks of a streamed response. open_stream() returns
+        # (first chunk, remaining chunks); opening the stream is retried like
+        # call(), a failure after the first chunk is raised to the caller.
+        with self.slot(provider_name) as provider:
+            first, chunks = self._with_retries(provider, model, open_stream)
+            if first is not None:
+                yield first
+            yield from chunks
+
+    def _candidates(self, model_key):
+        # The requested model first, then the others as failover targets
+        candidates = []
+        for key in [model_key] + list(self.model_mapping):
+            model = self.model_mapping.get(key, key)
+            if model not in [candidate for _, candidate in candidates]:
+                candidates.append((key, model))
+        return candidates
+
+    def _chat_once(self, model, messages, max_tokens, temperature):
+        if self.provider_for(model) == 'gemini':
+            response = self.gemini_model(model).generate_content(
+                [message['content'] for message in messages],
+                request_options={'timeout': self.request_timeout}
+            )
+            return response.text
+
+        kwargs = {'model': model, 'messages': messages, 'timeout': self.request_timeout}
+        if max_tokens is not None:
+            kwargs['max_tokens'] = max_tokens
+        if temperature is not None:
+            kwargs['temperature'] = temperature
+        response = self.openai_client.chat.completions.create(**kwargs)
+        return response.choices[0].message.content
+
+    def chat(self, model_key, messages, max_tokens=None, temperature=None, failover=True):
+        # model_key is a MODEL_MAPPING key (or a raw model name); returns the
+        # completion text from the first provider that answers
+        last_error = None
+        for index, (key, model) in enumerate(self._candidates(model_key)):
+            if index and not failover:
+                break
+            try:
+                text = self.call(self.provider_for(model), model, lambda: self._chat_once(model, messages, max_tokens, temperature))
+                if index:
+                    self.failovers += 1
+                    logger.warning(f"Served {model_key} request with failover model {key}")
+                return text
+            except Exception as e:
+                if not isinstance(e, UpstreamUnavailable) and not is_retryable(e):
+                    raise
+                last_error = e
+        raise last_error
+
+    def _stream_once(self, model, messages, max_tokens, temperature):
+        if self.provider_for(model) == 'gemini':
+            response = self.gemini_model(model).generate_content(
+                [message['content'] for message in messages],
+                stream=True,
+                request_options={'timeout': self.request_timeout}
+            )
+            for chunk in response:
+                if chunk.text:
+                    yield chunk.text
+            return
+
+        kwargs = {'model': model, 'messages': messages, 'stream': True, 'timeout': self.request_timeout}
+        if max_tokens is not None:
+            kwargs['max_tokens'] = max_tokens
+        if temperature is not None:
+            kwargs['temperature'] = temperature
+        for chunk in self.openai_client.chat.completions.create(**kwargs):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def chat_stream(self, model_key, messages, max_tokens=None, temperature=None, failover=True):
+        # Yields completion tokens. Retries and failover cover opening the
+        # stream up to the first token, which is where rate limits and outages
+        # show up; a failure after text was sent is raised to the caller.
+        last_error = None
+        for index, (key, model) in enumerate(self._candidates(model_key)):
+            if index and not failover:
+                break
+
+            def open_stream():
+                tokens = self._stream_once(model, messages, max_tokens, temperature)
+                return next(tokens, None), tokens
+
+            try:
+                with self.slot(self.provider_for(model)) as provider:
+                    try:
+                        first, tokens = self._with_retries(provider, model, open_stream)
+                    except Exception as e:
+                        if not is_retryable(e):
+                            raise
+                        last_error = e
+                        continue
+
+                    if index:
+                        self.failovers += 1
+                        logger.warning(f"Streaming {model_key} request with failover model {key}")
+                    if first is not None:
+                        yield first
+                    yield from tokens
+                    return
+            except UpstreamUnavailable as e:
+                last_error = e
+        raise last_error
+
+    def stats(self):
+        return {
+            'providers': {
+                name: dict(provider.breaker.snapshot(), in_flight=provider.in_flight, max_concurrency=provider.max_concurrency)
+                for name, provider in self.providers.items()
+            },
+            'failovers': self.failovers,
+            'latency_seconds': {
+                f"{provider}/{model}": histogram.snapshot()
+                for (provider, model), histogram in self.latency.items()
+            }
+        }
@@ -0,0 +1,132 @@
+import numpy as np
+
+# Whisper's encoder always sees 30 s of audio, longer input is truncated
+MAX_WINDOW_SECONDS = 30.0
+
+
+class Window:
+    # A run of speech to transcribe in one Whisper pass: the samples to feed
+    # it plus where they start and end in the original recording
+    def __init__(self, samples, start, end, overlaps_previous=False):
+        self.samples = samples
+        self.start = start
+        self.end = end
+        self.overlaps_previous = overlaps_previous
+
+
+def frame_energies(samples, frame_size):
+    # RMS energy of consecutive non-overlapping frames
+    frames = len(samples) // frame_size
+    if not frames:
+        return np.zeros(0, dtype=np.float32)
+    framed = samples[:frames * frame_size].reshape(frames, frame_size)
+    return np.sqrt(np.mean(np.square(framed, dtype=np.float32), axis=1))
+
+
+def speech_segments(samples, sample_rate, frame_ms=30, threshold_ratio=3.0, min_energy=0.005,
+                    min_speech_ms=150, min_silence_ms=400, pad_ms=150):
+    # Energy based voice activity detection. A frame is speech when its RMS is
+    # threshold_ratio times above the noise floor (the 10th percentile of all
+    # frames) and above min_energy. Pauses shorter than min_silence_ms are kept
+    # inside a segment, blips shorter than min_speech_ms are dropped, and each
+    # segment is padded so word onsets are not clipped. Returns (start, end)
+    # sample offsets.
+    frame_size = max(1, int(sample_rate * frame_ms / 1000))
+    energies = frame_energies(samples, frame_size)
+    if not len(energies):
+        return []
+
+    noise_floor = float(np.percentile(energies, 10))
+    threshold = max(min_energy, noise_floor * threshold_ratio)
+    voiced = energies > threshold
+
+    max_gap = int(min_silence_ms / frame_ms)
+    min_frames = max(1, int(min_speech_ms / frame_ms))
+    pad = int(sample_rate * pad_ms / 1000)
+
+    segments = []
+    start = None
+    last_voiced = None
+    for index, is_voiced in enumerate(voiced):
+        if not is_voiced:
+            continue
+        if start is not None and index - last_voiced > max_gap:
+            segments.append((start, last_voiced + 1))
+            start = None
+        if start is None:
+            start = index
+        last_voiced = index
+    if start is not None:
+        segments.append((start, last_voiced + 1))
+
+    return [
+        (max(0, first * frame_size - pad), min(len(samples), last * frame_size + pad))
+        for first, last in segments
+        if last - first >= min_frames
+    ]
+
+
+def speech_windows(samples, sample_rate, segments, max_seconds=MAX_WINDOW_SECONDS, overlap_seconds=1.0, gap_seconds=0.2):
+    # Packs speech segments into windows of at most max_seconds. Silence
+    # between segments is replaced by a short gap_seconds pause, so it costs
+    # nothing. A segment longer than a window is cut into pieces that overlap
+    # by overlap_seconds; stitch_transcripts() removes the repeated words.
+    max_samples = int(max_seconds * sample_rate)
+    overlap = int(overlap_seconds * sample_rate)
+    gap = np.zeros(int(gap_seconds * sample_rate), dtype=samples.dtype)
+
+    pieces = []
+    for start, end in segments:
+        while end - start > max_samples:
+            pieces.append((start, start + max_samples))
+            start += max_samples - overlap
+        pieces.append((start, end))
+
+    windows = []
+    current = []
+    length = 0
+    for start, end in pieces:
+        added = end - start + (len(gap) if current else 0)
+        if current and length + added > max_samples:
+            windows.append(_window(samples, sample_rate, current, gap, windows))
+            current = []
+            added = end - start
+            length = 0
+        current.append((start, end))
+        length += added
+    if current:
+        windows.append(_window(samples, sample_rate, current, gap, windows))
+    return windows
+
+
+def _window(samples, sample_rate, pieces, gap, previous_windows):
+    parts = []
+    for index, (start, end) in enumerate(pieces):
+        if index:
+            parts.append(gap)
+        parts.append(samples[start:end])
+    start, end = pieces[0][0] / sample_rate, pieces[-1][1] / sample_rate
+    overlaps_previous = bool(previous_windows) and start < previous_windows[-1].end
+    return Window(np.concatenate(parts), start, end, overlaps_previous)
+
+
+def stitch_transcripts(windows, texts, max_overlap_words=12):
+    # Joins the window transcripts. Where a window overlaps the previous one,
+    # the words both transcribed at the boundary are kept once. Returns the
+    # text contributed by each window and the combined transcript.
+    stitched = []
+    previous = []
+    for window, text in zip(windows, texts):
+        words = text.split()
+        overlap = min(max_overlap_words, len(previous), len(words)) if window.overlaps_previous else 0
+        for size in range(overlap, 0, -1):
+            if [_normalize(word) for word in previous[-size:]] == [_normalize(word) for word in words[:size]]:
+                words = words[size:]
+                break
+        stitched.append(' '.join(words))
+        previous = text.split()
+    return stitched, ' '.join(part for part in stitched if part)
+
+
+def _normalize(word):
+    return ''.join(character for character in word.lower() if character.isalnum())
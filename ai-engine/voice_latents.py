@@ -0,0 +1,108 @@
+import glob
+import hashlib
+import logging
+import os
+import threading
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class VoiceLatentStore:
+    # XTTS speaker conditioning (GPT conditioning latent + speaker embedding)
+    # for the reference voices in samples_dir. Each voice is encoded once and
+    # reused for every utterance; the result is kept in memory and, when
+    # cache_dir is set, persisted as <voice>-<wav hash>.pt so restarts skip
+    # the encoder pass too. Replacing a WAV changes its hash and invalidates
+    # the stored latents.
+
+    def __init__(self, samples_dir, cache_dir=None):
+        self.samples_dir = samples_dir
+        self.cache_dir = cache_dir
+        self._latents = {}
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def sample_path(self, voice):
+        return os.path.join(self.samples_dir, voice + '.wav')
+
+    def voices(self):
+        return sorted(os.path.splitext(os.path.basename(path))[0]
+                      for path in glob.glob(os.path.join(self.samples_dir, '*.wav')))
+
+    def get(self, voice, model):
+        # model is the Xtts instance (TTS(...).synthesizer.tts_model)
+        path = self.sample_path(voice)
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        entry = self._latents.get(voice)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+
+        with self._lock:
+            entry = self._latents.get(voice)
+            if entry is not None and entry[0] == signature:
+                return entry[1]
+
+            wav_hash = file_sha256(path)
+            latents = self._load(voice, wav_hash, model.device)
+            if latents is None:
+                logger.info(f"Computing XTTS conditioning latents for voice: {voice}")
+                config = model.config
+                latents = model.get_conditioning_latents(
+                    audio_path=[path],
+                    gpt_cond_len=config.gpt_cond_len,
+                    max_ref_length=config.max_ref_len,
+                    sound_norm_refs=config.sound_norm_refs
+                )
+                self._save(voice, wav_hash, latents)
+
+            self._latents[voice] = (signature, latents)
+            return latents
+
+    def preload(self, model, voices=None):
+        for voice in voices or self.voices():
+            try:
+                self.get(voice, model)
+            except Exception as e:
+                logger.warning(f"Failed to compute XTTS latents for voice {voice}: {str(e)}")
+
+    def _cache_path(self, voice, wav_hash):
+        return os.path.join(self.cache_dir, f"{voice}-{wav_hash[:16]}.pt")
+
+    def _load(self, voice, wav_hash, device):
+        if not self.cache_dir:
+            return None
+        path = self._cache_path(voice, wav_hash)
+        if not os.path.exists(path):
+            return None
+        try:
+            stored = torch.load(path, map_location=device, weights_only=True)
+            return stored['gpt_cond_latent'], stored['speaker_embedding']
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable XTTS latents {path}: {str(e)}")
+            return None
+
+    def _save(self, voice, wav_hash, latents):
+        if not self.cache_dir:
+            return
+        # Latents computed from a previous version of this WAV are stale now
+        for stale in glob.glob(os.path.join(self.cache_dir, f"{voice}-*.pt")):
+            os.unlink(stale)
+        gpt_cond_latent, speaker_embedding = latents
+        try:
+            torch.save({'gpt_cond_latent': gpt_cond_latent.cpu(), 'speaker_embedding': speaker_embedding.cpu()},
+                       self._cache_path(voice, wav_hash))
+        except OSError as e:
+            logger.warning(f"Failed to persist XTTS latents for voice {voice}: {str(e)}")
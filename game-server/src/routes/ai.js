@@ -15,6 +15,14 @@ const upload = multer(); // In-memory storage
 const generateHash = (text) => {
   return crypto.createHash('md5').update(text).digest('hex');
 };
+
+// Trace id for the ai-engine call, so its logs and stage timings can be
+// matched to this request, and the game it is for, so the ai-engine can share
+// its GPU fairly between games
+const traceHeaders = (req) => ({
+  'X-Trace-Id': req.get('X-Trace-Id') || crypto.randomUUID().replace(/-/g, ''),
+  ...(req.body && req.body.gameId ? { 'X-Game-Id': String(req.body.gameId) } : {})
+});
 // Helper function to get or create audio file
 const getOrCreateAudioFile = async (gameId, text, audioBuffer = null) => {
   const hash = generateHash(text);
@@ -148,20 +156,24 @@ router.post('/generate-image', verifyToken, async (req, res) => {
       currentMessage: currentMessage.content,
       style,
       isKidsMode,
-      theme
+      theme,
+      format: 'webp'
+    }, {
+      // Raw image bytes, with the prompt in the X-Image-Prompt header
+      headers: { Accept: 'image/webp', ...traceHeaders(req) },
+      responseType: 'arraybuffer'
     });
     
-    const imageData = response.data.image;
-    
-    const buffer = Buffer.from(imageData, 'base64');
-    const imageFileName = `image_${gameId}_${Date.now()}.png`;
+    const buffer = Buffer.from(response.data);
+    const imageFileName = `image_${gameId}_${Date.now()}.webp`;
+    const prompt = decodeURIComponent(response.headers['x-image-prompt'] || '');
     
     await storeFile(imageBucketName, imageFileName, buffer);
     
     currentMessage.imageFile = `/image/${imageFileName}`;
     await gameState.save();
     
-    res.json({ imageUrl: currentMessage.imageFile, prompt: response.data.prompt });
+    res.json({ imageUrl: currentMessage.imageFile, prompt });
   } catch (error) {
     console.error('Error generating image:', error);
     res.status(500).json({ error: 'An error occurred while generating the image' });
@@ -179,6 +191,7 @@ router.post('/speech-to-text', verifyToken, upload.single('audio'), async (req,
     // Send the buffer to the AI engine
     const aiResponse = await axios.post('http://192.168.18.3:5000/speech-to-text', audioBuffer, {
       headers: {
+        ...traceHeaders(req),
         'Content-Type': 'audio/wav',
         'language': language.replace(/([a-z]{2})([a-z]{2})/i, '$1-$2')
       },
@@ -231,7 +244,7 @@ router.post('/generate-audio', verifyToken, async (req, res) => {
     // If not, generate new audio, add - to language e.g. ptbr -> pt-br
     const response = await axios.post('http://192.168.18.3:5000/tts', 
       { text: message.content, voice, language: language.replace(/([a-z]{2})([a-z]{2})/i, '$1-$2') },
-      { responseType: 'arraybuffer' }
+      { responseType: 'arraybuffer', headers: traceHeaders(req) }
     );
     
     const buffer = Buffer.from(response.data);
@@ -278,7 +291,7 @@ router.get('/image/:filename', async (req, res) => {
     const objectName = req.params.filename;
     const stream = await getFile(imageBucketName, objectName);
     
-    res.setHeader('Content-Type', 'image/png');
+    res.setHeader('Content-Type', objectName.endsWith('.webp') ? 'image/webp' : 'image/png');
     stream.pipe(res);
   } catch (error) {
     console.error('Error retrieving image file:', error);